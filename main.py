@@ -1,17 +1,3022 @@
 # 导入tkinter库，这是Python的标准GUI工具包，用于创建图形用户界面
 import tkinter as tk
 # 导入ttk模块，提供了themed Tk widgets，是tkinter的扩展，提供更现代的界面组件，导入messagebox用于显示消息对话框，simpledialog用于创建简单的输入对话框
-from tkinter import ttk, messagebox, simpledialog
+from tkinter import ttk, messagebox, simpledialog, filedialog
 # 导入json模块，用于处理JSON格式数据，在与Ollama API通信时解析和生成JSON数据
 import json
 # 导入requests库，用于发送HTTP请求，与Ollama服务器进行API通信
 import requests
+from requests.adapters import HTTPAdapter
 # 导入time库，用于显示时间
 import time
 # 导入webbrowser模块，用于打开系统默认浏览器
 import webbrowser
 # 导入re模块，用于正则表达式处理
 import re
+# 导入os模块，用于读取本地模型存储目录和文件状态
+import os
+# 导入threading和queue模块，用于在后台线程执行网络请求并把结果交回主线程
+import threading
+import queue
+# 导入线程池，用于有限并发地执行批量请求
+from concurrent.futures import ThreadPoolExecutor, as_completed
+# 导入logging模块，用于记录运行日志和API调用耗时
+import logging
+from logging.handlers import RotatingFileHandler
+from collections import deque, OrderedDict
+from urllib.parse import urlsplit
+# 导入诊断模式使用的模块：调用栈、性能分析和内存分配跟踪
+import sys
+import io
+import traceback
+import cProfile
+import pstats
+import tracemalloc
+# 导入hashlib和mmap模块，用于计算文件内容哈希（大文件以内存映射方式处理）
+import hashlib
+import mmap
+# 导入tarfile模块，用于模型包的流式打包和解包
+import tarfile
+# 导入sqlite3、array和unicodedata模块，用于嵌入向量缓存的紧凑存储和文本规范化
+import sqlite3
+from array import array
+import unicodedata
+# 导入base64模块，用于图片附件的编码
+import base64
+# 导入codecs模块，用于大文档附件的增量解码
+import codecs
+# 导入csv模块，用于导出操作日志
+import csv
+# 导入Pillow用于缩放图片附件和读取剪贴板图片，未安装时图片按原样发送
+try:
+    from PIL import Image, ImageGrab, ImageOps
+except ImportError:
+    Image = None
+    ImageGrab = None
+    ImageOps = None
+# 导入numpy用于向量检索，未安装时文档检索功能不可用，其余功能不受影响
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def format_bytes(num_bytes):
+    # 将字节数格式化为便于阅读的字符串（B/KB/MB/GB/TB）
+    size = float(num_bytes)
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1024:
+            return f"{size:.1f}{unit}" if unit != 'B' else f"{int(size)}B"
+        size /= 1024
+    return f"{size:.1f}TB"
+# 该函数在磁盘占用统计、删除确认等多处复用，统一字节大小的显示格式。
+
+
+def is_local_host(ip):
+    # 判断服务器地址是否为本机，只有本机服务器的模型才在本地模型目录中
+    return ip.lower().split('://')[-1] in ('localhost', '127.0.0.1', '::1', '[::1]')
+
+
+# 应用程序数据目录，用于保存生成参数配置、缓存、日志等持久化数据
+APP_DATA_DIR = os.path.join(os.path.expanduser('~'), '.ollama_gui')
+
+
+def load_json_file(path, default):
+    # 读取JSON文件，文件不存在或内容损坏时返回默认值
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json_file(path, data):
+    # 先写入临时文件再替换，避免程序异常退出时留下写了一半的文件
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+# 这两个函数是所有持久化配置共用的读写入口，统一使用UTF-8编码和原子替换。
+
+
+# 程序日志记录器，所有功能模块共用
+logger = logging.getLogger('ollama_gui')
+
+
+class StructuredFormatter(logging.Formatter):
+    # 日志格式化器：在普通日志行后以 key=value 形式追加结构化字段（通过extra={'fields': {...}}传入）
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line += ' ' + ' '.join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+class RingBufferHandler(logging.Handler):
+    # 内存环形缓冲日志处理器：只保留最近的若干条日志，供界面中的日志窗口查看
+    def __init__(self, capacity=2000):
+        super().__init__()
+        self.records = deque(maxlen=capacity)
+
+    def emit(self, record):
+        try:
+            self.records.append(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+    def lines(self):
+        # 返回当前缓冲区中全部日志行的副本
+        with self.lock:
+            return list(self.records)
+
+
+class LoggerWriter:
+    # 类文件对象：把写入stderr的内容（警告、未捕获的异常等）按行转发到日志
+    def __init__(self, level=logging.ERROR):
+        self.level = level
+        self.buffer = ''
+        # 当前线程是否正在转发日志：日志处理器出错时handleError会写stderr，再次进入这里会无限递归
+        self.local = threading.local()
+
+    def write(self, text):
+        if getattr(self.local, 'active', False):
+            # 转发过程中产生的输出直接写到原始的stderr（pythonw下可能不存在）
+            if sys.__stderr__ is not None:
+                sys.__stderr__.write(text)
+            return len(text)
+        self.local.active = True
+        try:
+            self.buffer += text
+            while '\n' in self.buffer:
+                line, self.buffer = self.buffer.split('\n', 1)
+                if line.strip():
+                    logger.log(self.level, line.rstrip())
+        finally:
+            self.local.active = False
+        return len(text)
+
+    def flush(self):
+        if self.buffer.strip():
+            logger.log(self.level, self.buffer.rstrip())
+        self.buffer = ''
+
+
+# 界面日志窗口使用的内存缓冲区
+log_buffer = RingBufferHandler()
+
+
+def setup_logging(log_dir=None, max_bytes=2 * 1024 * 1024, backup_count=3):
+    """
+    初始化日志系统
+
+    - 日志写入按大小轮转的文件（默认单个文件2MB，保留3个备份），磁盘占用有上限
+    - 同时写入内存环形缓冲区，可在界面中查看最近的日志
+    - 返回日志文件路径
+    """
+    log_dir = log_dir or os.path.join(APP_DATA_DIR, 'logs')
+    os.makedirs(log_dir, exist_ok=True)
+    log_path = os.path.join(log_dir, 'ollama_gui.log')
+    formatter = StructuredFormatter('%(asctime)s %(levelname)s %(threadName)s %(message)s')
+    file_handler = RotatingFileHandler(log_path, maxBytes=max_bytes,
+                                       backupCount=backup_count, encoding='utf-8')
+    file_handler.setFormatter(formatter)
+    log_buffer.setFormatter(formatter)
+    logger.setLevel(logging.INFO)
+    logger.addHandler(file_handler)
+    logger.addHandler(log_buffer)
+    # 日志处理器自身出错（如磁盘已满）时不再把异常信息写到stderr，stderr已经被转发到日志
+    logging.raiseExceptions = False
+    # warnings模块产生的警告也通过日志记录
+    logging.captureWarnings(True)
+    logging.getLogger('py.warnings').addHandler(file_handler)
+    logging.getLogger('py.warnings').addHandler(log_buffer)
+    return log_path
+# 日志系统替代了原来把stderr重定向到无限增长的StringIO的做法，长时间运行时内存占用不再增长，且错误信息可以查看。
+
+
+class TimedSession(requests.Session):
+    # 带计时的HTTP会话：每次API调用都会记录接口、方法、主机、状态码和耗时
+    # 流式请求的耗时为收到响应头的时间，完整的流式耗时由调用方另行记录
+    def request(self, method, url, *args, **kwargs):
+        parts = urlsplit(url)
+        fields = {'op': parts.path, 'method': method.upper(), 'host': parts.netloc}
+        start = time.perf_counter()
+        try:
+            response = super().request(method, url, *args, **kwargs)
+        except Exception as e:
+            fields.update(elapsed_ms=round((time.perf_counter() - start) * 1000, 1), error=type(e).__name__)
+            logger.warning("api_call", extra={'fields': fields})
+            raise
+        fields.update(status=response.status_code,
+                      elapsed_ms=round((time.perf_counter() - start) * 1000, 1),
+                      stream=bool(kwargs.get('stream')))
+        logger.info("api_call", extra={'fields': fields})
+        return response
+
+
+# 全部API请求共用的HTTP会话，同时可以复用TCP连接
+api = TimedSession()
+# 生成请求的超时（秒）：(建立连接, 两次收到数据之间的最长间隔)
+# 服务器在加载模型和计算提示词之后才返回第一个片段，读取超时需要足够长；主机宕机或网络中断时请求不会永远挂起
+GENERATE_TIMEOUT = (10, 300)
+
+
+class OptionsProfileStore:
+    """
+    按模型保存的生成参数配置
+
+    功能：
+    - 为每个模型保存一组Ollama请求options（num_ctx、num_thread、num_gpu、num_batch）
+    - 提供内置预设，例如“低延迟短上下文”和“长文档”
+    - 配置保存在APP_DATA_DIR/profiles.json中，程序重启后依然有效
+    - 记录每个模型最近一次生成返回的加载和推理耗时，便于比较不同配置
+    """
+
+    # 可在界面中编辑的参数名称及说明
+    OPTION_FIELDS = [
+        ('num_ctx', '上下文长度'),
+        ('num_thread', 'CPU线程数'),
+        ('num_gpu', 'GPU层数'),
+        ('num_batch', '批处理大小'),
+        ('temperature', '温度'),
+        ('seed', '随机种子'),
+    ]
+
+    # 需要按浮点数解析的参数，其余参数均为整数
+    FLOAT_OPTIONS = {'temperature'}
+
+    # 思考模式（请求的think字段）：None表示不发送，由服务器决定
+    THINK_MODES = {
+        '服务器默认': None,
+        '开启（单独显示）': True,
+        '关闭（降低延迟）': False,
+    }
+
+    # 内置预设，空字典表示完全使用服务器默认值
+    PRESETS = {
+        '服务器默认': {},
+        '低延迟短上下文': {'num_ctx': 2048, 'num_batch': 256},
+        '长文档': {'num_ctx': 32768, 'num_batch': 512},
+    }
+
+    # 每个模型保留的首token时间样本数（预填充和未预填充分别保留）
+    TTFT_SAMPLES = 20
+    # 发送时的预填充状态：预填充的内容与发送的消息完全一致 / 预填充请求还没有完成 / 没有可用的预填充
+    # 预填充未完成时服务器仍在计算，首token时间介于两者之间，单独统计才不会拉偏另外两组的平均值
+    PREFILL_LABELS = {'done': '已预填充', 'running': '预填充未完成', 'none': '未预填充'}
+
+    def __init__(self, path=None):
+        # 配置文件路径，默认位于应用程序数据目录
+        self.path = path or os.path.join(APP_DATA_DIR, 'profiles.json')
+        # 模型名称 -> {'profile': 预设名称, 'options': 参数字典, 'think': 思考模式}
+        self.models = load_json_file(self.path, {}).get('models', {})
+        # 模型名称 -> 最近一次生成的耗时统计（只保存在内存中）
+        self.last_stats = {}
+        # 模型名称 -> {是否预填充: 最近的首token时间（秒）}，用于比较输入时预填充的效果
+        self.ttft_samples = {}
+
+    def profile_for(self, model):
+        # 返回模型当前使用的预设名称和参数，未配置时使用服务器默认
+        entry = self.models.get(model, {})
+        return entry.get('profile', '服务器默认'), dict(entry.get('options', {}))
+
+    def options_for(self, model):
+        # 返回需要合并到请求options中的参数（只包含用户设置过的项）
+        return self.profile_for(model)[1]
+
+    def think_for(self, model):
+        # 返回模型的思考模式：True/False作为请求的think字段发送，None表示使用服务器默认
+        return self.models.get(model, {}).get('think')
+
+    def set_profile(self, model, profile, options, think=None):
+        # 保存模型的参数配置，只保留有效的参数并转换为对应的数值类型
+        clean = {key: self.parse_option(key, value) for key, value in options.items()
+                 if key in dict(self.OPTION_FIELDS) and value not in (None, '')}
+        self.models[model] = {'profile': profile, 'options': clean}
+        if think is not None:
+            self.models[model]['think'] = think
+        save_json_file(self.path, {'models': self.models})
+
+    @classmethod
+    def parse_option(cls, key, value):
+        # 将输入的参数值转换为数值，格式不正确时抛出ValueError
+        return float(value) if key in cls.FLOAT_OPTIONS else int(value)
+
+    def record_stats(self, model, result):
+        # 从流式响应的最后一条数据中提取服务器报告的耗时（单位纳秒）
+        stats = {key: result.get(key) for key in
+                 ('total_duration', 'load_duration', 'prompt_eval_count',
+                  'prompt_eval_duration', 'eval_count', 'eval_duration')}
+        stats['profile'] = self.profile_for(model)[0]
+        self.last_stats[model] = stats
+        return stats
+
+    @staticmethod
+    def format_stats(stats):
+        # 将耗时统计格式化为一行简短文本
+        def seconds(ns):
+            return (ns or 0) / 1e9
+
+        def rate(count, ns):
+            return (count or 0) / seconds(ns) if ns else 0.0
+
+        return (f"[{stats.get('profile')}] 加载 {seconds(stats.get('load_duration')):.2f}s | "
+                f"提示词 {stats.get('prompt_eval_count') or 0} tok "
+                f"{rate(stats.get('prompt_eval_count'), stats.get('prompt_eval_duration')):.1f} tok/s | "
+                f"生成 {stats.get('eval_count') or 0} tok "
+                f"{rate(stats.get('eval_count'), stats.get('eval_duration')):.1f} tok/s | "
+                f"总计 {seconds(stats.get('total_duration')):.2f}s")
+
+    def record_ttft(self, model, seconds, prefill):
+        # 记录一次首token时间，按预填充状态（PREFILL_LABELS中的键）分别保存最近的样本
+        samples = self.ttft_samples.setdefault(model, {})
+        samples.setdefault(prefill, deque(maxlen=self.TTFT_SAMPLES)).append(seconds)
+
+    def format_ttft(self, model, seconds, prefill):
+        # 将本次首token时间和各预填充状态下的平均值格式化为一行文本
+        def average(key):
+            values = self.ttft_samples.get(model, {}).get(key)
+            return f"{sum(values) / len(values):.2f}s ({len(values)}次)" if values else '-'
+
+        return (f"首token {seconds:.2f}s（{self.PREFILL_LABELS[prefill]}） | 平均 " +
+                " / ".join(f"{label} {average(key)}" for key, label in self.PREFILL_LABELS.items()))
+# 这个类负责生成参数的持久化和耗时统计。send_message只发送用户设置过的参数，未设置的项仍由服务器决定，
+# 这样可以按模型分别控制上下文长度、GPU卸载层数、批处理大小和线程数，同时观察配置对加载和推理速度的影响。
+
+
+class DocumentIndex:
+    """
+    本地文档检索索引
+
+    功能：
+    - 将文件夹中的文本文件切分为片段，通过批量/api/embed请求生成向量
+    - 向量以float32矩阵形式保存在内存映射文件中，检索top-k时只需一次矩阵乘法
+    - 记录每个文件的修改时间、大小和内容哈希，重建索引时只重新嵌入发生变化的文件
+    - 已删除或已修改文件的旧片段先标记为无效，无效片段过多时再整体压缩
+
+    存储结构（位于APP_DATA_DIR/retrieval/<索引名>/）：
+    - meta.json：文件信息、片段对应关系和嵌入模型
+    - chunks.json：片段文本，与向量矩阵的行一一对应
+    - vectors.f32：已归一化的float32向量矩阵
+    """
+
+    # 参与索引的文本文件扩展名
+    TEXT_EXTENSIONS = {'.txt', '.md', '.rst', '.py', '.json', '.csv', '.log', '.html', '.xml', '.yaml', '.yml', '.ini'}
+    # 每个片段的最大字符数和相邻片段的重叠字符数
+    CHUNK_CHARS = 1000
+    CHUNK_OVERLAP = 200
+
+    def __init__(self, name='default', root_dir=None):
+        # 索引文件所在目录
+        self.index_dir = os.path.join(root_dir or os.path.join(APP_DATA_DIR, 'retrieval'), name)
+        self.meta_path = os.path.join(self.index_dir, 'meta.json')
+        self.chunks_path = os.path.join(self.index_dir, 'chunks.json')
+        self.vectors_path = os.path.join(self.index_dir, 'vectors.f32')
+        # 检索锁：保护向量映射和片段列表，只在追加、替换和检索时短暂持有
+        self.lock = threading.Lock()
+        # 更新锁：同一时间只允许一次增量更新
+        self.update_lock = threading.Lock()
+        meta = load_json_file(self.meta_path, {})
+        # 文件路径 -> {'mtime_ns', 'size', 'sha256', 'rows': [行号列表]}
+        self.files = meta.get('files', {})
+        # 嵌入模型名称和向量维度，切换模型后需要完整重建
+        self.model = meta.get('model')
+        self.dim = meta.get('dim', 0)
+        self.folder = meta.get('folder')
+        # 每一行对应的 (文件路径, 片段文本)，文件路径为None表示该行已失效
+        self.chunks = load_json_file(self.chunks_path, [])
+        # 每一行是否有效的布尔数组，与chunks同步维护，检索时不需要再遍历全部片段
+        self.valid = (np.fromiter((chunk[0] is not None for chunk in self.chunks), dtype=bool, count=len(self.chunks))
+                      if np is not None else None)
+        self.vectors = None
+        self.open_vectors()
+
+    def open_vectors(self):
+        # 以只读方式内存映射向量矩阵，不会把整个矩阵读入内存
+        self.vectors = None
+        if np is not None and self.dim and self.chunks and os.path.exists(self.vectors_path):
+            # 上次更新中途失败时文件末尾可能留有chunks.json中没有记录的行，先截断，保证行号与片段一一对应
+            expected = len(self.chunks) * self.dim * 4
+            if os.path.getsize(self.vectors_path) > expected:
+                with open(self.vectors_path, 'r+b') as f:
+                    f.truncate(expected)
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r',
+                                     shape=(len(self.chunks), self.dim))
+        else:
+            self.vectors = None
+
+    def save_meta(self):
+        # 保存索引的元数据和片段文本
+        save_json_file(self.meta_path, {'files': self.files, 'model': self.model,
+                                        'dim': self.dim, 'folder': self.folder})
+        save_json_file(self.chunks_path, self.chunks)
+
+    @classmethod
+    def split_text(cls, text):
+        # 将文本切分为有重叠的片段，尽量在换行处断开
+        chunks = []
+        start = 0
+        length = len(text)
+        while start < length:
+            end = min(length, start + cls.CHUNK_CHARS)
+            if end < length:
+                newline = text.rfind('\n', start + cls.CHUNK_CHARS // 2, end)
+                if newline != -1:
+                    end = newline + 1
+            chunk = text[start:end].strip()
+            if chunk:
+                chunks.append(chunk)
+            if end >= length:
+                break
+            start = max(end - cls.CHUNK_OVERLAP, start + 1)
+        return chunks
+
+    def scan_folder(self, folder):
+        # 遍历文件夹，返回所有支持的文本文件路径
+        paths = []
+        for dirpath, _dirnames, filenames in os.walk(folder):
+            for filename in filenames:
+                if os.path.splitext(filename)[1].lower() in self.TEXT_EXTENSIONS:
+                    paths.append(os.path.join(dirpath, filename))
+        return sorted(paths)
+
+    def update(self, folder, model, embed_fn, progress=None):
+        """
+        增量更新索引
+
+        参数：
+        - folder：要索引的文件夹
+        - model：嵌入模型名称
+        - embed_fn：嵌入函数，接收文本列表，返回同样长度的向量列表
+        - progress：进度回调，参数为 (已处理文件数, 文件总数, 当前文件)
+        返回值：(重新嵌入的文件数, 新增片段数)
+
+        读取文件和嵌入请求都在检索锁之外进行，每个文件嵌入完成后才短暂加锁追加向量并替换旧片段，
+        更新期间检索照常进行，修改过的文件在新向量就绪前仍按旧内容检索。
+        """
+        if np is None:
+            raise RuntimeError("文档检索需要安装numpy: pip install numpy")
+        with self.update_lock:
+            with self.lock:
+                # 切换文件夹或嵌入模型时，旧向量不再可用，需要完整重建
+                if folder != self.folder or model != self.model:
+                    self.files, self.chunks, self.dim = {}, [], 0
+                    self.valid = np.zeros(0, dtype=bool)
+                    self.vectors = None
+                    if os.path.exists(self.vectors_path):
+                        os.remove(self.vectors_path)
+                    self.folder, self.model = folder, model
+
+            paths = self.scan_folder(folder)
+            present = set(paths)
+            with self.lock:
+                # 已删除文件的片段标记为失效
+                for path in list(self.files):
+                    if path not in present:
+                        self.invalidate_rows(self.files.pop(path)['rows'])
+
+            changed_files = 0
+            new_rows = 0
+            try:
+                for index, path in enumerate(paths):
+                    if progress:
+                        progress(index, len(paths), path)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    # files只会在持有update_lock时被修改，这里可以直接读取
+                    info = self.files.get(path)
+                    # 修改时间和大小都没变，直接跳过，不读取文件内容
+                    if info and info['mtime_ns'] == st.st_mtime_ns and info['size'] == st.st_size:
+                        continue
+                    with open(path, 'rb') as f:
+                        raw = f.read()
+                    digest = hashlib.sha256(raw).hexdigest()
+                    # 内容哈希未变（例如只是被touch过），只更新修改时间
+                    if info and info['sha256'] == digest:
+                        with self.lock:
+                            info['mtime_ns'], info['size'] = st.st_mtime_ns, st.st_size
+                        continue
+                    texts = self.split_text(raw.decode('utf-8', errors='ignore'))
+                    # 嵌入请求可能耗时很长，不持有检索锁
+                    matrix = self.normalize(texts, embed_fn(texts)) if texts else None
+                    with self.lock:
+                        if info:
+                            self.invalidate_rows(info['rows'])
+                        rows = self.append_vectors(path, texts, matrix) if texts else []
+                        self.files[path] = {'mtime_ns': st.st_mtime_ns, 'size': st.st_size,
+                                            'sha256': digest, 'rows': rows}
+                    changed_files += 1
+                    new_rows += len(rows)
+
+                if progress:
+                    progress(len(paths), len(paths), '')
+                with self.lock:
+                    # 失效行超过一半时压缩矩阵，回收磁盘空间
+                    dead = len(self.chunks) - self.chunk_count()
+                    if dead and dead * 2 > len(self.chunks):
+                        self.compact()
+            finally:
+                # 嵌入中途失败时也保存已追加的行，向量文件与chunks.json始终保持一致
+                with self.lock:
+                    self.save_meta()
+                    self.open_vectors()
+            return changed_files, new_rows
+
+    def invalidate_rows(self, rows):
+        # 将指定行标记为失效，检索时会被跳过（调用方持有self.lock）
+        for row in rows:
+            self.chunks[row] = [None, '']
+        if self.valid is not None and rows:
+            self.valid[rows] = False
+
+    def normalize(self, texts, vectors):
+        # 检查嵌入结果并按行归一化，返回float32矩阵（不访问索引状态，可以在锁外调用）
+        matrix = np.asarray(vectors, dtype=np.float32)
+        if matrix.ndim != 2 or len(matrix) != len(texts):
+            raise ValueError("嵌入结果数量与片段数量不一致")
+        if self.dim and matrix.shape[1] != self.dim:
+            raise ValueError(f"向量维度不一致: {matrix.shape[1]} != {self.dim}")
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.maximum(norms, 1e-12)
+
+    def append_vectors(self, path, texts, matrix):
+        # 将归一化后的向量追加到矩阵文件末尾并重新映射，返回新增的行号列表（调用方持有self.lock）
+        if not self.dim:
+            self.dim = matrix.shape[1]
+        # 追加写入前释放内存映射，避免Windows上文件被占用
+        self.vectors = None
+        os.makedirs(self.index_dir, exist_ok=True)
+        with open(self.vectors_path, 'ab') as f:
+            f.write(matrix.tobytes())
+        start = len(self.chunks)
+        self.chunks.extend([path, text] for text in texts)
+        self.valid = np.concatenate([self.valid, np.ones(len(texts), dtype=bool)])
+        # 写入后立即重新映射，检索不会看到向量为空的中间状态
+        self.open_vectors()
+        return list(range(start, len(self.chunks)))
+
+    def compact(self):
+        # 删除所有失效行，重写向量矩阵并更新各文件的行号
+        self.open_vectors()
+        keep = [row for row, chunk in enumerate(self.chunks) if chunk[0] is not None]
+        data = np.array(self.vectors[keep]) if keep and self.vectors is not None else np.zeros((0, self.dim), np.float32)
+        self.vectors = None
+        data.astype(np.float32).tofile(self.vectors_path)
+        mapping = {old: new for new, old in enumerate(keep)}
+        self.chunks = [self.chunks[row] for row in keep]
+        self.valid = np.ones(len(keep), dtype=bool)
+        for info in self.files.values():
+            info['rows'] = [mapping[row] for row in info['rows'] if row in mapping]
+
+    def search(self, query_vector, k=4):
+        # 余弦相似度检索：向量已归一化，一次矩阵乘法得到全部得分
+        with self.lock:
+            if np is None or self.vectors is None or not len(self.chunks):
+                return []
+            # 不使用原地除法，避免修改调用者传入的数组
+            query = np.asarray(query_vector, dtype=np.float32)
+            query = query / max(float(np.linalg.norm(query)), 1e-12)
+            scores = self.vectors @ query
+            valid = self.valid
+            scores = np.where(valid, scores, -np.inf)
+            k = min(k, int(valid.sum()))
+            if k <= 0:
+                return []
+            # argpartition只做部分排序，再对前k个结果排序
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [(float(scores[row]), self.chunks[row][0], self.chunks[row][1]) for row in top]
+
+    def chunk_count(self):
+        # 返回有效片段数量
+        if self.valid is not None:
+            return int(self.valid.sum())
+        return sum(1 for chunk in self.chunks if chunk[0] is not None)
+# 这个类实现了基于本地文件的向量检索。向量在写入时就做了归一化，检索时的余弦相似度退化为点积，
+# 十万级片段的检索只需一次矩阵-向量乘法；更新时先比较修改时间，再比较内容哈希，只有内容真正变化的文件才会重新嵌入。
+
+
+def embed_texts(url, model, texts, batch_size=32, concurrency=2):
+    # 通过/api/embed批量生成向量：按batch_size分批，最多concurrency个请求同时进行
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+
+    def embed_batch(batch):
+        response = api.post(url, json={"model": model, "input": batch})
+        response.raise_for_status()
+        return response.json().get('embeddings', [])
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        results = list(pool.map(embed_batch, batches))
+    vectors = [vector for batch in results for vector in batch]
+    if len(vectors) != len(texts):
+        raise ValueError(f"嵌入结果数量不正确: {len(vectors)} != {len(texts)}")
+    return vectors
+# 批量请求可以大幅减少与服务器之间的往返次数，pool.map保证返回结果与输入顺序一致。
+
+
+class EmbeddingCache:
+    """
+    按内容寻址的嵌入向量磁盘缓存
+
+    功能：
+    - 以 (模型digest, 规范化文本的SHA-256) 作为键，相同内容只需嵌入一次
+    - 向量以float32二进制形式保存在SQLite数据库中，体积紧凑
+    - 按最近使用时间(LRU)淘汰，总大小不超过设定的上限
+    - 同名模型的digest发生变化（例如重新拉取了新版本）时，自动删除旧digest的全部缓存
+    - 记录本次运行的命中和未命中次数，在界面中显示
+    """
+
+    def __init__(self, path=None, max_bytes=256 * 1024 * 1024):
+        self.path = path or os.path.join(APP_DATA_DIR, 'embed_cache.sqlite3')
+        # 缓存大小上限（字节），只统计向量数据本身
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # 本次运行中已确认过的 模型名称 -> digest，用于检测digest变化
+        self.known_digests = {}
+        # SQLite连接会在多个后台线程中使用，所有访问都通过锁串行化
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries ("
+                        "key TEXT PRIMARY KEY, model TEXT, digest TEXT, "
+                        "vector BLOB, size INTEGER, last_used REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries(last_used)")
+        self.db.commit()
+
+    @staticmethod
+    def normalize_text(text):
+        # 规范化文本：统一Unicode形式并合并连续空白，避免仅空白不同的文本重复嵌入
+        return ' '.join(unicodedata.normalize('NFC', text).split())
+
+    def make_key(self, digest, text):
+        # 缓存键由模型digest和规范化文本的哈希组成
+        text_hash = hashlib.sha256(self.normalize_text(text).encode('utf-8')).hexdigest()
+        return f"{digest}:{text_hash}"
+
+    def check_digest(self, model, digest):
+        # 同名模型的digest变化时，删除该模型旧digest的全部缓存条目
+        if self.known_digests.get(model) == digest:
+            return
+        with self.lock:
+            self.db.execute("DELETE FROM entries WHERE model = ? AND digest != ?", (model, digest))
+            self.db.commit()
+        self.known_digests[model] = digest
+
+    def embed(self, model, digest, texts, embed_fn):
+        """
+        先查缓存，只把未命中的文本交给embed_fn嵌入，并把新结果写入缓存
+
+        参数：
+        - model/digest：模型名称和digest
+        - texts：文本列表
+        - embed_fn：嵌入函数，接收文本列表，返回同样长度的向量列表
+        返回值：与texts顺序一致的向量列表
+        """
+        self.check_digest(model, digest)
+        keys = [self.make_key(digest, text) for text in texts]
+        vectors = [None] * len(texts)
+        now = time.time()
+        with self.lock:
+            for i, key in enumerate(keys):
+                row = self.db.execute("SELECT vector FROM entries WHERE key = ?", (key,)).fetchone()
+                if row:
+                    vectors[i] = array('f', row[0]).tolist()
+            hit_keys = [(now, key) for key, vector in zip(keys, vectors) if vector is not None]
+            self.db.executemany("UPDATE entries SET last_used = ? WHERE key = ?", hit_keys)
+            self.db.commit()
+
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if not missing:
+            return vectors
+
+        # 同一批中规范化后相同的文本只请求一次
+        unique = {}
+        for i in missing:
+            unique.setdefault(keys[i], texts[i])
+        new_vectors = dict(zip(unique, embed_fn(list(unique.values()))))
+        for i in missing:
+            vectors[i] = list(new_vectors[keys[i]])
+
+        with self.lock:
+            rows = []
+            for key, vector in new_vectors.items():
+                blob = array('f', vector).tobytes()
+                rows.append((key, model, digest, blob, len(blob), now))
+            self.db.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.evict()
+            self.db.commit()
+        return vectors
+
+    def evict(self):
+        # 总大小超过上限时，按最近使用时间从旧到新删除条目（调用方需持有锁）
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self.db.execute("SELECT key, size FROM entries ORDER BY last_used").fetchall():
+            if total <= self.max_bytes:
+                break
+            self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+
+    def stats(self):
+        # 返回 (条目数, 占用字节数)
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+
+    def clear(self):
+        # 清空全部缓存条目并重置计数
+        with self.lock:
+            self.db.execute("DELETE FROM entries")
+            self.db.commit()
+            self.db.execute("VACUUM")
+        self.hits = self.misses = 0
+# 这个类让重复出现的文本（重新索引的文件、重复的查询、通用的样板片段）不必再次请求服务器。
+# 缓存键包含模型digest，因此换用不同版本的模型时旧向量不会被误用。
+
+
+class ResponseCache:
+    """
+    确定性请求的回答缓存
+
+    只有固定seed且temperature为0的请求才会被缓存，此时同样的输入必然得到同样的输出。
+    缓存键由模型digest、实际发送的提示词、options和context共同决定；
+    回答按流式片段保存，命中时可以按原来的片段顺序回放。
+    数据保存在SQLite中，按最近使用时间(LRU)淘汰，总大小不超过设定的上限。
+    """
+
+    def __init__(self, path=None, max_bytes=64 * 1024 * 1024):
+        self.path = path or os.path.join(APP_DATA_DIR, 'response_cache.sqlite3')
+        # 缓存大小上限（字节）
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries ("
+                        "key TEXT PRIMARY KEY, parts TEXT, final TEXT, size INTEGER, last_used REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries(last_used)")
+        self.db.commit()
+
+    @staticmethod
+    def is_deterministic(options):
+        # 只有固定随机种子且温度为0的请求才是确定性的
+        return bool(options) and options.get('seed') is not None and options.get('temperature') == 0
+
+    @staticmethod
+    def make_key(digest, payload):
+        # 用模型digest和请求中影响输出的字段计算缓存键（stream字段不影响输出，不参与计算）
+        material = {'digest': digest}
+        for field in ('prompt', 'system', 'options', 'context', 'format', 'images', 'think'):
+            if field in payload:
+                material[field] = payload[field]
+        return hashlib.sha256(json.dumps(material, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        # 查询缓存，命中时返回 (片段列表, 最后一条响应数据)，并更新最近使用时间
+        with self.lock:
+            row = self.db.execute("SELECT parts, final FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.db.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.db.commit()
+            self.hits += 1
+            return json.loads(row[0]), json.loads(row[1])
+
+    def put(self, key, parts, final):
+        # 保存一次完整的回答，并在超过上限时淘汰最久未使用的条目
+        parts_text = json.dumps(parts, ensure_ascii=False)
+        final_text = json.dumps(final, ensure_ascii=False)
+        size = len(parts_text.encode('utf-8')) + len(final_text.encode('utf-8'))
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                            (key, parts_text, final_text, size, time.time()))
+            total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total > self.max_bytes:
+                for old_key, old_size in self.db.execute("SELECT key, size FROM entries ORDER BY last_used").fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    self.db.execute("DELETE FROM entries WHERE key = ?", (old_key,))
+                    total -= old_size
+            self.db.commit()
+
+    def clear(self):
+        # 清空全部缓存条目并重置计数
+        with self.lock:
+            self.db.execute("DELETE FROM entries")
+            self.db.commit()
+            self.db.execute("VACUUM")
+        self.hits = self.misses = 0
+# 常用的固定提示词在确定性设置下每次都会得到同样的回答，缓存命中后无需再占用服务器GPU。
+
+
+class HostPool:
+    """
+    多个Ollama服务端组成的主机池
+
+    功能：
+    - 后台线程定期通过/api/version探测每台主机，记录响应延迟
+    - 同时读取/api/ps（已加载模型数）和/api/tags（可用模型），作为负载和路由依据
+    - 对话请求发送到拥有所选模型、且负载最低的健康主机
+    - 熔断器：连续失败达到阈值后主机进入“熔断”状态，不再接收请求，直到后台探测成功才恢复
+    """
+
+    # 连续失败多少次后熔断
+    FAILURE_THRESHOLD = 2
+    # 探测间隔（秒）和单次探测超时（秒）
+    PROBE_INTERVAL = 10
+    PROBE_TIMEOUT = 3
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(APP_DATA_DIR, 'hosts.json')
+        config = load_json_file(self.path, {})
+        # 是否启用主机池，关闭时仍使用界面上的IP地址和端口
+        self.enabled = config.get('enabled', False)
+        self.lock = threading.Lock()
+        # 主机地址 -> 状态字典
+        self.hosts = {}
+        self.set_hosts(config.get('hosts', []))
+        self.stop_event = threading.Event()
+        self.probe_thread = None
+
+    @staticmethod
+    def new_state():
+        # 单台主机的初始状态：未探测前视为不可用
+        return {'healthy': False, 'failures': 0, 'latency': None, 'loaded': 0,
+                'models': set(), 'in_flight': 0, 'checked_at': None, 'error': ''}
+
+    def set_hosts(self, hosts):
+        # 更新主机列表，保留已有主机的状态
+        with self.lock:
+            self.hosts = {host: self.hosts.get(host) or self.new_state() for host in hosts}
+
+    def save(self):
+        save_json_file(self.path, {'enabled': self.enabled, 'hosts': list(self.hosts)})
+
+    def start(self):
+        # 启动后台探测线程（重复调用不会创建多个线程）
+        if self.probe_thread and self.probe_thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.probe_thread = threading.Thread(target=self.probe_loop, daemon=True)
+        self.probe_thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def probe_loop(self):
+        # 按固定间隔探测全部主机，直到stop被调用
+        while not self.stop_event.is_set():
+            self.probe_all()
+            self.stop_event.wait(self.PROBE_INTERVAL)
+
+    def probe_all(self):
+        # 并发探测所有主机，避免一台主机超时拖慢其他主机的状态更新
+        hosts = list(self.hosts)
+        if hosts:
+            with ThreadPoolExecutor(max_workers=min(8, len(hosts))) as pool:
+                list(pool.map(self.probe, hosts))
+
+    def probe(self, host):
+        # 探测单台主机：/api/version用于健康检查和延迟，/api/ps和/api/tags用于负载和路由
+        try:
+            start = time.perf_counter()
+            api.get(f"{host}/api/version", timeout=self.PROBE_TIMEOUT).raise_for_status()
+            latency = time.perf_counter() - start
+            loaded = len(api.get(f"{host}/api/ps", timeout=self.PROBE_TIMEOUT).json().get('models', []))
+            models = {m['name'] for m in api.get(f"{host}/api/tags", timeout=self.PROBE_TIMEOUT).json().get('models', [])}
+        except Exception as e:
+            self.record_failure(host, str(e))
+            return
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None:
+                return
+            # 探测成功即关闭熔断器
+            state.update(healthy=True, failures=0, latency=latency, loaded=loaded,
+                         models=models, checked_at=time.time(), error='')
+
+    def record_failure(self, host, error=''):
+        # 记录一次失败，连续失败达到阈值时熔断
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None:
+                return
+            state['failures'] += 1
+            state['error'] = error
+            state['checked_at'] = time.time()
+            if state['failures'] >= self.FAILURE_THRESHOLD:
+                state['healthy'] = False
+
+    def acquire(self, model):
+        """
+        为请求选择一台主机并增加其进行中的请求数
+
+        选择规则：健康且拥有该模型的主机中，按 (本客户端进行中的请求数 + 已加载模型数, 延迟) 取最小值。
+        没有可用主机时抛出异常。
+        """
+        names = {model, f"{model}:latest"}
+        with self.lock:
+            candidates = [(state['in_flight'] + state['loaded'], state['latency'] or 0, host)
+                          for host, state in self.hosts.items()
+                          if state['healthy'] and state['models'] & names]
+            if not candidates:
+                raise Exception(f"主机池中没有可用且包含模型 {model} 的主机")
+            host = min(candidates)[2]
+            self.hosts[host]['in_flight'] += 1
+            return host
+
+    def release(self, host):
+        # 请求结束后减少进行中的请求数
+        with self.lock:
+            if host in self.hosts:
+                self.hosts[host]['in_flight'] = max(0, self.hosts[host]['in_flight'] - 1)
+
+    def snapshot(self):
+        # 返回主机状态的副本，供界面显示
+        with self.lock:
+            return {host: dict(state, models=set(state['models'])) for host, state in self.hosts.items()}
+# 主机池让对话请求不再依赖单台服务器：宕机或过载的主机会被熔断并自动绕开，恢复后由后台探测重新加入。
+
+
+class EventLoopMonitor:
+    """
+    Tk事件循环延迟监测器（诊断模式）
+
+    功能：
+    - 通过root.after定时心跳，测量实际触发时间与预期时间的差值，统计事件循环延迟的分位数
+    - 后台看门狗线程发现主线程超过阈值仍未心跳时，抓取主线程当时的调用栈
+    - 根据调用栈中最外层的OllamaGUI方法判断卡顿来源（如send_message、list_models、pull_model）
+    - 可选地用cProfile和tracemalloc记录一段时间的性能和内存分配数据并写入文件
+    """
+
+    # 心跳间隔（毫秒）和判定为卡顿的阈值（秒）
+    INTERVAL_MS = 50
+    STALL_THRESHOLD = 0.2
+
+    def __init__(self, root, origin_names=()):
+        self.root = root
+        # 用于判断卡顿来源的方法名集合
+        self.origin_names = set(origin_names)
+        self.running = False
+        # 待执行的心跳after编号，以及每次开启时递增的代数（旧的看门狗线程发现代数变化后退出）
+        self.tick_id = None
+        self.generation = 0
+        # 最近的延迟样本（秒）和最近的卡顿记录
+        self.lag_samples = deque(maxlen=2000)
+        self.stalls = deque(maxlen=200)
+        self.lock = threading.Lock()
+        self.main_thread_id = threading.main_thread().ident
+        self.last_tick = time.perf_counter()
+        self.expected = self.last_tick
+        self.current_stall = None
+        self.profiler = None
+        self.profile_dir = os.path.join(APP_DATA_DIR, 'profiles')
+
+    def start(self):
+        # 开启诊断模式：启动心跳和看门狗线程
+        if self.running:
+            return
+        self.running = True
+        self.generation += 1
+        self.last_tick = self.expected = time.perf_counter()
+        self.tick_id = self.root.after(self.INTERVAL_MS, self.tick)
+        threading.Thread(target=self.watchdog, args=(self.generation,), daemon=True).start()
+
+    def stop(self):
+        # 关闭诊断模式：取消待执行的心跳，看门狗线程在下一次循环时退出
+        # 关闭后立即重新开启也不会出现两条心跳链和两个看门狗线程
+        self.running = False
+        self.generation += 1
+        if self.tick_id is not None:
+            self.root.after_cancel(self.tick_id)
+            self.tick_id = None
+
+    def tick(self):
+        # 心跳回调（主线程）：记录本次延迟，如有进行中的卡顿则结束并保存记录
+        if not self.running:
+            return
+        now = time.perf_counter()
+        self.lag_samples.append(max(0.0, now - self.expected))
+        with self.lock:
+            stall = self.current_stall
+            self.current_stall = None
+            if stall:
+                stall['duration'] = now - stall['start']
+                self.stalls.append(stall)
+                logger.warning("event_loop_stall", extra={'fields': {
+                    'origin': stall['origin'], 'duration_ms': round(stall['duration'] * 1000, 1)}})
+            self.last_tick = now
+        self.expected = now + self.INTERVAL_MS / 1000
+        self.tick_id = self.root.after(self.INTERVAL_MS, self.tick)
+
+    def watchdog(self, generation):
+        # 看门狗线程：主线程超过阈值未心跳时抓取一次调用栈，监测器被关闭或重新开启后退出
+        while self.running and generation == self.generation:
+            time.sleep(self.STALL_THRESHOLD / 2)
+            with self.lock:
+                blocked = time.perf_counter() - self.last_tick
+                if blocked < self.STALL_THRESHOLD or self.current_stall is not None:
+                    continue
+                frame = sys._current_frames().get(self.main_thread_id)
+                if frame is None:
+                    continue
+                stack = traceback.extract_stack(frame)
+                self.current_stall = {'start': self.last_tick, 'wall_time': time.time() - blocked,
+                                      'origin': self.find_origin(stack),
+                                      'stack': ''.join(traceback.format_list(stack))}
+
+    def find_origin(self, stack):
+        # 从外向内查找第一个属于已知来源的方法名，找不到时使用最内层的函数名
+        for frame_summary in stack:
+            if frame_summary.name in self.origin_names:
+                return frame_summary.name
+        return stack[-1].name if stack else '未知'
+
+    def lag_percentiles(self):
+        # 返回事件循环延迟的p50/p95/p99和最大值（毫秒）
+        samples = sorted(self.lag_samples)
+        if not samples:
+            return None
+        def pick(p):
+            return samples[min(len(samples) - 1, int(len(samples) * p))] * 1000
+        return {'p50': pick(0.5), 'p95': pick(0.95), 'p99': pick(0.99), 'max': samples[-1] * 1000}
+
+    def worst_stalls(self, limit=20):
+        # 按时长从大到小返回最近的卡顿记录
+        with self.lock:
+            return sorted(self.stalls, key=lambda stall: stall['duration'], reverse=True)[:limit]
+
+    def start_profiling(self):
+        # 开始记录主线程的cProfile数据和tracemalloc内存分配数据
+        self.profiler = cProfile.Profile()
+        tracemalloc.start(25)
+        self.profiler.enable()
+
+    def stop_profiling(self):
+        # 停止记录并把结果写入文件，返回 (cProfile统计文件, 内存分配摘要文件)；没有进行中的分析时返回None
+        if self.profiler is None:
+            return None
+        self.profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        os.makedirs(self.profile_dir, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime())
+        prof_path = os.path.join(self.profile_dir, f"session-{stamp}.prof")
+        mem_path = os.path.join(self.profile_dir, f"session-{stamp}-memory.txt")
+        self.profiler.dump_stats(prof_path)
+        with open(mem_path, 'w', encoding='utf-8') as f:
+            stats_stream = io.StringIO()
+            pstats.Stats(self.profiler, stream=stats_stream).sort_stats('cumulative').print_stats(40)
+            f.write("=== cProfile（按累计耗时排序前40项） ===\n")
+            f.write(stats_stream.getvalue())
+            f.write("\n=== tracemalloc（按分配大小排序前30项） ===\n")
+            for stat in snapshot.statistics('lineno')[:30]:
+                f.write(f"{stat}\n")
+        self.profiler = None
+        return prof_path, mem_path
+# 诊断模式默认关闭，开启后的开销只有每50毫秒一次心跳和一个轻量看门狗线程。
+# “界面卡住”时可以直接看到是哪一个操作阻塞了事件循环、阻塞了多久以及当时的调用栈。
+
+
+class LoadTester:
+    """
+    并发负载测试：模拟N个同时对话的会话，评估主机容量和OLLAMA_NUM_PARALLEL设置
+
+    - 每个会话按顺序发送若干请求，请求之间等待“思考时间”，模拟真实用户
+    - 每个请求记录首token时间（TTFT）、生成速度（tokens/s）和是否出错
+    - 可以依次测试多个并发级别，找出总吞吐量不再明显增长的饱和拐点
+    - 测试结果保存为JSON报告，便于在不同主机之间比较
+    """
+
+    # 并发翻倍后总吞吐量提升低于该比例时，认为上一个并发级别就是饱和拐点
+    KNEE_GAIN = 0.10
+    # 某个并发级别的错误率超过该值时停止继续增加并发
+    MAX_ERROR_RATE = 0.5
+    # 请求超时（连接超时, 两次收到数据之间的最长等待秒数），卡住的连接不会让整轮测试无法结束
+    REQUEST_TIMEOUT = (10, 300)
+    # 构造提示词使用的常见英文单词，每个单词大约对应1个token
+    FILLER_WORDS = ('the quick brown fox jumps over the lazy dog while a small bird sings in the old '
+                    'green tree near the river and people walk along the road to the market').split()
+
+    def __init__(self, base_url, model, prompt_tokens=256, answer_tokens=128, think_time=0.0,
+                 requests_per_session=3, report_dir=None):
+        self.base_url = base_url
+        self.model = model
+        self.prompt_tokens = prompt_tokens
+        self.answer_tokens = answer_tokens
+        self.think_time = think_time
+        self.requests_per_session = requests_per_session
+        self.report_dir = report_dir or os.path.join(APP_DATA_DIR, 'loadtest')
+        # 设置后正在进行的测试会在当前请求结束后停止
+        self.cancel = threading.Event()
+        # 负载测试专用的HTTP会话，由run_level按并发数创建，不与界面的其他请求共用连接池
+        self.session = None
+
+    def build_prompt(self, session, index):
+        # 构造指定长度的提示词，开头包含会话和请求编号，避免服务器复用其他请求的提示词缓存
+        words = [self.FILLER_WORDS[i % len(self.FILLER_WORDS)] for i in range(self.prompt_tokens)]
+        return (f"Session {session} request {index} at {time.time():.6f}. " + ' '.join(words) +
+                "\nContinue the story above in as much detail as possible.")
+
+    def run_request(self, session, index):
+        # 发送一个流式生成请求并记录耗时数据
+        payload = {"model": self.model, "prompt": self.build_prompt(session, index), "stream": True,
+                   "options": {"num_predict": self.answer_tokens}}
+        started = time.perf_counter()
+        result = {'ttft': None, 'elapsed': 0.0, 'eval_count': 0, 'rate': 0.0, 'error': None}
+        try:
+            response = self.session.post(f"{self.base_url}/api/generate", json=payload, stream=True,
+                                         timeout=self.REQUEST_TIMEOUT)
+            response.raise_for_status()
+            final = {}
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                data = json.loads(line.decode('utf-8'))
+                if data.get('error'):
+                    raise Exception(data['error'])
+                if result['ttft'] is None and data.get('response'):
+                    result['ttft'] = time.perf_counter() - started
+                if data.get('done'):
+                    final = data
+            result['elapsed'] = time.perf_counter() - started
+            result['eval_count'] = final.get('eval_count', 0)
+            # 单个流的生成速度优先使用服务器统计的生成耗时，缺失时用首token之后的客户端耗时估算
+            eval_seconds = final.get('eval_duration', 0) / 1e9
+            if not eval_seconds and result['ttft'] is not None:
+                eval_seconds = result['elapsed'] - result['ttft']
+            result['rate'] = result['eval_count'] / eval_seconds if eval_seconds else 0.0
+        except Exception as e:
+            result['elapsed'] = time.perf_counter() - started
+            result['error'] = str(e)
+        return result
+
+    def run_level(self, concurrency, progress=None):
+        """
+        以指定并发数运行一轮测试
+
+        参数：progress为进度回调，参数为 (已完成请求数, 总请求数)
+        返回值：该并发级别的统计结果
+        """
+        results = []
+        lock = threading.Lock()
+        total = concurrency * self.requests_per_session
+
+        def session(session_index):
+            for index in range(self.requests_per_session):
+                if self.cancel.is_set():
+                    return
+                result = self.run_request(session_index, index)
+                with lock:
+                    results.append(result)
+                    done = len(results)
+                if progress:
+                    progress(done, total)
+                if self.think_time and index < self.requests_per_session - 1:
+                    self.cancel.wait(self.think_time)
+
+        # 连接池大小与并发数一致，否则请求会在客户端排队等待连接，测到的是连接池而不是服务器的延迟
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        started = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                list(pool.map(session, range(concurrency)))
+        finally:
+            self.session.close()
+        return self.summarize(concurrency, results, time.perf_counter() - started)
+
+    @staticmethod
+    def summarize(concurrency, results, wall_seconds):
+        # 汇总一个并发级别的TTFT分位数、单流和总吞吐量以及错误率
+        succeeded = [result for result in results if not result['error']]
+        ttfts = sorted(result['ttft'] * 1000 for result in succeeded if result['ttft'] is not None)
+        rates = sorted(result['rate'] for result in succeeded if result['rate'])
+
+        def pick(samples, p):
+            return round(samples[min(len(samples) - 1, int(len(samples) * p))], 1) if samples else None
+
+        return {
+            'concurrency': concurrency,
+            'requests': len(results),
+            'errors': len(results) - len(succeeded),
+            'error_rate': round((len(results) - len(succeeded)) / len(results), 3) if results else 0.0,
+            'ttft_p50_ms': pick(ttfts, 0.5),
+            'ttft_p95_ms': pick(ttfts, 0.95),
+            'ttft_p99_ms': pick(ttfts, 0.99),
+            'stream_tps_p50': pick(rates, 0.5),
+            'stream_tps_min': round(rates[0], 1) if rates else None,
+            'aggregate_tps': round(sum(result['eval_count'] for result in succeeded) / wall_seconds, 1)
+            if wall_seconds else 0.0,
+            'wall_seconds': round(wall_seconds, 2),
+            'sample_errors': sorted({result['error'] for result in results if result['error']})[:3],
+        }
+
+    def sweep(self, levels, on_level=None, progress=None):
+        """
+        依次测试多个并发级别
+
+        错误率过高或被取消时提前结束。参数on_level在每个级别完成后以该级别的统计结果调用。
+        返回值：各并发级别的统计结果列表
+        """
+        summaries = []
+        for concurrency in levels:
+            if self.cancel.is_set():
+                break
+            summary = self.run_level(concurrency, progress)
+            summaries.append(summary)
+            if on_level:
+                on_level(summary)
+            if summary['error_rate'] > self.MAX_ERROR_RATE:
+                break
+        return summaries
+
+    @classmethod
+    def find_knee(cls, summaries):
+        """
+        查找饱和拐点
+
+        返回值：(拐点并发数, 是否已饱和)；总吞吐量在测试范围内持续增长时返回最后一个级别和False
+        """
+        for previous, current in zip(summaries, summaries[1:]):
+            if not previous['aggregate_tps']:
+                continue
+            gain = (current['aggregate_tps'] - previous['aggregate_tps']) / previous['aggregate_tps']
+            if gain < cls.KNEE_GAIN:
+                return previous['concurrency'], True
+        return (summaries[-1]['concurrency'] if summaries else None), False
+
+    @staticmethod
+    def format_summary(summary):
+        # 将一个并发级别的统计结果格式化为一行文本
+        def show(value, unit=''):
+            return '-' if value is None else f"{value}{unit}"
+        return (f"并发 {summary['concurrency']:>3}: TTFT p50/p95/p99 {show(summary['ttft_p50_ms'])}/"
+                f"{show(summary['ttft_p95_ms'])}/{show(summary['ttft_p99_ms'])}ms | "
+                f"单流 {show(summary['stream_tps_p50'])} tok/s | 总计 {summary['aggregate_tps']} tok/s | "
+                f"错误率 {summary['error_rate'] * 100:.1f}%")
+
+    def write_report(self, summaries):
+        # 将测试参数、各级别结果和饱和拐点写入JSON报告，返回报告路径
+        knee, saturated = self.find_knee(summaries)
+        host = urlsplit(self.base_url).netloc.replace(':', '_')
+        model = re.sub(r'[^\w.-]', '_', self.model)
+        path = os.path.join(self.report_dir, f"{host}_{model}_{time.strftime('%Y%m%d_%H%M%S')}.json")
+        save_json_file(path, {
+            'host': self.base_url,
+            'model': self.model,
+            'time': time.strftime("%Y-%m-%d %H:%M:%S"),
+            'settings': {'prompt_tokens': self.prompt_tokens, 'answer_tokens': self.answer_tokens,
+                         'think_time': self.think_time, 'requests_per_session': self.requests_per_session},
+            'levels': summaries,
+            'knee_concurrency': knee,
+            'saturated': saturated,
+        })
+        return path
+# 负载测试直接调用/api/generate，不经过聊天队列、回答缓存和主机池，测得的是目标主机本身的能力；
+# 报告文件名包含主机、模型和时间，同一组参数在不同主机上的结果可以直接对比。
+
+
+class MarkdownStreamRenderer:
+    """
+    流式Markdown渲染器
+
+    模型的回答是带有标题、强调、列表、表格和代码块的Markdown文本。
+    渲染器逐行处理：已经完整的行按Markdown格式用Text标签渲染后不再改动，
+    最后一行未完成的内容（tail）以预览样式显示，新片段直接追加到末尾，
+    只有行的类型发生变化（标题的#、代码块围栏或表格的|前缀输入完整）时才删除并按新样式重新插入。
+    因此每个片段的处理量只与片段本身的长度有关，与当前行和整个回答的长度无关，长回答结束时也无需整体重绘。
+    """
+
+    # 行内格式：`代码`、**粗体**、*斜体* / _斜体_
+    INLINE_PATTERN = re.compile(r'(`[^`]+`|\*\*[^*]+\*\*|__[^_]+__|\*[^*\s][^*]*\*|_[^_\s][^_]*_)')
+    HEADING_PATTERN = re.compile(r'^(#{1,6})\s+(.*)$')
+    HEADING_PREFIX_PATTERN = re.compile(r'^(#{1,6})\s')
+    LIST_PATTERN = re.compile(r'^(\s*)([-*+]|\d+[.)])\s+(.*)$')
+
+    def __init__(self, text_widget, mark):
+        self.text = text_widget
+        # 回答末尾的插入位置标记（右侧重力）
+        self.mark = mark
+        # 未完成行的起始位置标记（左侧重力），位于mark之前
+        self.tail_mark = f"{mark}_tail"
+        self.text.mark_set(self.tail_mark, mark)
+        self.text.mark_gravity(self.tail_mark, 'left')
+        self.tail = ''
+        # 未完成行当前使用的预览样式
+        self.tail_style = ()
+        self.in_code_block = False
+        self.finished = False
+        # 回答第一个片段的起始位置，撤回回答时从这里删除
+        self.start_mark = f"{mark}_start"
+        self.started = False
+
+    @staticmethod
+    def configure_tags(text_widget, base_font):
+        # 在文本控件上配置Markdown渲染使用的标签样式
+        family, size = base_font[0], base_font[1]
+        text_widget.tag_configure('md_h1', font=(family, size + 6, 'bold'))
+        text_widget.tag_configure('md_h2', font=(family, size + 4, 'bold'))
+        text_widget.tag_configure('md_h3', font=(family, size + 2, 'bold'))
+        text_widget.tag_configure('md_bold', font=(family, size, 'bold'))
+        text_widget.tag_configure('md_italic', font=(family, size, 'italic'))
+        text_widget.tag_configure('md_inline_code', font=('Consolas', size - 2), background='#eeeeee')
+        text_widget.tag_configure('md_code', font=('Consolas', size - 2), background='#f4f4f4')
+        text_widget.tag_configure('md_code_fence', font=('Consolas', size - 4), foreground='#888888',
+                                  background='#f4f4f4')
+        text_widget.tag_configure('md_table', font=('Consolas', size - 2))
+        text_widget.tag_configure('md_thinking', font=(family, size - 4), foreground='#888888')
+        text_widget.tag_configure('md_thinking_header', font=(family, size - 4, 'bold'), foreground='#6a6a9a')
+
+    def feed(self, chunk):
+        # 处理新收到的片段：渲染新完成的行，并重新插入未完成的行
+        self.text.config(state='normal')
+        if not self.started:
+            self.text.mark_set(self.start_mark, self.tail_mark)
+            self.text.mark_gravity(self.start_mark, 'left')
+            self.started = True
+        if '\n' not in chunk:
+            # 行还没有结束：样式不变时只追加新片段，否则按新样式重新插入整行
+            self.tail += chunk
+            style = self.tail_tags()
+            if style == self.tail_style:
+                self.text.insert(self.mark, chunk, style)
+            else:
+                self.text.delete(self.tail_mark, self.mark)
+                self.text.insert(self.mark, self.tail, style)
+                self.tail_style = style
+            self.text.config(state='disabled')
+            return
+        self.text.delete(self.tail_mark, self.mark)
+        lines = (self.tail + chunk).split('\n')
+        self.tail = lines.pop()
+        for line in lines:
+            self.render_line(line)
+            self.text.insert(self.mark, '\n', self.line_tags())
+        # 把未完成行的起点移动到当前末尾，再以预览样式插入未完成的内容
+        self.text.mark_set(self.tail_mark, self.mark)
+        self.text.mark_gravity(self.tail_mark, 'left')
+        self.tail_style = self.tail_tags()
+        self.text.insert(self.mark, self.tail, self.tail_style)
+        self.text.config(state='disabled')
+
+    def insert_plain(self, text, tags=()):
+        # 在未完成行之前插入不参与Markdown解析的文本（如提示信息），未完成行保持在最后
+        self.text.config(state='normal')
+        self.text.delete(self.tail_mark, self.mark)
+        self.text.insert(self.mark, text, tags)
+        self.text.mark_set(self.tail_mark, self.mark)
+        self.text.mark_gravity(self.tail_mark, 'left')
+        self.text.insert(self.mark, self.tail, self.tail_style)
+        self.text.config(state='disabled')
+
+    def finish(self):
+        # 回答结束时把最后一行按完整行渲染
+        if self.finished:
+            return
+        self.text.config(state='normal')
+        self.text.delete(self.tail_mark, self.mark)
+        if self.tail:
+            self.render_line(self.tail)
+        self.tail = ''
+        self.text.mark_unset(self.tail_mark)
+        self.text.config(state='disabled')
+        self.finished = True
+
+    def reset(self, section=None):
+        # 删除已经渲染的回答，恢复到还没有收到片段的状态
+        # 回答开始后才插入的思考过程标题位于回答中间，只删除标题之后的部分
+        if not self.started:
+            return
+        start = self.start_mark
+        if section and self.text.compare(section['end'], '>', start):
+            start = f"{section['end']} +1c"
+        self.text.config(state='normal')
+        self.text.delete(start, self.mark)
+        self.text.mark_set(self.tail_mark, self.mark)
+        self.text.mark_gravity(self.tail_mark, 'left')
+        self.text.config(state='disabled')
+        self.tail = ''
+        self.tail_style = ()
+        self.in_code_block = False
+        self.started = False
+
+    def line_tags(self):
+        # 代码块中的内容（包括换行和未完成行）使用代码样式
+        return ('md_code',) if self.in_code_block else ()
+
+    def tail_tags(self):
+        # 未完成行的预览样式：只根据行首判断标题、代码块围栏和表格，行内格式等行完成后再解析
+        stripped = self.tail.lstrip()
+        if stripped.startswith('```'):
+            return ('md_code_fence',)
+        if self.in_code_block:
+            return ('md_code',)
+        heading = self.HEADING_PREFIX_PATTERN.match(stripped)
+        if heading:
+            return (f'md_h{min(3, len(heading.group(1)))}',)
+        if stripped.startswith('|'):
+            return ('md_table',)
+        return ()
+
+    def render_line(self, line):
+        # 渲染一行完整的Markdown文本
+        stripped = line.strip()
+        if stripped.startswith('```'):
+            # 代码块围栏：切换代码块状态，围栏行只显示语言名称
+            self.in_code_block = not self.in_code_block
+            self.text.insert(self.mark, stripped[3:] or ' ', ('md_code_fence',))
+            return
+        if self.in_code_block:
+            self.text.insert(self.mark, line, ('md_code',))
+            return
+        heading = self.HEADING_PATTERN.match(stripped)
+        if heading:
+            level = min(3, len(heading.group(1)))
+            self.insert_inline(heading.group(2), (f'md_h{level}',))
+            return
+        if stripped.startswith('|'):
+            # 表格行使用等宽字体，保持列对齐
+            self.text.insert(self.mark, line, ('md_table',))
+            return
+        item = self.LIST_PATTERN.match(line)
+        if item:
+            indent, bullet, content = item.groups()
+            bullet = '•' if bullet in '-*+' else bullet
+            self.text.insert(self.mark, f"{indent}{bullet} ")
+            self.insert_inline(content)
+            return
+        self.insert_inline(line)
+
+    def insert_inline(self, line, base_tags=()):
+        # 处理行内的代码、粗体和斜体标记
+        for part in self.INLINE_PATTERN.split(line):
+            if not part:
+                continue
+            if part.startswith('`') and part.endswith('`') and len(part) > 2:
+                self.text.insert(self.mark, part[1:-1], base_tags + ('md_inline_code',))
+            elif (part.startswith('**') or part.startswith('__')) and len(part) > 4:
+                self.text.insert(self.mark, part[2:-2], base_tags + ('md_bold',))
+            elif part[0] in '*_' and part[-1] == part[0] and len(part) > 2:
+                self.text.insert(self.mark, part[1:-1], base_tags + ('md_italic',))
+            else:
+                self.text.insert(self.mark, part, base_tags)
+# 标题、列表、表格和代码块都以“行”为单位判断，行内格式只在所在行完成后解析一次。
+
+
+class ThinkingSplitter:
+    """
+    从流式回答中分离<think>...</think>思考内容
+
+    标签可能被拆分到多个片段中，未确定是否为标签的结尾部分会暂存到下一个片段再判断。
+    feed返回 (是否为思考内容, 文本) 列表，思考结束后回答开头的空行会被去掉。
+    qwq、deepseek-r1等模型的模板已经在提示词末尾写入<think>，回答直接从思考内容开始，
+    只在思考结束时输出单独的</think>。因此在还没有遇到任何标签时，第一个</think>之前已经输出的
+    内容要改为思考内容：此时返回 (None, 文本)，调用方撤回已经显示的回答，再把文本作为思考内容显示。
+    """
+
+    OPEN_TAG = '<think>'
+    CLOSE_TAG = '</think>'
+
+    def __init__(self):
+        self.in_thinking = False
+        # 可能是标签开头的未决文本
+        self.pending = ''
+        # 思考结束后，回答开头的换行需要去掉
+        self.strip_answer_start = False
+        # 还没有遇到任何标签，已经输出的回答可能其实是省略了<think>的思考内容
+        self.tag_seen = False
+        self.undecided = []
+
+    def feed(self, chunk):
+        # 处理一个片段，返回分离后的文本段
+        text = self.pending + chunk
+        self.pending = ''
+        segments = []
+        while text:
+            tags = (self.CLOSE_TAG,) if self.in_thinking else (self.OPEN_TAG,)
+            if not self.tag_seen:
+                tags = (self.OPEN_TAG, self.CLOSE_TAG)
+            found = [(text.find(tag), tag) for tag in tags if tag in text]
+            if found:
+                index, tag = min(found)
+                if tag == self.CLOSE_TAG and not self.in_thinking:
+                    # 没有<think>的</think>：之前的回答全部改为思考内容
+                    segments.append((None, ''.join(self.undecided) + text[:index]))
+                else:
+                    self.add(segments, text[:index])
+                    self.in_thinking = not self.in_thinking
+                self.tag_seen = True
+                self.undecided = []
+                text = text[index + len(tag):]
+                self.strip_answer_start = not self.in_thinking
+                continue
+            # 结尾可能是被拆开的标签，暂存到下一个片段
+            keep = max(next((size for size in range(min(len(tag) - 1, len(text)), 0, -1)
+                             if tag.startswith(text[-size:])), 0) for tag in tags)
+            self.add(segments, text[:len(text) - keep])
+            self.pending = text[len(text) - keep:]
+            break
+        return segments
+
+    def flush(self):
+        # 回答结束时返回暂存的文本
+        segments = []
+        self.add(segments, self.pending)
+        self.pending = ''
+        self.undecided = []
+        return segments
+
+    def add(self, segments, text):
+        if not self.in_thinking and self.strip_answer_start:
+            text = text.lstrip('\n')
+            if text:
+                self.strip_answer_start = False
+        if text:
+            segments.append((self.in_thinking, text))
+            if not self.tag_seen:
+                self.undecided.append(text)
+# 思考内容在生成线程中分离，主线程收到的事件已经区分为回答片段和思考片段，
+# 服务器通过单独的thinking字段返回思考内容时不需要经过这个类。
+
+
+class SchemaMismatch(ValueError):
+    # 流式输出已经不可能符合JSON Schema时抛出
+    pass
+
+
+class StreamingJsonValidator:
+    """
+    增量JSON Schema校验器
+
+    逐字符解析模型输出的JSON，一旦确定输出不可能再符合Schema（语法错误、类型不符、
+    出现不允许的属性、字符串不可能匹配enum、数组超过maxItems等）就立即抛出SchemaMismatch，
+    调用方可以马上中止请求，不必等到生成结束。
+
+    支持的Schema关键字：type、properties、required、additionalProperties、items、
+    enum、minItems、maxItems、minimum、maximum、minLength、maxLength。
+    """
+
+    WHITESPACE = ' \t\r\n'
+    NUMBER_CHARS = '0123456789+-.eE'
+    LITERALS = {'t': ('true', 'boolean'), 'f': ('false', 'boolean'), 'n': ('null', 'null')}
+
+    def __init__(self, schema=None):
+        self.schema = schema or {}
+        # 容器栈：每一项为 {'kind': 'object'/'array', 'schema', 'state', 'path', 'keys', 'count', 'key'}
+        self.stack = []
+        # 正在解析的标量：{'kind': 'string'/'number'/'literal', 'schema', 'path', 'raw', ...}
+        self.scalar = None
+        # 顶层值是否已经解析完成
+        self.complete = False
+        # 已接收的全部文本，结束时用于解析为对象
+        self.chunks = []
+        self.position = 0
+
+    def feed(self, text):
+        # 处理新收到的文本，输出不可能符合Schema时抛出SchemaMismatch
+        self.chunks.append(text)
+        for char in text:
+            self.position += 1
+            self.step(char)
+
+    def finish(self):
+        # 生成结束时调用：检查JSON是否完整，返回解析后的对象
+        if self.scalar and self.scalar['kind'] == 'number':
+            self.end_scalar()
+        if not self.complete:
+            raise SchemaMismatch("输出的JSON不完整")
+        return json.loads(''.join(self.chunks))
+
+    def fail(self, path, reason):
+        raise SchemaMismatch(f"{path}: {reason}（第{self.position}个字符）")
+
+    @staticmethod
+    def type_allows(schema, type_name):
+        # 判断Schema的type是否允许指定类型，integer是number的子集
+        allowed = schema.get('type')
+        if allowed is None:
+            return True
+        allowed = allowed if isinstance(allowed, list) else [allowed]
+        return type_name in allowed or (type_name == 'integer' and 'number' in allowed)
+
+    def step(self, char):
+        # 处理一个字符
+        if self.scalar:
+            kind = self.scalar['kind']
+            if kind == 'string':
+                self.step_string(char)
+                return
+            if kind == 'literal':
+                self.step_literal(char)
+                return
+            if char in self.NUMBER_CHARS:
+                self.scalar['raw'] += char
+                return
+            # 数字在遇到其他字符时结束，该字符继续由外层处理
+            self.end_scalar()
+        if char in self.WHITESPACE:
+            return
+        if self.complete:
+            self.fail('$', f"JSON结束后出现多余的字符 {char!r}")
+        if not self.stack:
+            self.start_value(char, self.schema, '$')
+            return
+        frame = self.stack[-1]
+        if frame['kind'] == 'object':
+            self.step_object(frame, char)
+        else:
+            self.step_array(frame, char)
+
+    def step_object(self, frame, char):
+        state = frame['state']
+        if state in ('key_or_end', 'key') and char == '"':
+            self.scalar = {'kind': 'string', 'role': 'key', 'schema': {}, 'path': frame['path'],
+                           'raw': '', 'escape': False}
+        elif state == 'key_or_end' and char == '}':
+            self.close_container()
+        elif state == 'colon' and char == ':':
+            frame['state'] = 'value'
+        elif state == 'value':
+            self.start_value(char, self.property_schema(frame, frame['key']), f"{frame['path']}.{frame['key']}")
+        elif state == 'comma_or_end' and char == ',':
+            frame['state'] = 'key'
+        elif state == 'comma_or_end' and char == '}':
+            self.close_container()
+        else:
+            self.fail(frame['path'], f"对象中出现意外的字符 {char!r}")
+
+    def step_array(self, frame, char):
+        state = frame['state']
+        if state == 'value_or_end' and char == ']':
+            self.close_container()
+        elif state in ('value_or_end', 'value'):
+            max_items = frame['schema'].get('maxItems')
+            if max_items is not None and frame['count'] >= max_items:
+                self.fail(frame['path'], f"数组元素超过maxItems={max_items}")
+            items = frame['schema'].get('items')
+            self.start_value(char, items if isinstance(items, dict) else {}, f"{frame['path']}[{frame['count']}]")
+        elif state == 'comma_or_end' and char == ',':
+            frame['state'] = 'value'
+        elif state == 'comma_or_end' and char == ']':
+            self.close_container()
+        else:
+            self.fail(frame['path'], f"数组中出现意外的字符 {char!r}")
+
+    def property_schema(self, frame, key):
+        # 返回对象属性对应的子Schema
+        schema = frame['schema']
+        properties = schema.get('properties', {})
+        if key in properties:
+            return properties[key]
+        additional = schema.get('additionalProperties', True)
+        return additional if isinstance(additional, dict) else {}
+
+    def start_value(self, char, schema, path):
+        # 根据值的第一个字符确定类型，类型不被Schema允许时立即失败
+        if char == '{':
+            kind, frame = 'object', {'kind': 'object', 'state': 'key_or_end', 'keys': set()}
+        elif char == '[':
+            kind, frame = 'array', {'kind': 'array', 'state': 'value_or_end', 'count': 0}
+        elif char == '"':
+            kind, frame = 'string', None
+            self.scalar = {'kind': 'string', 'role': 'value', 'schema': schema, 'path': path,
+                           'raw': '', 'escape': False}
+        elif char == '-' or char.isdigit():
+            kind, frame = 'number', None
+            self.scalar = {'kind': 'number', 'schema': schema, 'path': path, 'raw': char}
+        elif char in self.LITERALS:
+            literal, kind = self.LITERALS[char]
+            frame = None
+            self.scalar = {'kind': 'literal', 'schema': schema, 'path': path, 'raw': char, 'literal': literal}
+        else:
+            self.fail(path, f"无效的JSON值开头 {char!r}")
+        # 数字在开头无法区分整数和小数，允许integer时也先接受，结束时再检查
+        if not (self.type_allows(schema, kind) or (kind == 'number' and self.type_allows(schema, 'integer'))):
+            self.fail(path, f"类型应为 {schema.get('type')}，实际为 {kind}")
+        if frame is not None:
+            frame.update({'schema': schema, 'path': path})
+            self.stack.append(frame)
+
+    def step_string(self, char):
+        scalar = self.scalar
+        if scalar['escape']:
+            scalar['raw'] += char
+            scalar['escape'] = False
+            return
+        if char == '\\':
+            scalar['raw'] += char
+            scalar['escape'] = True
+            return
+        if char != '"':
+            scalar['raw'] += char
+            schema = scalar['schema']
+            # 不含转义字符时可以提前判断enum和maxLength
+            if '\\' not in scalar['raw']:
+                enum = schema.get('enum')
+                if enum is not None and not any(isinstance(value, str) and value.startswith(scalar['raw'])
+                                                for value in enum):
+                    self.fail(scalar['path'], f"字符串不可能匹配enum {enum}")
+                if schema.get('maxLength') is not None and len(scalar['raw']) > schema['maxLength']:
+                    self.fail(scalar['path'], f"字符串超过maxLength={schema['maxLength']}")
+            return
+        self.end_scalar()
+
+    def step_literal(self, char):
+        scalar = self.scalar
+        scalar['raw'] += char
+        if not scalar['literal'].startswith(scalar['raw']):
+            self.fail(scalar['path'], f"无效的字面量 {scalar['raw']!r}")
+        if scalar['raw'] == scalar['literal']:
+            self.end_scalar()
+
+    def end_scalar(self):
+        # 标量解析完成：检查取值约束，并推进外层容器的状态
+        scalar, self.scalar = self.scalar, None
+        schema, path = scalar['schema'], scalar['path']
+        if scalar['kind'] == 'string':
+            try:
+                value = json.loads(f'"{scalar["raw"]}"')
+            except ValueError:
+                self.fail(path, "无效的字符串转义")
+            if scalar['role'] == 'key':
+                frame = self.stack[-1]
+                allowed = frame['schema'].get('additionalProperties', True)
+                if allowed is False and value not in frame['schema'].get('properties', {}):
+                    self.fail(frame['path'], f"不允许的属性 {value!r}")
+                frame['keys'].add(value)
+                frame['key'] = value
+                frame['state'] = 'colon'
+                return
+            if schema.get('minLength') is not None and len(value) < schema['minLength']:
+                self.fail(path, f"字符串短于minLength={schema['minLength']}")
+            # 含转义字符的字符串在逐字符阶段无法判断长度，按解码后的值检查
+            if schema.get('maxLength') is not None and len(value) > schema['maxLength']:
+                self.fail(path, f"字符串超过maxLength={schema['maxLength']}")
+        elif scalar['kind'] == 'number':
+            try:
+                value = json.loads(scalar['raw'])
+            except ValueError:
+                self.fail(path, f"无效的数字 {scalar['raw']!r}")
+            if isinstance(value, float) and not self.type_allows(schema, 'number'):
+                self.fail(path, "类型应为integer，实际为小数")
+            if schema.get('minimum') is not None and value < schema['minimum']:
+                self.fail(path, f"数值小于minimum={schema['minimum']}")
+            if schema.get('maximum') is not None and value > schema['maximum']:
+                self.fail(path, f"数值大于maximum={schema['maximum']}")
+        else:
+            value = json.loads(scalar['literal'])
+        if 'enum' in schema and value not in schema['enum']:
+            self.fail(path, f"取值不在enum {schema['enum']} 中")
+        self.value_done()
+
+    def close_container(self):
+        # 对象或数组结束：检查required和minItems
+        frame = self.stack.pop()
+        schema = frame['schema']
+        if frame['kind'] == 'object':
+            missing = [key for key in schema.get('required', []) if key not in frame['keys']]
+            if missing:
+                self.fail(frame['path'], f"缺少必需属性 {missing}")
+        elif schema.get('minItems') is not None and frame['count'] < schema['minItems']:
+            self.fail(frame['path'], f"数组元素少于minItems={schema['minItems']}")
+        self.value_done()
+
+    def value_done(self):
+        # 一个值结束后推进外层容器的状态，没有外层容器时整个JSON完成
+        if not self.stack:
+            self.complete = True
+            return
+        frame = self.stack[-1]
+        if frame['kind'] == 'array':
+            frame['count'] += 1
+        frame['state'] = 'comma_or_end'
+# 校验器只保存容器栈和当前标量，处理每个字符的开销是常数；
+# 生成结束时再用json.loads解析完整文本，得到可以直接导出的对象。
+
+
+def parse_modelfile(text):
+    """
+    解析Modelfile文本，转换为/api/create使用的结构化字段
+
+    支持的指令：FROM、PARAMETER、SYSTEM、TEMPLATE、LICENSE、MESSAGE，参数值可以使用三引号跨多行。
+    以#开头的行为注释。返回值为字典，例如 {'from': 'llama3', 'parameters': {'num_ctx': 8192}}
+    """
+    result = {}
+    lines = text.splitlines()
+    index = 0
+    while index < len(lines):
+        line = lines[index].strip()
+        index += 1
+        if not line or line.startswith('#'):
+            continue
+        instruction, _, value = line.partition(' ')
+        instruction = instruction.upper()
+        value = value.strip()
+        # 三引号包裹的值可以跨越多行
+        if value.startswith('"""'):
+            value = value[3:]
+            while not value.endswith('"""') and index < len(lines):
+                value += '\n' + lines[index]
+                index += 1
+            value = value[:-3] if value.endswith('"""') else value
+        elif len(value) >= 2 and value[0] == value[-1] == '"':
+            value = value[1:-1]
+
+        if instruction == 'FROM':
+            result['from'] = value
+        elif instruction == 'PARAMETER':
+            key, _, raw = value.partition(' ')
+            raw = raw.strip().strip('"')
+            try:
+                parsed = int(raw)
+            except ValueError:
+                try:
+                    parsed = float(raw)
+                except ValueError:
+                    parsed = raw
+            parameters = result.setdefault('parameters', {})
+            # stop参数可以出现多次，合并为列表
+            if key == 'stop':
+                parameters.setdefault('stop', []).append(raw)
+            else:
+                parameters[key] = parsed
+        elif instruction in ('SYSTEM', 'TEMPLATE', 'LICENSE'):
+            result[instruction.lower()] = value
+        elif instruction == 'MESSAGE':
+            role, _, content = value.partition(' ')
+            result.setdefault('messages', []).append({'role': role, 'content': content.strip()})
+        else:
+            raise ValueError(f"不支持的Modelfile指令: {instruction}")
+    if 'from' not in result:
+        raise ValueError("Modelfile中缺少FROM指令")
+    return result
+# 新版Ollama的/api/create使用结构化字段（from、parameters、system等），旧版使用modelfile文本，
+# 创建模型时两种字段会同时发送，以兼容不同版本的服务器。
+
+
+def sha256_file(path, progress=None, chunk_size=8 * 1024 * 1024):
+    """
+    以内存映射方式计算大文件的SHA-256
+
+    文件不会被整体读入内存，每次只把一个chunk_size大小的映射窗口交给hashlib，
+    已处理的页面由操作系统按需回收。progress回调参数为 (已处理字节数, 文件总字节数)。
+    """
+    digest = hashlib.sha256()
+    size = os.path.getsize(path)
+    if size == 0:
+        return digest.hexdigest()
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        # 提示操作系统按顺序读取，便于预读和及时回收已读页面
+        if hasattr(mapped, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        view = memoryview(mapped)
+        try:
+            for offset in range(0, size, chunk_size):
+                digest.update(view[offset:offset + chunk_size])
+                if progress:
+                    progress(min(size, offset + chunk_size), size)
+        finally:
+            view.release()
+    return digest.hexdigest()
+
+
+def iter_file_chunks(path, progress=None, chunk_size=1024 * 1024):
+    # 逐块读取文件用作流式上传的请求体，内存中始终只保留一个块
+    size = os.path.getsize(path)
+    sent = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            sent += len(chunk)
+            if progress:
+                progress(sent, size)
+            yield chunk
+# 这两个函数保证导入多GB的GGUF文件时，客户端内存占用始终只有几十MB。
+
+
+class ModelStoreIndex:
+    """
+    本地Ollama模型存储索引器
+
+    功能：
+    - 读取模型目录下的manifests清单文件，建立 层(blob) → 模型 的反向索引
+    - 只对blobs目录做stat操作获取实际大小，不读取任何blob内容
+    - 统计每个模型的独占字节数和共享字节数
+    - 计算删除一组模型后实际可以回收的磁盘空间
+    - 按清单文件的修改时间增量更新，未变化的清单不会重复解析
+
+    目录结构（与Ollama服务端一致）：
+    - <models_dir>/manifests/<registry>/<namespace>/<model>/<tag>
+    - <models_dir>/blobs/sha256-<hex>
+    """
+
+    # 官方默认仓库地址，显示模型名称时会省略
+    DEFAULT_REGISTRY = 'registry.ollama.ai'
+    # 官方默认命名空间，显示模型名称时会省略
+    DEFAULT_NAMESPACE = 'library'
+
+    def __init__(self, models_dir=None):
+        # 模型目录优先使用传入参数，其次使用OLLAMA_MODELS环境变量，最后使用默认路径
+        self.models_dir = models_dir or self.default_models_dir()
+        # 清单缓存：清单文件路径 -> (mtime_ns, 文件大小, 模型名称, 层digest列表)
+        self.manifests = {}
+        # blob大小缓存：digest -> 字节数
+        self.blob_sizes = {}
+        # 反向索引：digest -> 引用该层的模型名称集合
+        self.layer_models = {}
+        # 正向索引：模型名称 -> 该模型引用的digest集合
+        self.model_layers = {}
+
+    @staticmethod
+    def default_models_dir():
+        # 返回Ollama默认的本地模型目录
+        env_dir = os.environ.get('OLLAMA_MODELS')
+        if env_dir:
+            return env_dir
+        return os.path.join(os.path.expanduser('~'), '.ollama', 'models')
+
+    def set_models_dir(self, models_dir):
+        # 切换模型目录后清空全部缓存，下次刷新时重新建立索引
+        if models_dir != self.models_dir:
+            self.models_dir = models_dir
+            self.manifests.clear()
+            self.blob_sizes.clear()
+            self.layer_models.clear()
+            self.model_layers.clear()
+
+    def manifest_model_name(self, manifest_path):
+        # 将清单文件的相对路径转换为与/api/tags一致的模型名称
+        # 例如 registry.ollama.ai/library/llama3/latest -> llama3:latest
+        rel = os.path.relpath(manifest_path, os.path.join(self.models_dir, 'manifests'))
+        parts = rel.replace(os.sep, '/').split('/')
+        if len(parts) < 4:
+            return None
+        registry, namespace, model, tag = parts[0], parts[1], '/'.join(parts[2:-1]), parts[-1]
+        if registry == self.DEFAULT_REGISTRY:
+            if namespace == self.DEFAULT_NAMESPACE:
+                return f"{model}:{tag}"
+            return f"{namespace}/{model}:{tag}"
+        return f"{registry}/{namespace}/{model}:{tag}"
+
+    def blob_path(self, digest):
+        # 根据digest计算blob文件路径，Ollama在文件名中使用'-'代替':'
+        return os.path.join(self.models_dir, 'blobs', digest.replace(':', '-'))
+
+    def refresh(self):
+        """
+        增量刷新索引
+
+        只有新增或修改时间发生变化的清单会被重新解析，已删除的清单会从索引中移除。
+        返回值：本次发生变化（新增、修改、删除）的清单数量
+        """
+        manifests_root = os.path.join(self.models_dir, 'manifests')
+        if not os.path.isdir(manifests_root):
+            raise FileNotFoundError(f"模型目录不存在: {manifests_root}")
+
+        seen = set()
+        changed = 0
+        for dirpath, _dirnames, filenames in os.walk(manifests_root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                seen.add(path)
+                cached = self.manifests.get(path)
+                # 修改时间和大小均未变化时直接复用缓存
+                if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+                    continue
+                name = self.manifest_model_name(path)
+                if not name:
+                    continue
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        manifest = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                digests = []
+                # config与各层都会占用blob，统一纳入统计
+                for layer in [manifest.get('config')] + list(manifest.get('layers', [])):
+                    if not layer or not layer.get('digest'):
+                        continue
+                    digests.append(layer['digest'])
+                    # 清单中的size仅作为blob缺失时的回退值
+                    self.blob_sizes.setdefault(layer['digest'], None)
+                    if self.blob_sizes[layer['digest']] is None:
+                        self.blob_sizes[layer['digest']] = self.stat_blob(layer['digest'], layer.get('size', 0))
+                self.manifests[path] = (st.st_mtime_ns, st.st_size, name, digests)
+                changed += 1
+
+        # 移除已被删除的清单
+        for path in list(self.manifests):
+            if path not in seen:
+                del self.manifests[path]
+                changed += 1
+
+        if changed:
+            self.rebuild_index()
+        return changed
+
+    def stat_blob(self, digest, fallback_size=0):
+        # 只通过stat获取blob的实际磁盘大小，blob不存在时使用清单中记录的大小
+        try:
+            return os.stat(self.blob_path(digest)).st_size
+        except OSError:
+            return int(fallback_size or 0)
+
+    def rebuild_index(self):
+        # 根据清单缓存重建正向和反向索引，并清理不再被引用的blob大小缓存
+        self.layer_models = {}
+        self.model_layers = {}
+        for _mtime, _size, name, digests in self.manifests.values():
+            self.model_layers.setdefault(name, set()).update(digests)
+            for digest in digests:
+                self.layer_models.setdefault(digest, set()).add(name)
+        for digest in list(self.blob_sizes):
+            if digest not in self.layer_models:
+                del self.blob_sizes[digest]
+
+    def model_usage(self, name):
+        # 统计单个模型的总字节数、独占字节数和与其他模型共享的字节数
+        total = unique = 0
+        for digest in self.model_layers.get(name, ()):
+            size = self.blob_sizes.get(digest) or 0
+            total += size
+            if len(self.layer_models.get(digest, ())) == 1:
+                unique += size
+        return {'total': total, 'unique': unique, 'shared': total - unique}
+
+    def reclaimable_bytes(self, names):
+        # 计算删除给定模型集合后实际可回收的字节数
+        # 只有全部引用者都在待删除集合中的blob才会真正被释放
+        names = set(names)
+        freed = 0
+        digests = set()
+        for name in names:
+            digests.update(self.model_layers.get(name, ()))
+        for digest in digests:
+            if self.layer_models.get(digest, set()) <= names:
+                freed += self.blob_sizes.get(digest) or 0
+        return freed
+
+    def disk_usage(self):
+        # 统计所有被引用blob的实际磁盘占用（共享层只计算一次）
+        return sum(size or 0 for size in self.blob_sizes.values())
+# 这个类实现了本地模型存储的只读索引。/api/tags返回的size按模型单独累加，共享基础层会被重复计算，
+# 通过 层 → 模型 的反向索引可以准确区分独占与共享字节，并给出删除任意模型组合时真正能释放的磁盘空间。
+
+
+class MemoryFitEstimator:
+    """
+    加载模型前的显存占用估算
+
+    发送请求之前估算模型权重和KV缓存需要的内存，并与可用显存比较：
+    - 权重大小优先使用/api/tags报告的模型文件大小，没有时按参数量和量化位数估算
+    - KV缓存 = 层数 × num_ctx × KV头数 × (K维度 + V维度) × 每个元素的字节数，层和头的信息来自/api/show
+    - 显存容量优先使用用户设置的预算；未设置时从/api/ps推断并按主机分别记录：
+      有模型只有部分放在GPU上时说明显存已满，此时所有已加载模型的size_vram之和就是显存容量
+    - 可用显存 = 显存容量 - 其他已加载模型的size_vram（要重新加载的模型本身不计入）
+    超出可用显存时给出能放下的最大num_ctx，避免服务器缓慢地把部分层卸载到CPU或加载失败。
+    """
+
+    # 常见量化类型的平均每个权重位数（包含缩放因子）
+    QUANT_BITS = {
+        'F32': 32, 'F16': 16, 'BF16': 16, 'Q8_0': 8.5, 'Q6_K': 6.56,
+        'Q5_K_M': 5.69, 'Q5_K_S': 5.54, 'Q5_1': 6.0, 'Q5_0': 5.5,
+        'Q4_K_M': 4.85, 'Q4_K_S': 4.58, 'Q4_1': 5.0, 'Q4_0': 4.5,
+        'Q3_K_L': 4.27, 'Q3_K_M': 3.91, 'Q3_K_S': 3.5, 'Q2_K': 3.35,
+    }
+    # KV缓存类型（服务器的OLLAMA_KV_CACHE_TYPE）对应的每个元素字节数
+    KV_CACHE_BYTES = {'f16': 2.0, 'q8_0': 1.0625, 'q4_0': 0.5625}
+    # 计算缓冲区等额外开销
+    OVERHEAD_BYTES = 512 * 1024 ** 2
+    # 建议的num_ctx按这个粒度向下取整，且不小于MIN_NUM_CTX
+    NUM_CTX_STEP = 1024
+    MIN_NUM_CTX = 2048
+
+    def __init__(self, path=None):
+        # 设置文件路径，默认位于应用程序数据目录
+        self.path = path or os.path.join(APP_DATA_DIR, 'memory_fit.json')
+        settings = load_json_file(self.path, {})
+        # 是否在发送前检查
+        self.enabled = settings.get('enabled', True)
+        # 用户设置的显存预算（字节），None表示从/api/ps推断
+        self.budget_bytes = settings.get('budget_bytes')
+        # 从/api/ps推断出的显存容量：服务器地址 -> 字节数（不同主机的显卡不同，不能共用）
+        learned = settings.get('learned_bytes')
+        self.learned_bytes = learned if isinstance(learned, dict) else {}
+        self.kv_cache_type = settings.get('kv_cache_type', 'f16')
+        # 用户已确认仍按原设置发送的 (模型, num_ctx)，本次运行中不再提示
+        self.accepted = set()
+
+    def save(self):
+        save_json_file(self.path, {'enabled': self.enabled, 'budget_bytes': self.budget_bytes,
+                                   'learned_bytes': self.learned_bytes, 'kv_cache_type': self.kv_cache_type})
+
+    @staticmethod
+    def parse_parameter_size(text):
+        # 将“70.6B”“135M”这样的参数量文字转换为数值
+        match = re.match(r'^\s*([\d.]+)\s*([KMBT]?)', text or '', re.IGNORECASE)
+        if not match:
+            return None
+        scale = {'': 1, 'K': 1e3, 'M': 1e6, 'B': 1e9, 'T': 1e12}[match.group(2).upper()]
+        return float(match.group(1)) * scale
+
+    @staticmethod
+    def model_shape(show):
+        # 从/api/show的结果中提取估算需要的模型结构信息，缺少的项为None
+        info = show.get('model_info') or {}
+        details = show.get('details') or {}
+        arch = info.get('general.architecture', '')
+
+        def field(name):
+            # 部分模型按层给出列表（例如每层KV头数不同），取最大值
+            value = info.get(f"{arch}.{name}")
+            return max(value) if isinstance(value, list) and value else value
+
+        heads = field('attention.head_count')
+        embedding = field('embedding_length')
+        key_dim = field('attention.key_length') or (embedding // heads if embedding and heads else None)
+        return {
+            'parameters': info.get('general.parameter_count')
+                          or MemoryFitEstimator.parse_parameter_size(details.get('parameter_size')),
+            'quantization': details.get('quantization_level', ''),
+            'layers': field('block_count'),
+            'kv_heads': field('attention.head_count_kv') or heads,
+            'key_dim': key_dim,
+            'value_dim': field('attention.value_length') or key_dim,
+            'context_length': field('context_length'),
+        }
+
+    def estimate(self, show, num_ctx, weights_bytes=None):
+        # 估算以num_ctx加载模型需要的内存（字节），返回各部分和总计
+        shape = self.model_shape(show)
+        if not weights_bytes and shape['parameters']:
+            bits = self.QUANT_BITS.get(shape['quantization'].upper(), 16)
+            weights_bytes = shape['parameters'] * bits / 8
+        kv_per_token = 0
+        if shape['layers'] and shape['kv_heads'] and shape['key_dim']:
+            kv_per_token = (shape['layers'] * shape['kv_heads'] * (shape['key_dim'] + shape['value_dim'])
+                            * self.KV_CACHE_BYTES.get(self.kv_cache_type, 2.0))
+        weights_bytes = weights_bytes or 0
+        kv_bytes = kv_per_token * num_ctx
+        return {'shape': shape, 'num_ctx': num_ctx, 'weights': weights_bytes, 'kv_per_token': kv_per_token,
+                'kv': kv_bytes, 'total': weights_bytes + kv_bytes + self.OVERHEAD_BYTES}
+
+    def available(self, host, running_models, model=None):
+        """
+        返回加载model时主机上的可用显存（字节）和来源说明
+
+        显存容量减去其他已加载模型占用的显存；model已经加载（例如以不同的num_ctx重新加载）时它自己的占用会被释放，不扣除。
+        没有设置预算且无法从/api/ps推断时返回 (None, '')。
+        """
+        if any(0 < item.get('size_vram', 0) < item.get('size', 0) for item in running_models):
+            capacity = sum(item.get('size_vram', 0) for item in running_models)
+            if capacity > self.learned_bytes.get(host, 0):
+                self.learned_bytes[host] = capacity
+                self.save()
+        if self.budget_bytes:
+            capacity, source = self.budget_bytes, '设置的预算'
+        elif self.learned_bytes.get(host):
+            capacity, source = self.learned_bytes[host], '根据/api/ps推断'
+        else:
+            return None, ''
+        resident = sum(item.get('size_vram', 0) for item in running_models
+                       if model not in (item.get('name'), item.get('model')))
+        if resident:
+            source += f"，已减去其他已加载模型占用的 {format_bytes(resident)}"
+        return max(0, capacity - resident), source
+
+    def largest_fit(self, estimate, available):
+        # 返回在可用显存内能使用的最大num_ctx（不超过模型最大上下文），权重本身放不下时返回None
+        if not estimate['kv_per_token']:
+            return None
+        room = available - estimate['weights'] - self.OVERHEAD_BYTES
+        num_ctx = int(room / estimate['kv_per_token']) // self.NUM_CTX_STEP * self.NUM_CTX_STEP
+        if estimate['shape']['context_length']:
+            num_ctx = min(num_ctx, estimate['shape']['context_length'])
+        return num_ctx if num_ctx >= self.MIN_NUM_CTX else None
+# 估算只用于在发送前提醒：实际占用还与服务器版本、并行数（OLLAMA_NUM_PARALLEL）和GPU数量有关，
+# 因此只有超出可用显存时才询问用户，用户确认按原设置发送后本次运行中不再重复提示。
+
+
+class DocumentAttachment:
+    """
+    大文档附件的流式读取、token估算和按上下文长度分段
+
+    - 文件按块从磁盘读取并增量解码，不会整体放入内存或输入框
+    - token数按字符估算：中日韩字符约1个token，其余字符约4个字符1个token
+    - 分段时优先在换行处切分，单行过长时按字符数强制切分
+    """
+
+    # 每次从磁盘读取的字节数
+    READ_SIZE = 64 * 1024
+    # 未设置num_ctx时假定的上下文长度（Ollama旧版本的默认值，取保守值避免提示词被服务器截断）
+    DEFAULT_NUM_CTX = 2048
+    # 为提示词模板、问题说明等预留的token数
+    PROMPT_OVERHEAD = 128
+    # 未设置num_predict时为回答预留的token数
+    DEFAULT_ANSWER_TOKENS = 512
+    # 中日韩字符范围，用于token估算
+    CJK_PATTERN = re.compile(r'[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]')
+    MODES = {'映射归约': 'map_reduce', '截断': 'truncate'}
+
+    @classmethod
+    def estimate_tokens(cls, text):
+        # 估算文本的token数
+        cjk = len(cls.CJK_PATTERN.findall(text))
+        return cjk + (len(text) - cjk + 3) // 4
+
+    @classmethod
+    def iter_text(cls, path):
+        # 按块读取文件并增量解码为文本，多字节字符跨块时不会被截断
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(cls.READ_SIZE)
+                if not block:
+                    break
+                yield decoder.decode(block)
+        tail = decoder.decode(b'', final=True)
+        if tail:
+            yield tail
+
+    @classmethod
+    def estimate_file(cls, path):
+        # 流式统计文件的估算token数，不保留文件内容
+        return sum(cls.estimate_tokens(text) for text in cls.iter_text(path))
+
+    @classmethod
+    def iter_chunks(cls, path, max_tokens):
+        """
+        将文件切分为估算token数不超过max_tokens的片段
+
+        内存中只保留当前片段，适合处理几十MB的日志文件
+        """
+        return cls.split_text(cls.iter_text(path), max_tokens)
+
+    @classmethod
+    def split_text(cls, texts, max_tokens):
+        # 将连续的文本块按行重新组合为估算token数不超过max_tokens的片段
+        lines = []
+        tokens = 0
+        pending = ''
+        for text in texts:
+            parts = (pending + text).split('\n')
+            pending = parts.pop()
+            pieces = [piece for line in parts for piece in cls.split_line(line + '\n', max_tokens)]
+            # 没有换行的长内容（压缩过的JSON、单行日志）超过上限时立即切出完整的片段，只保留不足一段的尾部，
+            # 未完成的行不会随文件增长，每个块的处理量与文件大小无关
+            if len(pending) > max_tokens and cls.estimate_tokens(pending) > max_tokens:
+                split = cls.split_line(pending, max_tokens)
+                pending = split.pop()
+                pieces.extend(split)
+            for piece in pieces:
+                piece_tokens = cls.estimate_tokens(piece)
+                if lines and tokens + piece_tokens > max_tokens:
+                    yield ''.join(lines)
+                    lines, tokens = [], 0
+                lines.append(piece)
+                tokens += piece_tokens
+        for piece in cls.split_line(pending, max_tokens):
+            if lines and tokens + cls.estimate_tokens(piece) > max_tokens:
+                yield ''.join(lines)
+                lines, tokens = [], 0
+            lines.append(piece)
+            tokens += cls.estimate_tokens(piece)
+        if lines and ''.join(lines).strip():
+            yield ''.join(lines)
+
+    @classmethod
+    def split_line(cls, line, max_tokens):
+        # 单行超过上限时按字符数切分（按每字符1个token的最坏情况计算，保证切分后不超限）
+        if cls.estimate_tokens(line) <= max_tokens:
+            return [line] if line else []
+        return [line[i:i + max_tokens] for i in range(0, len(line), max_tokens)]
+
+    @classmethod
+    def chunk_budget(cls, num_ctx, options, question):
+        # 计算每个文档片段可以使用的token数：上下文长度减去回答、问题和模板预留
+        answer_tokens = options.get('num_predict') or cls.DEFAULT_ANSWER_TOKENS
+        if answer_tokens < 0:
+            answer_tokens = cls.DEFAULT_ANSWER_TOKENS
+        budget = num_ctx - answer_tokens - cls.estimate_tokens(question) - cls.PROMPT_OVERHEAD
+        return max(budget, 256)
+# 文档附件不经过Tk文本控件，几MB的日志文件也不会让输入框卡顿；
+# 分段大小由模型的上下文长度决定，保证每次请求都不会被服务器静默截断。
+
+
+class OperationJournal:
+    """
+    模型操作日志（拉取、删除、创建、复制）
+
+    - 每次操作记录一行JSON，追加写入~/.ollama_gui/operations.jsonl，程序退出后仍然保留
+    - 记录主机、模型、字节数、耗时、平均和峰值吞吐量、重试次数和结果
+      吞吐量只对传输数据的操作（拉取、创建/上传、导入）记录，删除和复制的耗时与数据量无关，吞吐量留空
+    - 可以导出为CSV，用于容量规划
+    - append可以在任意线程中调用
+    """
+
+    # 每条记录的字段顺序，同时也是CSV的列顺序
+    FIELDS = ['time', 'operation', 'host', 'model', 'bytes', 'duration_s',
+              'avg_bps', 'peak_bps', 'retries', 'outcome', 'error']
+    # 记录吞吐量的操作类型
+    TRANSFER_OPERATIONS = ('pull', 'create', 'import')
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(APP_DATA_DIR, 'operations.jsonl')
+        self.lock = threading.Lock()
+
+    def begin(self, operation, host, model):
+        # 开始记录一次操作，返回用于更新进度和结束记录的对象
+        return OperationRecord(self, operation, host, model)
+
+    def append(self, entry):
+        # 追加一条记录，写入失败只记录日志，不影响操作本身
+        try:
+            with self.lock:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        except OSError as e:
+            logger.warning(f"写入操作日志失败: {str(e)}")
+
+    def load(self, limit=5000):
+        # 读取最近的limit条记录，跳过损坏的行
+        if not os.path.exists(self.path):
+            return []
+        entries = deque(maxlen=limit)
+        with self.lock, open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue
+        return list(entries)
+
+    def export_csv(self, path, entries=None):
+        # 导出为CSV文件（带BOM，Excel可以直接打开），返回导出的记录数
+        entries = self.load(limit=None) if entries is None else entries
+        with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=self.FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(entries)
+        return len(entries)
+
+
+class OperationRecord:
+    # 一次进行中的操作：根据进度回调计算吞吐量，结束时写入操作日志
+
+    # 峰值吞吐量的统计窗口（秒），避免瞬时波动造成虚高
+    PEAK_WINDOW = 1.0
+
+    def __init__(self, journal, operation, host, model):
+        self.journal = journal
+        self.operation = operation
+        self.host = host
+        self.model = model
+        self.wall_time = time.time()
+        self.started = time.perf_counter()
+        self.bytes = 0
+        self.peak_bps = 0.0
+        self.retries = 0
+        # 是否已经写入操作日志，避免同一次操作被记录两次
+        self.finished = False
+        # 上一个统计窗口的起点：(时间, 字节数)
+        self.window_start = (self.started, 0)
+
+    def progress(self, done_bytes):
+        # 更新已传输的字节数，每个统计窗口结束时更新一次峰值吞吐量
+        now = time.perf_counter()
+        self.bytes = max(self.bytes, done_bytes)
+        window_time, window_bytes = self.window_start
+        if now - window_time >= self.PEAK_WINDOW:
+            self.peak_bps = max(self.peak_bps, (self.bytes - window_bytes) / (now - window_time))
+            self.window_start = (now, self.bytes)
+
+    def retry(self):
+        # 记录一次重试
+        self.retries += 1
+
+    def finish(self, outcome, error='', done_bytes=None):
+        # 结束操作并写入操作日志，返回写入的记录
+        self.finished = True
+        if done_bytes is not None:
+            self.bytes = done_bytes
+        duration = time.perf_counter() - self.started
+        avg_bps = self.bytes / duration if duration > 0 else 0.0
+        transfer = self.operation in OperationJournal.TRANSFER_OPERATIONS
+        entry = {
+            'time': time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.wall_time)),
+            'operation': self.operation,
+            'host': self.host,
+            'model': self.model,
+            'bytes': self.bytes,
+            'duration_s': round(duration, 2),
+            'avg_bps': round(avg_bps) if transfer else None,
+            # 操作时间不足一个统计窗口时，峰值取平均值
+            'peak_bps': round(max(self.peak_bps, avg_bps)) if transfer else None,
+            'retries': self.retries,
+            'outcome': outcome,
+            'error': error,
+        }
+        self.journal.append(entry)
+        return entry
+# 操作日志采用追加写入的JSON Lines格式，单条记录损坏不会影响其他记录，
+# 不同主机的日志文件也可以直接合并后再导出分析。
+
+
+class ImageEncoder:
+    """
+    视觉模型图片附件的缩放和base64编码
+
+    - 图片按最长边缩放到max_side以内，避免把上千万像素的原图上传给服务器
+    - 编码结果按 (原始内容SHA-256, max_side) 缓存，多轮对话中重复发送同一张图片不会重复编码
+    - 未安装Pillow时不做缩放，直接发送原始文件内容的base64编码
+    - 所有方法都可以在后台线程中调用
+    """
+
+    # 缓存的编码结果数量上限（按最近使用淘汰）
+    MAX_CACHE_ENTRIES = 32
+    # 支持的图片文件扩展名
+    FILE_TYPES = [("图片文件", "*.png *.jpg *.jpeg *.webp *.bmp *.gif"), ("所有文件", "*.*")]
+
+    def __init__(self, max_side=1024):
+        # 缩放后图片最长边的像素数，0表示不缩放
+        self.max_side = max_side
+        # 编码缓存：(digest, max_side) -> (base64字符串, 说明文字)
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def encode(self, source):
+        """
+        编码一张图片
+
+        参数：source为图片文件路径或图片的原始字节
+        返回值：(base64字符串, 说明文字)，说明文字用于在聊天区域显示图片尺寸和编码大小
+        """
+        if isinstance(source, bytes):
+            raw = source
+        else:
+            with open(source, 'rb') as f:
+                raw = f.read()
+        key = (hashlib.sha256(raw).hexdigest(), self.max_side)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+
+        data, note = self.resize(raw)
+        result = (base64.b64encode(data).decode('ascii'), note)
+        with self.lock:
+            self.cache[key] = result
+            while len(self.cache) > self.MAX_CACHE_ENTRIES:
+                self.cache.popitem(last=False)
+        return result
+
+    def resize(self, raw):
+        # 按最长边缩放图片并重新编码，返回 (图片字节, 说明文字)
+        if Image is None:
+            return raw, f"{format_bytes(len(raw))}（未安装Pillow，未缩放）"
+        with Image.open(io.BytesIO(raw)) as image:
+            image_format = image.format
+            # 手机拍摄的竖向照片通过EXIF方向标记旋转，先按标记转正，否则模型看到的是横躺的图片
+            orientation = image.getexif().get(0x0112, 1)
+            if orientation != 1:
+                image = ImageOps.exif_transpose(image)
+            width, height = image.size
+            if self.max_side and max(width, height) > self.max_side:
+                image.thumbnail((self.max_side, self.max_side), Image.LANCZOS)
+            elif image_format in ('JPEG', 'PNG') and orientation == 1:
+                # 尺寸已经足够小且格式受服务器支持时直接使用原始内容
+                return raw, f"{width}x{height}, {format_bytes(len(raw))}"
+            output = io.BytesIO()
+            # 带透明通道的图片保存为PNG，其余保存为JPEG以减小体积
+            if image.mode in ('RGBA', 'LA', 'P'):
+                image.save(output, format='PNG', optimize=True)
+            else:
+                image.convert('RGB').save(output, format='JPEG', quality=90)
+            data = output.getvalue()
+            return data, f"{width}x{height} -> {image.size[0]}x{image.size[1]}, {format_bytes(len(data))}"
+
+    @staticmethod
+    def grab_clipboard():
+        """
+        读取剪贴板中的图片
+
+        返回值：图片来源列表（PNG字节或图片文件路径），剪贴板中没有图片时返回空列表
+        """
+        if ImageGrab is None:
+            return []
+        try:
+            content = ImageGrab.grabclipboard()
+        except Exception:
+            return []
+        if isinstance(content, list):
+            # 从文件管理器复制的文件以路径列表形式返回
+            return [path for path in content if isinstance(path, str) and os.path.isfile(path)]
+        if content is None or not hasattr(content, 'save'):
+            return []
+        output = io.BytesIO()
+        content.save(output, format='PNG')
+        return [output.getvalue()]
+# 缩放和编码都在生成线程中进行，主线程只保存图片路径或剪贴板内容，
+# 选择大图片后界面不会卡顿；一张1200万像素的照片缩放到1024像素后通常只有一两百KB。
+
+
+class ModelBundle:
+    """
+    可移植的模型包（tar格式）导出与导入
+
+    包内容按顺序为：
+    - manifest.json：{'name': 模型名称, 'manifest': 原始清单}，总是位于第一个
+    - blobs/sha256-<hex>：清单引用的blob文件（目标端已有的权重、投影器和适配器blob会被跳过，
+      config和模板、系统提示词、参数等小文件总是写入，导入时需要读取它们的内容）
+
+    导出时直接从模型目录流式读取blob写入tar流，不产生临时副本；
+    导入时逐块读取tar成员并同时计算SHA-256，digest不一致时立即中止。
+    导入目标可以是本地模型目录，也可以是Ollama服务器（通过/api/blobs上传后用/api/create注册）。
+    """
+
+    MANIFEST_MEMBER = 'manifest.json'
+    # 流式读写使用的块大小
+    CHUNK_SIZE = 1024 * 1024
+    # 注册到服务器时需要读取内容的小型文本层
+    TEXT_MEDIA_TYPES = {
+        'application/vnd.ollama.image.template': 'template',
+        'application/vnd.ollama.image.system': 'system',
+        'application/vnd.ollama.image.license': 'license',
+    }
+
+    # 可以按digest跳过的大文件层（权重、投影器、适配器），注册时只需要服务器上存在这些blob
+    LARGE_LAYER_SUFFIXES = ('.model', '.projector', '.adapter')
+
+    @staticmethod
+    def manifest_layers(manifest):
+        # 返回清单引用的全部层（包括config）
+        return [layer for layer in [manifest.get('config')] + list(manifest.get('layers', [])) if layer]
+
+    @classmethod
+    def large_digests(cls, manifest):
+        # 返回清单中大文件层的digest，只有这些blob可以因为目标端已存在而不写入模型包
+        return sorted({layer['digest'] for layer in manifest.get('layers', [])
+                       if layer.get('mediaType', '').endswith(cls.LARGE_LAYER_SUFFIXES)})
+
+    @classmethod
+    def is_text_layer(cls, media_type):
+        # 模板、系统提示词、许可证、参数和预设消息层，注册时需要读取内容作为/api/create的字段
+        return media_type in cls.TEXT_MEDIA_TYPES or media_type.endswith(('.params', '.messages'))
+
+    @staticmethod
+    def read_manifest(store_index, model_name):
+        # 从本地模型目录读取模型的清单
+        store_index.refresh()
+        manifest_path = next((path for path, entry in store_index.manifests.items() if entry[2] == model_name), None)
+        if manifest_path is None:
+            raise ValueError(f"本地模型目录中没有找到模型 {model_name}")
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    @classmethod
+    def export_bundle(cls, store_index, model_name, out_path, skip_digests=(), progress=None):
+        """
+        将模型导出为模型包
+
+        参数：
+        - store_index：ModelStoreIndex，提供模型目录和清单路径
+        - skip_digests：目标端已经存在、无需写入包中的digest集合（只对大文件层生效）
+        - progress：进度回调，参数为 (已写入字节数, 总字节数)
+        返回值：(写入的blob数量, 写入的字节数, 跳过的blob数量)
+        """
+        manifest = cls.read_manifest(store_index, model_name)
+        skip_digests = set(skip_digests) & set(cls.large_digests(manifest))
+        layers = [layer for layer in cls.manifest_layers(manifest) if layer['digest'] not in skip_digests]
+        # 同一个blob在清单中可能出现多次，只写入一次
+        digests = list(dict.fromkeys(layer['digest'] for layer in layers))
+        total = sum(os.path.getsize(store_index.blob_path(digest)) for digest in digests)
+        written = 0
+        with tarfile.open(out_path, mode='w|') as tar:
+            header = json.dumps({'name': model_name, 'manifest': manifest}, ensure_ascii=False).encode('utf-8')
+            info = tarfile.TarInfo(cls.MANIFEST_MEMBER)
+            info.size = len(header)
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(header))
+            for digest in digests:
+                blob_path = store_index.blob_path(digest)
+                info = tarfile.TarInfo(f"blobs/{digest.replace(':', '-')}")
+                info.size = os.path.getsize(blob_path)
+                info.mtime = int(os.path.getmtime(blob_path))
+                # tarfile按块从文件对象复制数据，blob不会整体读入内存
+                with open(blob_path, 'rb') as blob:
+                    tar.addfile(info, blob)
+                written += info.size
+                if progress:
+                    progress(written, total)
+        return len(digests), written, len(skip_digests)
+
+    @classmethod
+    def iter_verified(cls, stream, digest, size, progress=None, offset=0, total=0):
+        # 逐块读取tar成员，同时计算SHA-256，读取结束时digest不一致则抛出异常
+        hasher = hashlib.sha256()
+        remaining = size
+        while remaining > 0:
+            chunk = stream.read(min(cls.CHUNK_SIZE, remaining))
+            if not chunk:
+                raise ValueError(f"模型包数据不完整: {digest}")
+            hasher.update(chunk)
+            remaining -= len(chunk)
+            if progress:
+                progress(offset + size - remaining, total)
+            yield chunk
+        if f"sha256:{hasher.hexdigest()}" != digest:
+            raise ValueError(f"digest校验失败: {digest}")
+
+    @classmethod
+    def read_header(cls, tar):
+        # 读取包中的第一个成员manifest.json
+        member = tar.next()
+        if member is None or member.name != cls.MANIFEST_MEMBER:
+            raise ValueError("不是有效的模型包：缺少manifest.json")
+        return json.loads(tar.extractfile(member).read().decode('utf-8'))
+
+    @classmethod
+    def import_to_directory(cls, archive_path, models_dir, name=None, progress=None):
+        """
+        将模型包导入本地模型目录
+
+        blob先写入临时文件，校验通过后再改名为正式文件名；目录中已有的blob直接跳过。
+        返回值：导入的模型名称
+        """
+        total = os.path.getsize(archive_path)
+        store_index = ModelStoreIndex(models_dir)
+        blobs_dir = os.path.join(models_dir, 'blobs')
+        os.makedirs(blobs_dir, exist_ok=True)
+        with tarfile.open(archive_path, mode='r|') as tar:
+            header = cls.read_header(tar)
+            name = name or header['name']
+            manifest = header['manifest']
+            # 流模式下必须用next()顺序读取成员，迭代器会从头重放已读过的manifest.json
+            for member in iter(tar.next, None):
+                digest = member.name.split('/')[-1].replace('-', ':', 1)
+                target = store_index.blob_path(digest)
+                if os.path.exists(target):
+                    continue
+                tmp_path = target + '.partial'
+                try:
+                    with open(tmp_path, 'wb') as f:
+                        for chunk in cls.iter_verified(tar.extractfile(member), digest, member.size,
+                                                       progress, member.offset_data, total):
+                            f.write(chunk)
+                    os.replace(tmp_path, target)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+
+        # 所有blob就绪后才写入清单，保证目录中的模型始终完整
+        missing = [layer['digest'] for layer in cls.manifest_layers(manifest)
+                   if not os.path.exists(store_index.blob_path(layer['digest']))]
+        if missing:
+            raise ValueError(f"模型包中缺少 {len(missing)} 个blob，且目标目录中也不存在")
+        save_json_file(cls.manifest_path(models_dir, name), manifest)
+        return name
+
+    @staticmethod
+    def manifest_path(models_dir, name):
+        # 根据模型名称计算清单文件路径，与ModelStoreIndex.manifest_model_name互为逆运算
+        model, _, tag = name.partition(':')
+        parts = model.split('/')
+        if len(parts) == 1:
+            parts = [ModelStoreIndex.DEFAULT_REGISTRY, ModelStoreIndex.DEFAULT_NAMESPACE] + parts
+        elif len(parts) == 2:
+            parts = [ModelStoreIndex.DEFAULT_REGISTRY] + parts
+        return os.path.join(models_dir, 'manifests', *parts, tag or 'latest')
+
+    @classmethod
+    def import_to_server(cls, archive_path, base_url, name=None, progress=None):
+        """
+        将模型包导入Ollama服务器
+
+        权重等大文件逐块校验并流式上传到/api/blobs，服务器已有的blob跳过上传；
+        模板、系统提示词、参数等小文件读取内容后作为/api/create的结构化字段。
+        返回值：(模型名称, /api/create请求数据)
+        """
+        total = os.path.getsize(archive_path)
+        with tarfile.open(archive_path, mode='r|') as tar:
+            header = cls.read_header(tar)
+            name = name or header['name']
+            manifest = header['manifest']
+            media_types = {layer['digest']: layer.get('mediaType', '') for layer in cls.manifest_layers(manifest)}
+            payload = {"model": name, "name": name, "stream": True}
+            small_contents = {}
+            # 流模式下必须用next()顺序读取成员，迭代器会从头重放已读过的manifest.json
+            for member in iter(tar.next, None):
+                digest = member.name.split('/')[-1].replace('-', ':', 1)
+                media_type = media_types.get(digest, '')
+                if cls.is_text_layer(media_type):
+                    # 小文件读入内存，校验后解析为结构化字段
+                    small_contents[digest] = b''.join(cls.iter_verified(
+                        tar.extractfile(member), digest, member.size, progress, member.offset_data, total))
+                    continue
+                blob_url = f"{base_url}/api/blobs/{digest}"
+                if api.head(blob_url).status_code == 200:
+                    continue
+                response = api.post(blob_url, data=cls.iter_verified(
+                    tar.extractfile(member), digest, member.size, progress, member.offset_data, total))
+                response.raise_for_status()
+
+        # 模板、系统提示词、参数等字段只能从包中读取，缺少时注册出来的模型会悄悄丢失这些设置
+        missing = [layer['digest'] for layer in manifest.get('layers', [])
+                   if cls.is_text_layer(layer.get('mediaType', '')) and layer['digest'] not in small_contents]
+        if missing:
+            raise ValueError(f"模型包中缺少模板/参数等文本层: {', '.join(missing)}")
+        # 按清单中的媒体类型构建/api/create的字段
+        files = {}
+        adapters = {}
+        # 只遍历layers，config不对应/api/create的任何字段；清单中没有config时也不会漏掉第一层
+        for layer in manifest.get('layers', []):
+            digest, media_type = layer['digest'], layer.get('mediaType', '')
+            if media_type.endswith('.model'):
+                files['model.gguf'] = digest
+            elif media_type.endswith('.projector'):
+                files['projector.gguf'] = digest
+            elif media_type.endswith('.adapter'):
+                adapters['adapter.gguf'] = digest
+            elif digest in small_contents:
+                content = small_contents[digest].decode('utf-8')
+                if media_type in cls.TEXT_MEDIA_TYPES:
+                    payload[cls.TEXT_MEDIA_TYPES[media_type]] = content
+                elif media_type.endswith('.params'):
+                    payload['parameters'] = json.loads(content)
+                else:
+                    payload['messages'] = json.loads(content)
+        if not files:
+            raise ValueError("模型包中没有模型权重层，且无法在服务器上注册")
+        payload['files'] = files
+        if adapters:
+            payload['adapters'] = adapters
+        return name, payload
+# 模型包让两台离线的Ollama主机之间迁移模型不再需要手工复制blob目录：
+# 包中只包含清单真正引用的blob，目标端已有的blob在导出或导入时都会被跳过。
+
+
+class ChatSession:
+    """
+    聊天会话：每个会话对应聊天页面中的一个标签页
+
+    - 每个会话有独立的模型、对话树、聊天显示区域和生成任务
+    - 对话以树的形式保存：每个节点是一轮问答，重新生成或修改提问会在原节点旁边产生新的分支，原来的对话保留
+    - 每个节点保存到这一轮为止的上下文（token编号，以紧凑的整数数组保存），
+      从任意节点继续提问时直接发送该节点的上下文，服务器只需计算新增的提问
+    - 会话不在前台时，生成的片段只写入任务缓冲区，切换到该会话时一次性渲染
+    - 对话树的节点数、保存上下文的节点数和显示区域的行数都有上限，长时间运行的会话占用的内存不会无限增长
+    - 会话保存为磁盘快照：<key>.json保存对话树、模型digest和生成参数，
+      上下文数组依次写入<key>_<序号>.ctx二进制文件，重新打开程序时几毫秒即可恢复，继续提问时直接使用保存的上下文
+    """
+
+    # 保存上下文的节点数上限，超出后释放最久未使用节点的上下文（之后从该节点继续时改为发送对话记录）
+    MAX_CONTEXT_NODES = 50
+    # 对话树的节点数上限，超出后删除最早的不在当前分支上的分支
+    MAX_NODES = 500
+    # 聊天显示区域保留的最大行数，超出后删除最早的内容
+    MAX_TEXT_LINES = 5000
+    # 保留思考内容的回答数量，更早回答的思考过程会被释放
+    MAX_THINKING_SECTIONS = 20
+    # 不使用服务器上下文时，随提问一起发送的最近对话轮数
+    MAX_TRANSCRIPT_TURNS = 10
+    # 保留的结构化输出结果数量
+    MAX_STRUCTURED_RESULTS = 1000
+
+    def __init__(self, session_id, title, model, frame, text):
+        self.id = session_id
+        self.title = title
+        self.model = model
+        # 快照文件名（创建时间+编号），以及快照写入次数（用于生成新的上下文文件名）
+        self.key = f"{int(time.time() * 1000)}_{session_id}"
+        self.snapshot_serial = 0
+        # 标签页容器和聊天显示区域
+        self.frame = frame
+        self.text = text
+        # 对话树：节点编号 -> {'id', 'parent', 'children', 'user', 'ai', 'time', 'model', 'digest', 'context'}
+        self.nodes = {}
+        self.node_counter = 0
+        # 当前所在的节点（None表示还没有对话），新的提问作为它的子节点
+        self.head = None
+        # 保存了上下文的节点编号，按最近使用的顺序排列
+        self.context_nodes = OrderedDict()
+        # 思考过程区域：任务编号 -> 区域信息，超出上限时释放最早的思考内容
+        self.thinking_sections = OrderedDict()
+        # 结构化输出模式下校验通过的结果（已解析的对象），可以导出为JSON文件
+        self.structured_results = deque(maxlen=self.MAX_STRUCTURED_RESULTS)
+        # 输入时预填充：本轮已完成预填充的输入内容（None表示尚未预填充）、是否有预填充请求正在进行
+        # 以及发送轮次（每发送一条消息加1，用于丢弃上一轮过期的预填充结果）
+        self.prefill_text = None
+        self.prefill_running = False
+        self.turn = 0
+        # 会话在后台时收到了新内容
+        self.unread = False
+        # 会话已关闭，之后到达的事件直接丢弃
+        self.closed = False
+
+    def path(self, node_id):
+        # 返回从第一轮到指定节点的节点列表
+        turns = []
+        while node_id is not None:
+            node = self.nodes[node_id]
+            turns.append(node)
+            node_id = node['parent']
+        turns.reverse()
+        return turns
+
+    def add_turn(self, parent, user, ai, context, model, digest):
+        # 在parent下新增一轮问答并返回节点编号；回答包含思考内容时context为None，之后改为发送对话记录
+        # 服务器返回的上下文以32位整数数组保存，占用内存约为列表的四分之一
+        # 同时记录生成该上下文的模型和digest，模型更换或更新后上下文中的token编号不再有效
+        self.node_counter += 1
+        node = {'id': self.node_counter, 'parent': parent, 'children': [], 'user': user, 'ai': ai,
+                'time': time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()), 'model': model, 'digest': digest,
+                'context': array('i', context) if context else None}
+        self.nodes[node['id']] = node
+        if parent is not None:
+            self.nodes[parent]['children'].append(node['id'])
+        if node['context'] is not None:
+            self.touch_context(node['id'])
+        return node['id']
+
+    def prune(self, keep=()):
+        """
+        节点数超过上限时删除最早的旁支，返回删除的节点数
+
+        当前分支以及keep中节点（生成中或排队中任务的父节点）所在的分支受保护；
+        旁支按起点从早到晚整棵删除。只剩受保护的分支时删除最早的根节点，
+        它的子节点成为新的根（节点自己的上下文已经包含之前的对话，不受影响）。
+        """
+        removed = 0
+        while len(self.nodes) > self.MAX_NODES:
+            protected = set()
+            for node_id in (self.head, *keep):
+                while node_id is not None and node_id in self.nodes and node_id not in protected:
+                    protected.add(node_id)
+                    node_id = self.nodes[node_id]['parent']
+            branches = [node['id'] for node in self.nodes.values()
+                        if node['id'] not in protected and (node['parent'] is None or node['parent'] in protected)]
+            if branches:
+                stack = [min(branches)]
+            else:
+                root = min(node['id'] for node in self.nodes.values() if node['parent'] is None)
+                for child in self.nodes[root]['children']:
+                    self.nodes[child]['parent'] = None
+                self.nodes[root]['children'] = []
+                stack = [root]
+            while stack:
+                node = self.nodes.pop(stack.pop())
+                stack.extend(node['children'])
+                self.context_nodes.pop(node['id'], None)
+                if node['parent'] is not None and node['parent'] in self.nodes:
+                    self.nodes[node['parent']]['children'].remove(node['id'])
+                removed += 1
+        return removed
+
+    def touch_context(self, node_id):
+        # 记录节点上下文的使用，超出上限时释放最久未使用节点的上下文
+        self.context_nodes[node_id] = True
+        self.context_nodes.move_to_end(node_id)
+        while len(self.context_nodes) > self.MAX_CONTEXT_NODES:
+            old_id, _ = self.context_nodes.popitem(last=False)
+            self.nodes[old_id]['context'] = None
+
+    def context_for(self, node_id, model, digest):
+        # 返回使用指定模型从节点继续提问时发送的上下文（列表），没有保存上下文或模型不一致时返回None
+        if node_id is None:
+            return None
+        node = self.nodes[node_id]
+        if node['context'] is None or node['model'] != model:
+            return None
+        if digest and node['digest'] and digest != node['digest']:
+            return None
+        self.touch_context(node_id)
+        return node['context'].tolist()
+
+    def transcript(self, node_id):
+        # 将到指定节点为止的最近几轮对话整理为文本（只包含最终回答，不含思考内容），用于代替服务器上下文
+        turns = self.path(node_id)[-self.MAX_TRANSCRIPT_TURNS:]
+        if not turns:
+            return ''
+        lines = [f"用户: {turn['user']}\n助手: {turn['ai']}" for turn in turns]
+        return "以下是之前的对话记录:\n" + "\n\n".join(lines) + "\n\n"
+
+    def snapshot_state(self, digest, options, think):
+        """
+        在主线程中收集写入快照需要的数据
+
+        只复制节点的文字字段和上下文数组的引用（上下文数组创建后不再修改），不涉及磁盘读写，
+        返回的数据交给write_snapshot在后台线程中写入，之后对话树的变化不会影响正在写入的快照。
+        """
+        self.snapshot_serial += 1
+        nodes = [{key: node[key] for key in ('id', 'parent', 'user', 'ai', 'time', 'model', 'digest')}
+                 for node in self.nodes.values()]
+        contexts = [node['context'] for node in self.nodes.values()]
+        meta = {'version': 1, 'key': self.key, 'title': self.title, 'model': self.model,
+                'digest': digest, 'options': options, 'think': think,
+                'head': self.head, 'node_counter': self.node_counter, 'serial': self.snapshot_serial,
+                'ctx_file': f"{self.key}_{self.snapshot_serial}.ctx", 'byteorder': sys.byteorder,
+                'itemsize': array('i').itemsize, 'context_order': list(self.context_nodes), 'nodes': nodes}
+        return meta, contexts
+
+    @staticmethod
+    def write_snapshot(directory, meta, contexts):
+        """
+        将snapshot_state收集的数据写入磁盘快照（在后台线程中调用）
+
+        上下文数组按原始字节依次写入新的.ctx文件，元数据只记录每个节点上下文的起始位置和长度；
+        先写.ctx再写元数据，最后删除旧的.ctx，写入过程中程序退出时旧快照仍然完整可用。
+        """
+        ctx_name = meta['ctx_file']
+        offset = 0
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = os.path.join(directory, ctx_name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            for entry, context in zip(meta['nodes'], contexts):
+                if context is not None:
+                    entry['context'] = [offset, len(context)]
+                    f.write(context.tobytes())
+                    offset += len(context)
+        os.replace(tmp_path, os.path.join(directory, ctx_name))
+        save_json_file(os.path.join(directory, f"{meta['key']}.json"), meta)
+        # 删除之前的上下文文件
+        for name in os.listdir(directory):
+            if name.startswith(f"{meta['key']}_") and name.endswith('.ctx') and name != ctx_name:
+                os.remove(os.path.join(directory, name))
+
+    def load_snapshot(self, meta):
+        # 从快照元数据恢复对话树，上下文从.ctx文件一次读入后按位置切分为整数数组
+        directory = os.path.dirname(meta['path'])
+        contexts = array('i')
+        if meta['itemsize'] != contexts.itemsize:
+            raise ValueError("上下文整数长度与当前平台不一致")
+        with open(os.path.join(directory, meta['ctx_file']), 'rb') as f:
+            contexts.frombytes(f.read())
+        if meta['byteorder'] != sys.byteorder:
+            contexts.byteswap()
+        self.key = meta['key']
+        self.snapshot_serial = meta['serial']
+        self.node_counter = meta['node_counter']
+        self.nodes = {}
+        for entry in meta['nodes']:
+            node = dict(entry, children=[], context=None)
+            if entry.get('context'):
+                offset, count = entry['context']
+                node['context'] = contexts[offset:offset + count]
+            self.nodes[node['id']] = node
+        for node in self.nodes.values():
+            if node['parent'] is not None:
+                self.nodes[node['parent']]['children'].append(node['id'])
+        self.context_nodes = OrderedDict((node_id, True) for node_id in meta['context_order']
+                                         if self.nodes[node_id]['context'] is not None)
+        self.head = meta['head']
+
+    def drop_contexts_longer_than(self, num_ctx):
+        # 当前num_ctx小于保存的上下文长度时，服务器会截断上下文，这些节点改为发送对话记录；返回释放的数量
+        dropped = [node_id for node_id in self.context_nodes if len(self.nodes[node_id]['context']) >= num_ctx]
+        for node_id in dropped:
+            self.nodes[node_id]['context'] = None
+            del self.context_nodes[node_id]
+        return len(dropped)
+
+    def delete_snapshot(self, directory):
+        # 删除会话的快照文件（元数据和上下文）
+        for name in os.listdir(directory) if os.path.isdir(directory) else []:
+            if name.startswith(f"{self.key}.") or name.startswith(f"{self.key}_"):
+                os.remove(os.path.join(directory, name))
+
+    def tab_text(self):
+        # 标签页标题：后台有新内容时显示圆点
+        return f"{'● ' if self.unread else ''}{self.title} [{self.model}]"
+
+    def trim(self):
+        # 删除超出行数上限的最早内容，正在生成的任务通过标记定位，不受影响
+        lines = int(self.text.index('end-1c').split('.')[0])
+        excess = lines - self.MAX_TEXT_LINES
+        if excess > 0:
+            self.text.config(state='normal')
+            self.text.delete('1.0', f"{excess + 1}.0")
+            self.text.config(state='disabled')
+# 会话对象只在主线程中使用；生成线程通过任务中保存的数据工作，不会直接访问会话的控件。
+
 
 class OllamaGUI:
     def __init__(self, root):
@@ -48,14 +3053,86 @@ class OllamaGUI:
         # 设置Ollama服务器默认连接参数
         self.ip_address = "127.0.0.1"  # 默认本地IP地址
         self.port = "11434"  # Ollama服务的默认端口
-        # 初始化对话历史记录列表，用于存储聊天内容
-        self.conversation_history = []
+        # 聊天会话列表（每个标签页一个会话），对话历史保存在各自的会话中
+        self.sessions = []
+        # 当前显示的会话
+        self.current_session = None
+        # 会话编号计数器，用于生成默认标题
+        self.session_counter = 0
+        # 会话快照目录，程序启动时从这里恢复上次的会话
+        self.session_dir = os.path.join(APP_DATA_DIR, 'sessions')
+        # 后台写入快照：会话key -> (会话, 快照数据或None)，以及当前的写入线程
+        self.snapshot_tasks = {}
+        self.snapshot_lock = threading.Lock()
+        self.snapshot_thread = None
+        # 本地模型存储索引器，用于统计真实磁盘占用和共享层
+        self.store_index = ModelStoreIndex()
+        # 批量删除模型时的最大并发请求数
+        self.delete_workers = 4
+        # 模型操作日志（拉取、删除、创建、复制），持久保存在本地
+        self.journal = OperationJournal()
+        # 拉取模型时连接中断的最大重试次数
+        self.pull_retries = 2
+        # 按模型保存的生成参数配置
+        self.options_profiles = OptionsProfileStore()
+        # 提交队列：等待中的任务列表、正在生成的任务以及后台线程回传的界面事件
+        self.pending_prompts = []
+        self.active_generations = {}
+        self.ui_events = queue.Queue()
+        self.job_counter = 0
+        # 每个会话同时进行的生成数量上限，服务器OLLAMA_NUM_PARALLEL大于1时可以调大
+        self.max_parallel_generations = 1
+        # 本地文档检索：索引对象延迟创建，检索开关、检索片段数以及嵌入请求的批大小和并发数
+        self.document_index = None
+        self.retrieval_enabled = tk.BooleanVar(value=False)
+        self.retrieval_top_k = 4
+        self.embed_batch_size = 32
+        self.embed_concurrency = 2
+        # 模型名称 -> digest，由refresh_models更新
+        self.model_digests = {}
+        # 嵌入向量磁盘缓存，默认上限256MB
+        self.embedding_cache = EmbeddingCache()
+        # 确定性请求（固定seed且temperature为0）的回答缓存，需要手动开启
+        self.response_cache = ResponseCache()
+        self.response_cache_enabled = tk.BooleanVar(value=False)
+        self.bypass_response_cache = tk.BooleanVar(value=False)
+        # 输入时预填充：停止输入一段时间后把对话前缀和已输入内容发送给服务器预先计算（num_predict为0）
+        self.prefill_enabled = tk.BooleanVar(value=False)
+        self.prefill_delay_ms = 800
+        self.prefill_after_id = None
+        # 图片附件：等待随下一条消息发送的图片列表，元素为 (显示名称, 文件路径或图片字节)
+        self.pending_images = []
+        # 图片缩放和编码器，编码结果按图片哈希缓存
+        self.image_encoder = ImageEncoder()
+        # 文档附件：等待随下一条消息发送的文档（路径、名称、估算token数、处理方式），不放入输入框
+        self.pending_document = None
+        # /api/show结果缓存：(模型名称, digest) -> 模型信息，用于文档分段和显存估算
+        self.model_show_info = {}
+        # 模型名称 -> 模型文件大小（来自/api/tags），用于估算权重占用的显存
+        self.model_sizes = {}
+        # 发送前的显存占用估算和检查设置
+        self.memory_fit = MemoryFitEstimator()
+        # 结构化输出：开启后请求带上format字段，回答按输出Schema流式校验，Schema保存在output_schema.json中
+        self.structured_output_enabled = tk.BooleanVar(value=False)
+        self.output_schema_path = os.path.join(APP_DATA_DIR, 'output_schema.json')
+        self.output_schema = load_json_file(self.output_schema_path, {}).get('schema')
+        # 事件循环延迟监测器（诊断模式），卡顿来源按以下方法名归类
+        self.loop_monitor = EventLoopMonitor(self.root, origin_names=(
+            'send_message', 'list_models', 'pull_model', 'delete_model', 'perform_delete_models',
+            'refresh_models', 'show_version_in_chat', 'show_disk_usage', 'process_ui_events'))
+        # 多主机负载均衡：启用后在后台持续探测各主机的健康状态
+        self.host_pool = HostPool()
+        if self.host_pool.enabled:
+            self.host_pool.start()
         
         # 调用方法设置全局UI样式，统一界面风格
         self.setup_styles()
         
         # 调用方法构建完整GUI界面
         self.setup_gui()
+        
+        # 启动界面事件处理循环，在主线程中显示后台生成线程的输出
+        self.root.after(30, self.process_ui_events)
 # 这段代码是OllamaGUI类的初始化方法，负责设置应用程序的基本参数、窗口属性、默认值和界面样式。它为整个应用程序奠定了基础，包括窗口大小、位置、字体设置、服务器连接参数等，并调用其他方法来完成界面的构建。
     
     def setup_styles(self):
@@ -187,8 +3264,15 @@ class OllamaGUI:
         self.port_entry.grid(row=0, column=3, padx=5, pady=5, sticky='w')
         
         # 版本查询按钮
-        version_button = ttk.Button(grid_frame, text='Ollama版本号', command=self.show_version_in_chat)
-        version_button.grid(row=0, column=4, padx=(20,0), pady=5, sticky='e')
+        # 右上角工具按钮：知识库设置和版本查询
+        tools_frame = ttk.Frame(grid_frame)
+        tools_frame.grid(row=0, column=4, padx=(20,0), pady=5, sticky='e')
+        version_button = ttk.Button(tools_frame, text='Ollama版本号', command=self.show_version_in_chat)
+        version_button.pack(side='right')
+        knowledge_button = ttk.Button(tools_frame, text='知识库', command=self.open_knowledge_base)
+        knowledge_button.pack(side='right', padx=(0, 5))
+        host_pool_button = ttk.Button(tools_frame, text='主机池', command=self.open_host_pool)
+        host_pool_button.pack(side='right', padx=(0, 5))
         
         # 第二行：模型选择区域
         # 模型选择下拉框及其标签
@@ -201,26 +3285,100 @@ class OllamaGUI:
         refresh_button = ttk.Button(grid_frame, text='刷新模型列表', command=self.refresh_models)
         refresh_button.grid(row=1, column=2, columnspan=2, padx=5, pady=5)
         
+        # 生成参数配置按钮，为当前模型设置num_ctx等请求参数
+        options_frame = ttk.Frame(grid_frame)
+        options_frame.grid(row=1, column=4, padx=(20,0), pady=5, sticky='e')
+        options_button = ttk.Button(options_frame, text='生成参数', command=self.edit_model_options)
+        options_button.pack(side='left')
+        # 显存估算按钮，查看当前模型在不同num_ctx下需要的内存，并设置发送前检查
+        ttk.Button(options_frame, text='显存估算', command=self.open_memory_fit).pack(side='left', padx=(5, 0))
+        
+        # 第三行：显示最近一次生成的服务器耗时统计
+        self.stats_label = ttk.Label(grid_frame, text='', foreground='#555555',
+                                     font=(self.default_font[0], self.default_font[1]-4))
+        self.stats_label.grid(row=2, column=0, columnspan=5, padx=(0,5), sticky='w')
+        
         # 设置网格布局最后一列的权重，使其自动扩展
         grid_frame.grid_columnconfigure(4, weight=1)
         
         # 初始化模型列表
         self.refresh_models()
         
-        # 构建聊天消息显示区域
+        # 构建聊天消息显示区域：每个会话一个标签页
         chat_area = ttk.Frame(self.chat_frame)
         chat_area.pack(fill='both', expand=True, padx=10, pady=5)
         
-        # 创建聊天消息显示文本框，配备垂直滚动条
-        chat_scroll = ttk.Scrollbar(chat_area)
-        chat_scroll.pack(side='right', fill='y')
+        # 会话操作按钮：新建和关闭会话
+        session_bar = ttk.Frame(chat_area)
+        session_bar.pack(fill='x')
+        ttk.Button(session_bar, text='关闭会话', command=self.close_session).pack(side='right', padx=2)
+        ttk.Button(session_bar, text='新建会话', command=self.new_session).pack(side='right', padx=2)
+        # 对话分支：重新生成最后一个回答，或在对话树中切换分支、修改之前的提问
+        ttk.Button(session_bar, text='对话树', command=self.show_conversation_tree).pack(side='left', padx=2)
+        ttk.Button(session_bar, text='重新生成', command=self.regenerate_answer).pack(side='left', padx=2)
         
-        # 聊天文本框初始化为禁用状态，防止用户直接编辑
-        self.chat_text = tk.Text(chat_area, height=15, font=self.default_font, 
-                                state='disabled', yscrollcommand=chat_scroll.set)
-        self.chat_text.pack(fill='both', expand=True)
-        chat_scroll.config(command=self.chat_text.yview)
+        self.session_notebook = ttk.Notebook(chat_area)
+        self.session_notebook.pack(fill='both', expand=True)
+        self.session_notebook.bind('<<NotebookTabChanged>>', self.on_session_changed)
+        # 用户在下拉框中选择模型时，只修改当前会话使用的模型
+        self.model_combobox.bind('<<ComboboxSelected>>', self.on_session_model_changed)
+        # 恢复上次保存的会话，没有快照时新建一个空会话
+        if not self.restore_sessions():
+            self.new_session()
+        
+        # 构建提交队列区域，显示生成中和排队中的消息
+        queue_frame = ttk.Frame(self.chat_frame)
+        queue_frame.pack(fill='x', padx=10, pady=(5, 0))
+        
+        queue_buttons = ttk.Frame(queue_frame)
+        queue_buttons.pack(side='right', fill='y', padx=(5, 0))
+        
+        self.queue_listbox = tk.Listbox(queue_frame, height=3, exportselection=False,
+                                        font=(self.default_font[0], self.default_font[1]-4))
+        self.queue_listbox.pack(side='left', fill='both', expand=True)
+        self.queue_view_ids = []
         
+        # 第一行：队列操作按钮（上移、下移、取消/停止）以及并发数设置
+        queue_row = ttk.Frame(queue_buttons)
+        queue_row.pack(side='top', anchor='e')
+        ttk.Button(queue_row, text='上移', command=lambda: self.move_queued_prompt(-1)).pack(side='left', padx=2)
+        ttk.Button(queue_row, text='下移', command=lambda: self.move_queued_prompt(1)).pack(side='left', padx=2)
+        ttk.Button(queue_row, text='取消', command=self.cancel_queued_prompt).pack(side='left', padx=2)
+        ttk.Label(queue_row, text='并发:').pack(side='left', padx=(10, 2))
+        self.parallel_var = tk.StringVar(value=str(self.max_parallel_generations))
+        ttk.Spinbox(queue_row, from_=1, to=8, width=3, textvariable=self.parallel_var,
+                    command=self.on_parallel_changed, state='readonly',
+                    font=("TkDefaultFont", 16)).pack(side='left')
+        
+        # 第二行：回答缓存开关、跳过缓存和清空缓存
+        cache_row = ttk.Frame(queue_buttons)
+        cache_row.pack(side='top', anchor='e', pady=(3, 0))
+        ttk.Checkbutton(cache_row, text='缓存确定性回答', variable=self.response_cache_enabled).pack(side='left', padx=2)
+        ttk.Checkbutton(cache_row, text='跳过缓存', variable=self.bypass_response_cache).pack(side='left', padx=2)
+        ttk.Button(cache_row, text='清空', command=self.clear_response_cache).pack(side='left', padx=2)
+        ttk.Checkbutton(cache_row, text='输入时预填充', variable=self.prefill_enabled).pack(side='left', padx=(10, 2))
+        
+        # 构建图片附件栏：附加或粘贴的图片随下一条消息发送给视觉模型
+        attach_row = ttk.Frame(self.chat_frame)
+        attach_row.pack(fill='x', padx=10)
+        ttk.Button(attach_row, text='附加图片', command=self.attach_images).pack(side='left', padx=2)
+        ttk.Button(attach_row, text='附加文档', command=self.attach_document).pack(side='left', padx=2)
+        self.document_mode = ttk.Combobox(attach_row, values=list(DocumentAttachment.MODES), width=8, state='readonly')
+        self.document_mode.set('映射归约')
+        self.document_mode.pack(side='left', padx=2)
+        ttk.Button(attach_row, text='清除附件', command=self.clear_attachments).pack(side='left', padx=2)
+        ttk.Label(attach_row, text='最大边长:').pack(side='left', padx=(8, 2))
+        self.image_side_var = tk.StringVar(value=str(self.image_encoder.max_side))
+        ttk.Spinbox(attach_row, from_=0, to=4096, increment=256, width=6, textvariable=self.image_side_var,
+                    command=self.on_image_side_changed).pack(side='left')
+        self.image_side_var.trace_add('write', lambda *args: self.on_image_side_changed())
+        self.attach_label = ttk.Label(attach_row, text='')
+        self.attach_label.pack(side='left', padx=8)
+        # 结构化输出开关、编辑输出Schema和导出校验通过的结果
+        ttk.Button(attach_row, text='导出JSON', command=self.export_structured_results).pack(side='right', padx=2)
+        ttk.Button(attach_row, text='Schema', command=self.edit_output_schema).pack(side='right', padx=2)
+        ttk.Checkbutton(attach_row, text='JSON输出', variable=self.structured_output_enabled).pack(side='right', padx=2)
+
         # 构建用户输入区域
         input_frame = ttk.Frame(self.chat_frame)
         input_frame.pack(fill='x', padx=10, pady=(5, 10))
@@ -255,6 +3413,10 @@ class OllamaGUI:
 
         # 修改回车键事件绑定
         self.input_text.bind('<Return>', lambda event: self.handle_enter(event))
+        # 粘贴时优先检查剪贴板中的图片，没有图片时按普通文本粘贴
+        self.input_text.bind('<<Paste>>', self.handle_paste)
+        # 输入内容变化后延迟触发预填充，连续输入时只在停顿后发送一次
+        self.input_text.bind('<KeyRelease>', self.schedule_prefill, add='+')
 # 这个方法负责构建聊天界面的整体布局，包括三个主要部分：
 # 1. 服务器配置区域：用于设置Ollama服务器的连接参数和模型选择
 # 2. 聊天消息显示区域：展示用户与AI模型的对话内容
@@ -288,9 +3450,10 @@ class OllamaGUI:
         tree_scroll_y.pack(side='right', fill='y')
         
         # 创建Treeview表格组件，用于展示模型的详细信息
-        # show='headings'用于隐藏默认的树形图标列
+        # show='headings'用于隐藏默认的树形图标列，selectmode='extended'支持Ctrl/Shift多选
         self.model_tree = ttk.Treeview(tree_frame, columns=('名称', '大小', '修改时间'), 
-                                      show='headings', yscrollcommand=tree_scroll_y.set)
+                                      show='headings', selectmode='extended',
+                                      yscrollcommand=tree_scroll_y.set)
         
         # 配置表格的三个列标题
         self.model_tree.heading('名称', text='名称')
@@ -315,17 +3478,32 @@ class OllamaGUI:
         # 每个元组包含按钮显示文本和对应的处理方法
         operations = [
             ('拉取模型', self.pull_model),    # 用于下载新的AI模型
-            ('删除模型', self.delete_model)    # 用于移除已安装的模型
+            ('删除模型', self.delete_model),   # 用于移除已安装的模型
+            ('复制模型', self.copy_model),     # 通过/api/copy为模型创建新名称
+            ('创建模型', self.create_model),   # 通过Modelfile创建派生模型
+            ('导入GGUF', self.import_gguf),    # 上传本地GGUF文件并注册为模型
+            ('导出模型包', self.export_model_bundle),  # 将模型清单和blob打包，用于迁移到其他主机
+            ('导入模型包', self.import_model_bundle),  # 校验并导入模型包到服务器或本地目录
+            ('磁盘占用', self.show_disk_usage),  # 统计本地存储的独占/共享空间
+            ('模型目录', self.set_models_dir),  # 设置本地模型存储目录
+            ('查看日志', self.show_logs),       # 查看最近的运行日志
+            ('操作记录', self.show_operation_journal),  # 查看和导出模型操作的历史记录
+            ('诊断', self.open_diagnostics),    # 事件循环卡顿监测和性能分析
+            ('负载测试', self.open_load_test)   # 模拟并发会话，评估主机容量
         ]
         
-        # 动态创建操作按钮并设置布局
-        for text, command in operations:
-            ttk.Button(right_buttons_frame, text=text, command=command).pack(
-                side='left',     # 按钮左对齐排列
-                fill='x',        # 水平方向填充
-                padx=5,          # 水平间距5像素
-                expand=True      # 允许按钮扩展占用可用空间
+        # 动态创建操作按钮并设置布局，按钮较多时每行排列3个
+        for index, (text, command) in enumerate(operations):
+            ttk.Button(right_buttons_frame, text=text, command=command).grid(
+                row=index // 3,     # 每3个按钮换一行
+                column=index % 3,
+                sticky='ew',        # 水平方向填充
+                padx=5,             # 水平间距5像素
+                pady=2              # 垂直间距2像素
             )
+        # 各列等宽扩展，占用可用空间
+        for column in range(3):
+            right_buttons_frame.grid_columnconfigure(column, weight=1)
         
         # 创建操作结果显示区域的容器框架
         result_frame = ttk.Frame(right_frame)
@@ -434,18 +3612,23 @@ class OllamaGUI:
             
             # 调用Ollama API获取已安装的模型列表
             url = f"{base_url}/api/tags"
-            response = requests.get(url)      # 发送GET请求
+            response = api.get(url)      # 发送GET请求
             response.raise_for_status()       # 检查请求是否成功
             models = response.json().get('models', [])  # 解析JSON响应获取模型列表
             
             # 处理获取到的模型列表数据
             model_names = [model['name'] for model in models]  # 提取所有模型的名称
+            # 记录每个模型的digest，用于缓存键和检测模型版本变化
+            self.model_digests = {model['name']: model.get('digest', '') for model in models}
+            self.model_sizes = {model['name']: model.get('size', 0) for model in models}
             model_names.sort()  # 按字母顺序对模型名称进行排序
             self.model_combobox['values'] = model_names  # 更新下拉列表的选项
             
-            # 自动选择第一个可用的模型
+            # 当前会话的模型仍然存在时保持不变，否则自动选择第一个可用的模型
             if model_names:
-                self.model_combobox.set(model_names[0])
+                current = self.current_session.model if self.current_session else ''
+                self.model_combobox.set(current if current in model_names else model_names[0])
+                self.on_session_model_changed()
             
         except Exception as e:
             # 发生错误时的异常处理
@@ -453,6 +3636,7 @@ class OllamaGUI:
             # 设置默认值，确保界面可用性
             self.model_combobox['values'] = ["llama2"]  # 设置默认模型选项
             self.model_combobox.set("llama2")          # 选择默认模型
+            self.on_session_model_changed()
 # 这个方法的主要功能是刷新和更新可用的AI模型列表，具体实现了以下功能：
 # 1. 智能处理多种服务器地址格式，支持本地服务器、HTTP/HTTPS地址、IPv4地址等
 # 2. 通过API获取Ollama服务器上已安装的模型列表
@@ -487,7 +3671,7 @@ class OllamaGUI:
         try:
             # 构建并发送HTTP GET请求获取模型列表
             url = f"http://{ip}:{port}/api/tags"  # 构建Ollama API的URL端点
-            response = requests.get(url)          # 发送GET请求获取模型列表
+            response = api.get(url)          # 发送GET请求获取模型列表
             response.raise_for_status()           # 检查HTTP响应状态，如果不是200则抛出异常
             
             # 解析服务器返回的JSON数据
@@ -687,7 +3871,7 @@ class OllamaGUI:
                 # 构建API请求URL，用于获取已安装模型列表
                 check_url = f"http://{ip}:{port}/api/tags"
                 # 发送HTTP GET请求获取模型列表
-                response = requests.get(check_url)
+                response = api.get(check_url)
                 # 从响应JSON中提取模型名称列表，如果'models'键不存在则返回空列表
                 existing_models = [m['name'] for m in response.json().get('models', [])]
                 
@@ -735,6 +3919,8 @@ class OllamaGUI:
         progress = ttk.Progressbar(progress_dialog, mode='determinate', length=730)  # 创建确定模式的进度条
         progress.pack(pady=15)  # 设置进度条的垂直间距
 
+        # 记录本次拉取操作的字节数、吞吐量和重试次数
+        record = self.journal.begin('pull', f"{ip}:{port}", model_name)
         # 开始模型下载流程的异常处理块
         try:
             # 在主界面的结果文本区域添加下载开始提示
@@ -751,109 +3937,122 @@ class OllamaGUI:
                 "insecure": True     # 允许非安全连接，用于处理自签名证书的情况
             }
             
-            # 发送HTTP POST请求并获取流式响应
-            response = requests.post(url, json=data, stream=True)  # 使用流式传输处理大型下载
-            response.raise_for_status()  # 检查响应状态，如果不是200则抛出异常
-            
-            # 更新进度对话框显示下载开始状态
-            progress_label.config(text="连接成功，开始下载模型...")  # 更新状态文本
-            progress['value'] = 0  # 设置进度条初始值
-            progress_dialog.update()  # 刷新对话框显示
-
             # 初始化下载进度追踪变量
             total_bytes = 0          # 记录总下载字节数
             downloaded_bytes = 0      # 记录已下载字节数
             layer_info = {}          # 用字典存储每个层的下载信息，键为层的digest，值为该层的下载状态
             
-            # 使用迭代器处理服务器返回的流式响应数据
-            for line in response.iter_lines():
-                # 跳过空行，确保数据有效性
-                if not line:
-                    continue
-                
+            # 连接中断时自动重试，服务器会从已下载的位置继续拉取
+            attempt = 0
+            while True:
                 try:
-                    # 解析每行JSON格式的响应数据，转换为Python字典
-                    progress_data = json.loads(line.decode('utf-8'))
-                    # 获取当前下载状态信息，如果不存在则返回空字符串
-                    status = progress_data.get('status', '')
+                    # 发送HTTP POST请求并获取流式响应
+                    response = api.post(url, json=data, stream=True)  # 使用流式传输处理大型下载
+                    response.raise_for_status()  # 检查响应状态，如果不是200则抛出异常
+            
+                    # 更新进度对话框显示下载开始状态
+                    progress_label.config(text="连接成功，开始下载模型...")  # 更新状态文本
+                    progress['value'] = 0  # 设置进度条初始值
+                    progress_dialog.update()  # 刷新对话框显示
+
+                    # 使用迭代器处理服务器返回的流式响应数据
+                    for line in response.iter_lines():
+                        # 跳过空行，确保数据有效性
+                        if not line:
+                            continue
+                
+                        try:
+                            # 解析每行JSON格式的响应数据，转换为Python字典
+                            progress_data = json.loads(line.decode('utf-8'))
+                            # 获取当前下载状态信息，如果不存在则返回空字符串
+                            status = progress_data.get('status', '')
                     
-                    # 根据不同的下载状态更新进度界面显示
-                    if 'pulling manifest' in status:
-                        # 当正在获取模型清单时，更新状态标签和进度条
-                        progress_label.config(text="正在获取模型信息...")
-                        progress['value'] = 0  # 设置进度条为初始状态
-                        progress_dialog.update()  # 刷新进度对话框显示
-                    elif 'pulling' in status:
-                        # 当正在下载模型文件时，处理具体的下载进度
-                        # 获取当前下载层的唯一标识符
-                        digest = progress_data.get('digest', '')
-                        # 获取当前已完成的字节数
-                        completed = int(progress_data.get('completed', 0))
-                        # 获取当前层的总字节数
-                        total = int(progress_data.get('total', 0))
+                            # 根据不同的下载状态更新进度界面显示
+                            if 'pulling manifest' in status:
+                                # 当正在获取模型清单时，更新状态标签和进度条
+                                progress_label.config(text="正在获取模型信息...")
+                                progress['value'] = 0  # 设置进度条为初始状态
+                                progress_dialog.update()  # 刷新进度对话框显示
+                            elif 'pulling' in status:
+                                # 当正在下载模型文件时，处理具体的下载进度
+                                # 获取当前下载层的唯一标识符
+                                digest = progress_data.get('digest', '')
+                                # 获取当前已完成的字节数
+                                completed = int(progress_data.get('completed', 0))
+                                # 获取当前层的总字节数
+                                total = int(progress_data.get('total', 0))
                         
-                        # 处理每个下载层的信息
-                        if digest:
-                            # 如果是新的下载层，初始化其信息并更新总字节数
-                            if digest not in layer_info:
-                                layer_info[digest] = {'total': total, 'completed': 0}
-                                total_bytes += total  # 累加总下载大小
-                            # 更新当前层的已下载字节数
-                            layer_info[digest]['completed'] = completed
+                                # 处理每个下载层的信息
+                                if digest:
+                                    # 如果是新的下载层，初始化其信息并更新总字节数
+                                    if digest not in layer_info:
+                                        layer_info[digest] = {'total': total, 'completed': 0}
+                                        total_bytes += total  # 累加总下载大小
+                                    # 更新当前层的已下载字节数
+                                    layer_info[digest]['completed'] = completed
                             
-                            # 计算总体下载进度
-                            # 累加所有层的已下载字节数
-                            downloaded_bytes = sum(layer['completed'] for layer in layer_info.values())
-                            if total_bytes > 0:
-                                # 计算下载百分比，最大显示95%，预留验证阶段的进度空间
-                                progress_percent = min(95, (downloaded_bytes / total_bytes) * 100)
-                                # 将字节数转换为MB单位，便于显示
-                                downloaded_mb = downloaded_bytes / (1024 * 1024)
-                                total_mb = total_bytes / (1024 * 1024)
-                                # 格式化进度显示文本
-                                status_text = f"正在下载模型: {downloaded_mb:.1f}MB/{total_mb:.1f}MB ({progress_percent:.1f}%)"
-                                # 更新进度显示界面
-                                progress_label.config(text=status_text)
-                                progress['value'] = progress_percent
+                                    # 计算总体下载进度
+                                    # 累加所有层的已下载字节数
+                                    downloaded_bytes = sum(layer['completed'] for layer in layer_info.values())
+                                    record.progress(downloaded_bytes)
+                                    if total_bytes > 0:
+                                        # 计算下载百分比，最大显示95%，预留验证阶段的进度空间
+                                        progress_percent = min(95, (downloaded_bytes / total_bytes) * 100)
+                                        # 将字节数转换为MB单位，便于显示
+                                        downloaded_mb = downloaded_bytes / (1024 * 1024)
+                                        total_mb = total_bytes / (1024 * 1024)
+                                        # 格式化进度显示文本
+                                        status_text = f"正在下载模型: {downloaded_mb:.1f}MB/{total_mb:.1f}MB ({progress_percent:.1f}%)"
+                                        # 更新进度显示界面
+                                        progress_label.config(text=status_text)
+                                        progress['value'] = progress_percent
+                                        progress_dialog.update()
+                            # 处理模型文件的SHA256校验阶段
+                            elif 'verifying sha256 digest' in status:
+                                # 更新进度标签显示校验状态
+                                progress_label.config(text="正在验证模型完整性...")
+                                # 设置进度条为96%，表示进入校验阶段
+                                progress['value'] = 96
+                                # 刷新进度对话框显示
+                                progress_dialog.update()
+                            # 处理模型清单文件写入阶段
+                            elif 'writing manifest' in status:
+                                # 更新进度标签显示写入状态
+                                progress_label.config(text="正在写入模型文件...")
+                                # 设置进度条为97%，表示进入文件写入阶段
+                                progress['value'] = 97
+                                progress_dialog.update()
+                            # 处理清理临时文件阶段
+                            elif 'removing unused layers' in status:
+                                # 更新进度标签显示清理状态
+                                progress_label.config(text="正在清理未使用的文件...")
+                                # 设置进度条为98%，表示进入清理阶段
+                                progress['value'] = 98
+                                progress_dialog.update()
+                            # 处理下载成功完成状态
+                            elif status == 'success':
+                                # 更新进度标签显示完成状态
+                                progress_label.config(text="下载完成！")
+                                # 设置进度条为100%，表示下载全部完成
+                                progress['value'] = 100
                                 progress_dialog.update()
-                    # 处理模型文件的SHA256校验阶段
-                    elif 'verifying sha256 digest' in status:
-                        # 更新进度标签显示校验状态
-                        progress_label.config(text="正在验证模型完整性...")
-                        # 设置进度条为96%，表示进入校验阶段
-                        progress['value'] = 96
-                        # 刷新进度对话框显示
-                        progress_dialog.update()
-                    # 处理模型清单文件写入阶段
-                    elif 'writing manifest' in status:
-                        # 更新进度标签显示写入状态
-                        progress_label.config(text="正在写入模型文件...")
-                        # 设置进度条为97%，表示进入文件写入阶段
-                        progress['value'] = 97
-                        progress_dialog.update()
-                    # 处理清理临时文件阶段
-                    elif 'removing unused layers' in status:
-                        # 更新进度标签显示清理状态
-                        progress_label.config(text="正在清理未使用的文件...")
-                        # 设置进度条为98%，表示进入清理阶段
-                        progress['value'] = 98
-                        progress_dialog.update()
-                    # 处理下载成功完成状态
-                    elif status == 'success':
-                        # 更新进度标签显示完成状态
-                        progress_label.config(text="下载完成！")
-                        # 设置进度条为100%，表示下载全部完成
-                        progress['value'] = 100
-                        progress_dialog.update()
                     
-                # 捕获JSON解析异常，跳过无效的数据行
-                except json.JSONDecodeError:
-                    continue
+                        # 捕获JSON解析异常，跳过无效的数据行
+                        except json.JSONDecodeError:
+                            continue
+                    break
+                except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError):
+                    if attempt >= self.pull_retries:
+                        raise
+                    attempt += 1
+                    record.retry()
+                    progress_label.config(text=f"连接中断，正在重试 ({attempt}/{self.pull_retries})...")
+                    progress_dialog.update()
            
             # 通过API验证下载的模型是否可用
             verify_url = f"http://{ip}:{port}/api/show"
             # 发送POST请求验证模型状态
-            verify_response = requests.post(verify_url, json={"name": model_name})
+            verify_response = api.post(verify_url, json={"name": model_name})
             # 如果验证失败，抛出异常并包含错误信息
             if not verify_response.ok:
                 raise Exception(f"模型验证失败: {verify_response.text}")
@@ -876,6 +4075,7 @@ class OllamaGUI:
             
             # 清理资源，关闭进度对话框
             progress_dialog.destroy()
+            record.finish('success', done_bytes=downloaded_bytes)
             
             # 刷新模型列表显示
             # list_models更新树形视图中的模型列表
@@ -894,6 +4094,8 @@ class OllamaGUI:
         except Exception as e:
             # 清理资源，关闭进度对话框
             progress_dialog.destroy()
+            if not record.finished:
+                record.finish('failed', str(e))
             # 在结果文本区域显示错误信息
             self.result_text.insert(tk.END, f"错误: {str(e)}\n")
             # 显示错误提示对话框
@@ -933,9 +4135,422 @@ class OllamaGUI:
 # 代码采用分层设计模式，通过字典结构（layer_info）管理多层下载进度，并使用流式处理确保与大模型对话的实时反馈，提供良好的用户体验。
 # 每个阶段都通过进度条和文本标签向用户提供清晰的反馈。代码使用了异常处理机制确保即使遇到无效数据也能继续运行，提高程序的稳定性。
 # 代码采用完整的错误处理机制，确保即使在出错情况下也能正确清理资源并给出用户友好的提示。通过多层验证确保模型下载的完整性和可用性。
+
+    def selected_tree_model(self):
+        # 返回模型列表中第一个选中的模型名称，未选中时返回空字符串
+        selection = self.model_tree.selection()
+        return self.model_tree.item(selection[0], 'values')[0] if selection else ''
+
+    def copy_model(self):
+        # 复制模型：通过/api/copy为已有模型创建一个新名称，只写入新清单，不复制权重文件
+        source = self.selected_tree_model() or self.get_selected_model()
+        destination = simpledialog.askstring("复制模型", f"源模型: {source}\n请输入新的模型名称（如 {source.split(':')[0]}:mytag）:",
+                                             parent=self.root)
+        if not destination or not destination.strip():
+            return
+        destination = destination.strip()
+        ip = self.ip_entry.get().strip()
+        port = self.port_entry.get().strip()
+        record = self.journal.begin('copy', f"{ip}:{port}", f"{source} -> {destination}")
+        try:
+            current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+            self.result_text.insert(tk.END, f"\n[{current_time}] 正在复制模型 {source} -> {destination}...\n")
+            response = api.post(f"http://{ip}:{port}/api/copy",
+                                json={"source": source, "destination": destination})
+            response.raise_for_status()
+            record.finish('success')
+            current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+            self.result_text.insert(tk.END, f"[{current_time}] 模型 {destination} 复制完成!\n")
+            self.list_models()
+            self.refresh_models()
+            messagebox.showinfo("完成", f"已复制为 {destination}")
+        except Exception as e:
+            if not record.finished:
+                record.finish('failed', str(e))
+            self.result_text.insert(tk.END, f"错误: {str(e)}\n")
+            messagebox.showerror("错误", f"复制模型失败: {str(e)}")
+# /api/copy只创建新的清单并引用相同的blob，新名称可以立即使用且不占用额外磁盘空间。
+
+    def create_model(self):
+        # 创建派生模型：在Modelfile编辑器中基于已有模型修改参数或系统提示词，通过/api/create生成新模型
+        base = self.selected_tree_model() or self.get_selected_model()
+
+        dialog = tk.Toplevel(self.root)
+        dialog.title("创建模型")
+        dialog_width = 800
+        dialog_height = 600
+        dialog_x = self.root.winfo_x() + (self.root.winfo_width() - dialog_width) // 2
+        dialog_y = self.root.winfo_y() + (self.root.winfo_height() - dialog_height) // 2
+        dialog.geometry(f"{dialog_width}x{dialog_height}+{dialog_x}+{dialog_y}")
+        dialog.transient(self.root)
+        dialog.grab_set()
+
+        content_frame = ttk.Frame(dialog, padding=20)
+        content_frame.pack(fill='both', expand=True)
+
+        # 新模型名称
+        name_frame = ttk.Frame(content_frame)
+        name_frame.pack(fill='x')
+        ttk.Label(name_frame, text='新模型名称:').pack(side='left')
+        name_entry = ttk.Entry(name_frame, width=35, font=("TkDefaultFont", 16))
+        name_entry.insert(0, f"{base.split(':')[0]}:custom")
+        name_entry.pack(side='left', padx=5)
+
+        # Modelfile编辑器，预置FROM指令和常用参数示例（以#开头的行为注释）
+        ttk.Label(content_frame, text='Modelfile:').pack(anchor='w', pady=(10, 5))
+        editor = tk.Text(content_frame, height=12, font=('Consolas', self.default_font[1] - 2), wrap='none')
+        editor.pack(fill='both', expand=True)
+        editor.insert('1.0', f'FROM {base}\n'
+                             '# PARAMETER num_ctx 16384\n'
+                             '# PARAMETER temperature 0.7\n'
+                             '# SYSTEM """你是一个乐于助人的助手。"""\n')
+
+        def on_create():
+            name = name_entry.get().strip()
+            modelfile = editor.get('1.0', tk.END)
+            if not name:
+                messagebox.showwarning("警告", "请输入新模型名称！", parent=dialog)
+                return
+            try:
+                fields = parse_modelfile(modelfile)
+            except ValueError as e:
+                messagebox.showwarning("警告", str(e), parent=dialog)
+                return
+            dialog.destroy()
+            # 同时发送结构化字段（新版服务器）和modelfile文本（旧版服务器）
+            payload = dict(fields, model=name, name=name, modelfile=modelfile, stream=True)
+            self.run_streaming_operation("创建模型", "/api/create", payload, name)
+
+        button_frame = ttk.Frame(content_frame)
+        button_frame.pack(pady=10)
+        ttk.Button(button_frame, text='创建', command=on_create).pack(side='left', padx=20)
+        ttk.Button(button_frame, text='取消', command=dialog.destroy).pack(side='left', padx=20)
+        self.root.wait_window(dialog)
+# 派生模型复用基础模型的权重层，只新增参数、系统提示词等小文件，几秒钟即可完成，无需重新下载。
+
+    def import_gguf(self):
+        # 导入本地GGUF文件：计算SHA-256、检查服务器是否已有该blob、流式上传，最后通过/api/create注册模型
+        path = filedialog.askopenfilename(parent=self.root, title="选择GGUF文件",
+                                          filetypes=[("GGUF模型文件", "*.gguf"), ("所有文件", "*.*")])
+        if not path:
+            return
+        default_name = os.path.splitext(os.path.basename(path))[0].lower()
+        name = simpledialog.askstring("导入GGUF", "请输入模型名称：", initialvalue=default_name, parent=self.root)
+        if not name or not name.strip():
+            return
+        name = name.strip()
+        ip = self.ip_entry.get().strip()
+        port = self.port_entry.get().strip()
+        base_url = f"http://{ip}:{port}"
+
+        # 创建进度窗口并居中显示
+        progress_dialog, _label, _progress, make_progress = self.create_transfer_dialog("导入进度")
+
+        current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        self.result_text.insert(tk.END, f"\n[{current_time}] 正在导入 {path} 为模型 {name}...\n")
+        self.result_text.see(tk.END)
+
+        def log_line(text):
+            self.run_on_main(lambda: (self.result_text.insert(tk.END, f"  {text}\n"), self.result_text.see(tk.END)))
+
+        def finish(error, digest=None):
+            # 主线程：上传完成后交给run_streaming_operation通过/api/create注册模型
+            if progress_dialog.winfo_exists():
+                progress_dialog.destroy()
+            if error:
+                self.result_text.insert(tk.END, f"错误: {error}\n")
+                messagebox.showerror("错误", f"导入GGUF失败: {error}")
+                return
+            filename = os.path.basename(path)
+            payload = {"model": name, "name": name, "files": {filename: f"sha256:{digest}"},
+                       "modelfile": f"FROM @sha256:{digest}", "stream": True}
+            self.run_streaming_operation("导入模型", "/api/create", payload, name)
+
+        def worker():
+            # 哈希和上传阶段记入操作日志，上传失败时也能查到记录；之后的/api/create另有一条create记录
+            record = self.journal.begin('import', f"{ip}:{port}", name)
+            try:
+                # 第一步：以内存映射方式计算SHA-256
+                digest = sha256_file(path, make_progress("计算SHA-256"))
+                log_line(f"SHA-256: {digest}")
+                blob_url = f"{base_url}/api/blobs/sha256:{digest}"
+                # 第二步：服务器已有相同blob时跳过上传
+                if api.head(blob_url).status_code == 200:
+                    log_line("服务器已存在该文件，跳过上传")
+                else:
+                    # 第三步：以分块流式请求体上传，内存中只保留一个块
+                    show_upload = make_progress("上传")
+
+                    def upload_progress(done, total):
+                        record.progress(done)
+                        show_upload(done, total)
+                    started = time.perf_counter()
+                    response = api.post(blob_url, data=iter_file_chunks(path, upload_progress))
+                    response.raise_for_status()
+                    elapsed = time.perf_counter() - started
+                    size = os.path.getsize(path)
+                    log_line(f"上传完成: {format_bytes(size)}，用时 {elapsed:.1f}s，"
+                             f"平均 {format_bytes(size / max(elapsed, 1e-6))}/s")
+                record.finish('success')
+                self.run_on_main(lambda: finish(None, digest))
+            except Exception as e:
+                error = str(e)
+                record.finish('failed', error)
+                self.run_on_main(lambda: finish(error))
+
+        threading.Thread(target=worker, daemon=True).start()
+# 导入过程完全在后台线程中进行：哈希使用内存映射，上传使用分块生成器，客户端峰值内存与文件大小无关。
+# 服务器上已经存在相同内容的blob时直接跳过上传，适合在离线环境中重复导入同一文件。
+
+    def create_transfer_dialog(self, title, indeterminate=False):
+        """
+        创建居中显示的传输进度窗口
+
+        参数：indeterminate为True时先显示滚动进度条（总量未知），第一次报告进度后切换为确定进度
+        返回值：(进度窗口, 状态标签, 进度条, 进度回调生成函数)
+        进度回调可以在后台线程中调用，参数为 (已处理字节数, 总字节数)，每秒最多更新界面5次
+        """
+        progress_dialog = tk.Toplevel(self.root)
+        progress_dialog.title(title)
+        dialog_width = 750
+        dialog_height = 150
+        dialog_x = self.root.winfo_x() + (self.root.winfo_width() - dialog_width) // 2
+        dialog_y = self.root.winfo_y() + (self.root.winfo_height() - dialog_height) // 2
+        progress_dialog.geometry(f"{dialog_width}x{dialog_height}+{dialog_x}+{dialog_y}")
+        progress_dialog.transient(self.root)
+        progress_label = ttk.Label(progress_dialog, text="正在连接服务器..." if indeterminate else "准备中...")
+        progress_label.pack(pady=5)
+        progress = ttk.Progressbar(progress_dialog, mode='indeterminate' if indeterminate else 'determinate',
+                                   length=730)
+        progress.pack(pady=15)
+        if indeterminate:
+            progress.start(20)
+
+        def make_progress(stage):
+            # 生成带节流的进度回调，并计算吞吐量
+            started = time.perf_counter()
+            last_update = [0.0]
+
+            def callback(done, total):
+                now = time.perf_counter()
+                if now - last_update[0] < 0.2 and done < total:
+                    return
+                last_update[0] = now
+                rate = done / max(now - started, 1e-6)
+                text = f"{stage}: {format_bytes(done)}/{format_bytes(total)} ({format_bytes(rate)}/s)"
+                percent = done * 100 / total if total else 100
+                self.run_on_main(lambda: progress_dialog.winfo_exists() and (
+                    progress_label.config(text=text), progress.config(value=percent)))
+            return callback
+
+        return progress_dialog, progress_label, progress, make_progress
+
+    def export_model_bundle(self):
+        # 导出模型包：从本地模型目录读取清单和blob，流式写入一个tar文件
+        try:
+            self.store_index.refresh()
+        except Exception as e:
+            messagebox.showerror("错误", f"读取模型目录失败: {e}\n请先通过“模型目录”设置正确的路径")
+            return
+        model_name = self.selected_tree_model() or self.get_selected_model()
+        if model_name not in self.store_index.model_layers:
+            model_name = simpledialog.askstring(
+                "导出模型包", "请输入要导出的模型名称（本地模型目录中的模型）：\n" +
+                "\n".join(sorted(self.store_index.model_layers)), parent=self.root)
+            if not model_name or model_name.strip() not in self.store_index.model_layers:
+                if model_name:
+                    messagebox.showerror("错误", f"本地模型目录中没有找到模型 {model_name}")
+                return
+            model_name = model_name.strip()
+        out_path = filedialog.asksaveasfilename(
+            parent=self.root, title="保存模型包", defaultextension=".tar",
+            initialfile=model_name.replace('/', '_').replace(':', '_') + ".tar",
+            filetypes=[("Ollama模型包", "*.tar"), ("所有文件", "*.*")])
+        if not out_path:
+            return
+        # 目标是当前连接的服务器时，服务器上已有的blob不写入包中
+        check_server = messagebox.askyesno(
+            "导出模型包", "是否检查当前连接的服务器，跳过服务器上已经存在的blob？\n"
+                        "（目标主机就是当前服务器时可以大幅减小模型包）", parent=self.root)
+        ip = self.ip_entry.get().strip()
+        port = self.port_entry.get().strip()
+        base_url = f"http://{ip}:{port}"
+
+        progress_dialog, _label, _progress, make_progress = self.create_transfer_dialog("导出进度")
+        current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        self.result_text.insert(tk.END, f"\n[{current_time}] 正在导出模型 {model_name} 到 {out_path}...\n")
+        self.result_text.see(tk.END)
+
+        def finish(error, count=0, written=0, skipped=0):
+            if progress_dialog.winfo_exists():
+                progress_dialog.destroy()
+            if error:
+                self.result_text.insert(tk.END, f"错误: {error}\n")
+                messagebox.showerror("错误", f"导出模型包失败: {error}")
+                return
+            self.result_text.insert(tk.END, f"导出完成: {count} 个blob，{format_bytes(written)}，"
+                                            f"跳过目标端已有的 {skipped} 个blob\n")
+            self.result_text.see(tk.END)
+            messagebox.showinfo("完成", f"模型 {model_name} 已导出到 {out_path}")
+
+        def worker():
+            try:
+                skip = set()
+                if check_server:
+                    # 只检查权重等大文件，config和模板等小文件总是写入包中
+                    digests = ModelBundle.large_digests(ModelBundle.read_manifest(self.store_index, model_name))
+                    skip = {digest for digest in digests
+                            if api.head(f"{base_url}/api/blobs/{digest}").status_code == 200}
+                count, written, skipped = ModelBundle.export_bundle(self.store_index, model_name, out_path,
+                                                                    skip, make_progress("写入模型包"))
+                self.run_on_main(lambda: finish(None, count, written, skipped))
+            except Exception as e:
+                error = str(e)
+                self.run_on_main(lambda: finish(error))
+
+        threading.Thread(target=worker, daemon=True).start()
+
+    def import_model_bundle(self):
+        # 导入模型包：导入到当前服务器（上传blob后注册），或直接写入本地模型目录
+        path = filedialog.askopenfilename(parent=self.root, title="选择模型包",
+                                          filetypes=[("Ollama模型包", "*.tar"), ("所有文件", "*.*")])
+        if not path:
+            return
+        to_server = messagebox.askyesnocancel(
+            "导入模型包", "是否导入到当前连接的服务器？\n"
+                        f"选择“否”将直接写入本地模型目录: {self.store_index.models_dir}", parent=self.root)
+        if to_server is None:
+            return
+        name = simpledialog.askstring("导入模型包", "请输入导入后的模型名称（留空则使用包中的名称）：",
+                                      parent=self.root)
+        if name is None:
+            return
+        name = name.strip() or None
+        ip = self.ip_entry.get().strip()
+        port = self.port_entry.get().strip()
+        base_url = f"http://{ip}:{port}"
+        models_dir = self.store_index.models_dir
+
+        progress_dialog, _label, _progress, make_progress = self.create_transfer_dialog("导入进度")
+        current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        self.result_text.insert(tk.END, f"\n[{current_time}] 正在导入模型包 {path}...\n")
+        self.result_text.see(tk.END)
+
+        def finish(error, model_name=None, payload=None):
+            if progress_dialog.winfo_exists():
+                progress_dialog.destroy()
+            if error:
+                self.result_text.insert(tk.END, f"错误: {error}\n")
+                messagebox.showerror("错误", f"导入模型包失败: {error}")
+                return
+            if payload is not None:
+                # blob已全部上传并校验，交给run_streaming_operation通过/api/create注册模型
+                self.run_streaming_operation("导入模型包", "/api/create", payload, model_name)
+                return
+            self.result_text.insert(tk.END, f"模型 {model_name} 已写入本地模型目录\n")
+            self.result_text.see(tk.END)
+            self.list_models()
+            self.refresh_models()
+            messagebox.showinfo("完成", f"模型 {model_name} 导入成功！\n服务器使用该目录时即可直接加载")
+
+        def worker():
+            try:
+                if to_server:
+                    model_name, payload = ModelBundle.import_to_server(path, base_url, name,
+                                                                       make_progress("校验并上传"))
+                else:
+                    model_name, payload = ModelBundle.import_to_directory(path, models_dir, name,
+                                                                          make_progress("校验并写入")), None
+                self.run_on_main(lambda: finish(None, model_name, payload))
+            except Exception as e:
+                error = str(e)
+                self.run_on_main(lambda: finish(error))
+
+        threading.Thread(target=worker, daemon=True).start()
+# 模型包在两台主机之间迁移模型：导出时只读取清单引用的blob，导入时边读边校验digest，
+# 任何一个blob校验失败都会中止导入，不会在目标端留下不完整的模型。
+
+    def run_streaming_operation(self, title, path, payload, model_name):
+        """
+        执行返回流式状态的模型操作（如/api/create），并显示进度窗口
+
+        - 请求在后台线程中进行，每条状态通过界面事件队列交给主线程显示
+        - 状态中包含total/completed时显示确定进度，否则显示滚动进度条
+        - 完成后刷新一次模型列表
+        """
+        ip = self.ip_entry.get().strip()
+        port = self.port_entry.get().strip()
+        url = f"http://{ip}:{port}{path}"
+
+        # 创建进度窗口并居中显示，总量未知时显示滚动进度条
+        progress_dialog, progress_label, progress, _make_progress = self.create_transfer_dialog(
+            f"{title}进度", indeterminate=True)
+
+        current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        self.result_text.insert(tk.END, f"\n[{current_time}] 正在{title} {model_name}...\n")
+        self.result_text.see(tk.END)
+
+        def show_status(data):
+            # 主线程中更新进度窗口和结果区域
+            status = data.get('status', '')
+            if not progress_dialog.winfo_exists():
+                return
+            total, completed = data.get('total'), data.get('completed')
+            if total and completed is not None:
+                progress.stop()
+                progress.config(mode='determinate', value=min(100, completed * 100 / total))
+                progress_label.config(text=f"{status}: {format_bytes(completed)}/{format_bytes(total)}")
+            else:
+                progress_label.config(text=status)
+                self.result_text.insert(tk.END, f"  {status}\n")
+                self.result_text.see(tk.END)
+
+        def finish(error):
+            # 主线程中结束操作：关闭进度窗口、刷新模型列表并提示结果
+            if progress_dialog.winfo_exists():
+                progress_dialog.destroy()
+            current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+            if error:
+                self.result_text.insert(tk.END, f"错误: {error}\n")
+                messagebox.showerror("错误", f"{title}失败: {error}")
+                return
+            self.result_text.insert(tk.END, f"[{current_time}] {title} {model_name} 完成!\n")
+            self.list_models()
+            self.refresh_models()
+            messagebox.showinfo("完成", f"{title} {model_name} 成功！")
+
+        def worker():
+            error = None
+            last_status = None
+            record = self.journal.begin('create', f"{ip}:{port}", model_name)
+            try:
+                response = api.post(url, json=payload, stream=True)
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    data = json.loads(line.decode('utf-8'))
+                    if data.get('error'):
+                        raise Exception(data['error'])
+                    last_status = data.get('status')
+                    if data.get('completed'):
+                        record.progress(data['completed'])
+                    self.run_on_main(lambda data=data: show_status(data))
+                if last_status != 'success':
+                    raise Exception(f"操作未完成，最后状态: {last_status}")
+                record.finish('success')
+            except Exception as e:
+                error = str(e)
+                record.finish('failed', error)
+            self.run_on_main(lambda: finish(error))
+
+        threading.Thread(target=worker, daemon=True).start()
+# 这个方法是创建等流式模型操作的公共流程，与pull_model一样逐条显示服务器返回的状态，
+# 但请求在后台线程中执行，界面在整个过程中保持响应。
+
             
     # delete_model方法：用于删除已安装的Ollama模型
-    # 该方法创建一个交互式对话框，让用户选择并删除模型
+    # 支持在模型列表中多选后直接删除，或在对话框中多选要删除的模型
     def delete_model(self):
         # 从界面输入框获取Ollama服务器连接参数
         ip = self.ip_entry.get().strip()
@@ -946,7 +4561,7 @@ class OllamaGUI:
             # 构建API请求URL，获取已安装的模型列表
             url = f"http://{ip}:{port}/api/tags"
             # 发送GET请求获取模型列表
-            response = requests.get(url)
+            response = api.get(url)
             # 检查响应状态码，如果不是2xx则抛出异常
             response.raise_for_status()
             
@@ -960,172 +4575,604 @@ class OllamaGUI:
                 messagebox.showinfo("提示", "没有找到可用的模型")
                 return
             
-            # 从模型数据中提取模型名称列表
+            # 从模型数据中提取模型名称列表，并记录每个模型的大小用于估算释放空间
             model_names = [model.get('name') for model in models]
+            model_sizes = {model.get('name'): model.get('size', 0) for model in models}
             
             # 对模型名称列表进行升序排序
             # 简单的字符串升序排序，适用于各种模型名称格式
             model_names.sort()
-            
-            # 创建模型删除对话框
-            dialog = tk.Toplevel(self.root)
-            dialog.title("删除模型")
-            dialog.geometry("500x250")
-            
-            # 计算对话框在主窗口中的居中位置
-            # 获取主窗口的位置和尺寸信息
-            window_x = self.root.winfo_x()
-            window_y = self.root.winfo_y()
-            window_width = self.root.winfo_width()
-            window_height = self.root.winfo_height()
-            # 计算对话框的居中坐标
-            dialog_x = window_x + (window_width - 500) // 2
-            dialog_y = window_y + (window_height - 250) // 2
-            # 设置对话框位置
-            dialog.geometry(f"+{dialog_x}+{dialog_y}")
-            
-            # 设置对话框的模态属性
-            # transient设置对话框为主窗口的临时子窗口
-            dialog.transient(self.root)
-            # grab_set使对话框成为模态窗口，阻止用户与其他窗口交互
-            dialog.grab_set()
-            
-            # 创建对话框的内容区域
-            # 使用ttk.Frame创建一个带内边距的框架容器
-            content_frame = ttk.Frame(dialog, padding=20)
-            # 设置框架填充和扩展属性
-            content_frame.pack(fill='both', expand=True)
-            
-            # 在内容框架中创建标签组件，显示"已有模型列表"文本
-            # 使用ttk.Label确保与系统主题一致的外观
-            label = ttk.Label(content_frame, text="已有模型列表:", font=self.default_font)
-            # 将标签靠左对齐放置，并设置上下边距
-            label.pack(anchor='w', pady=(0, 10))
-            
-            # 创建StringVar变量用于存储下拉列表框的当前选择值
-            model_var = tk.StringVar()
-            # 创建下拉列表框组件，用于显示可选的模型列表
-            # values参数设置可选项列表
-            # state='readonly'防止用户手动输入
-            # width=30设置显示宽度
-            model_combobox = ttk.Combobox(content_frame, textvariable=model_var, 
-                                          values=model_names, state='readonly', 
-                                          font=self.default_font, width=30)
-            # 设置下拉列表框的布局，使其填充整个水平空间
-            model_combobox.pack(anchor='w', pady=(0, 20), fill='x')
-            
-            # 如果模型列表不为空，默认选择第一个模型（降序排序后的第一个）
-            if model_names:
-                model_combobox.current(0)
-
-            # 创建按钮容器框架，用于组织确认和取消按钮
-            button_frame = ttk.Frame(content_frame)
-            # 设置按钮框架水平居中
-            button_frame.pack(anchor='center', pady=10)
-            
-            # 定义确认按钮的回调函数（保持原有逻辑不变）
-            def on_confirm():
-                selected_model = model_var.get()
-                if selected_model:
-                    dialog.destroy()
-                    confirm = messagebox.askyesno("确认删除", f"确定要删除模型 {selected_model} 吗?")
-                    if confirm:
-                        self.perform_delete_model(selected_model)
-            
-            # 创建确认删除按钮，并绑定回调函数
-            confirm_button = ttk.Button(button_frame, text="确认删除", command=on_confirm)
-            confirm_button.pack(side='left', padx=20)
-            
-            # 创建取消按钮，点击时直接关闭对话框
-            cancel_button = ttk.Button(button_frame, text="取消", command=dialog.destroy)
-            cancel_button.pack(side='left', padx=20)
-            
-            # 等待对话框关闭后继续执行
-            # wait_window会阻塞程序执行直到对话框被关闭
-            self.root.wait_window(dialog)
-            
-        # 异常处理：捕获在获取模型列表过程中可能出现的所有异常
         except Exception as e:
             # 在结果文本区域显示错误信息
             self.result_text.insert(tk.END, f"错误: {str(e)}\n")
             # 弹出错误消息框显示详细错误信息
             messagebox.showerror("错误", f"获取模型列表失败: {str(e)}")
+            return
+
+        # 如果用户已在模型列表中多选了模型，直接进入确认环节，不再弹出选择对话框
+        tree_selected = [self.model_tree.item(item, 'values')[0] for item in self.model_tree.selection()]
+        tree_selected = [name for name in tree_selected if name in model_sizes]
+        if tree_selected:
+            self.confirm_delete_models(tree_selected, model_sizes)
+            return
+            
+        # 创建模型删除对话框
+        dialog = tk.Toplevel(self.root)
+        dialog.title("删除模型")
+        dialog.geometry("500x450")
+        
+        # 计算对话框在主窗口中的居中位置
+        # 获取主窗口的位置和尺寸信息
+        window_x = self.root.winfo_x()
+        window_y = self.root.winfo_y()
+        window_width = self.root.winfo_width()
+        window_height = self.root.winfo_height()
+        # 计算对话框的居中坐标
+        dialog_x = window_x + (window_width - 500) // 2
+        dialog_y = window_y + (window_height - 450) // 2
+        # 设置对话框位置
+        dialog.geometry(f"+{dialog_x}+{dialog_y}")
+        
+        # 设置对话框的模态属性
+        # transient设置对话框为主窗口的临时子窗口
+        dialog.transient(self.root)
+        # grab_set使对话框成为模态窗口，阻止用户与其他窗口交互
+        dialog.grab_set()
+        
+        # 创建对话框的内容区域
+        # 使用ttk.Frame创建一个带内边距的框架容器
+        content_frame = ttk.Frame(dialog, padding=20)
+        # 设置框架填充和扩展属性
+        content_frame.pack(fill='both', expand=True)
+        
+        # 在内容框架中创建标签组件，提示可以按住Ctrl或Shift多选
+        label = ttk.Label(content_frame, text="已有模型列表（Ctrl/Shift多选）:", font=self.default_font)
+        # 将标签靠左对齐放置，并设置上下边距
+        label.pack(anchor='w', pady=(0, 10))
+        
+        # 创建带滚动条的多选列表框，selectmode='extended'支持Ctrl/Shift多选
+        list_frame = ttk.Frame(content_frame)
+        list_frame.pack(fill='both', expand=True, pady=(0, 10))
+        list_scroll = ttk.Scrollbar(list_frame)
+        list_scroll.pack(side='right', fill='y')
+        model_listbox = tk.Listbox(list_frame, selectmode='extended', font=self.default_font,
+                                   yscrollcommand=list_scroll.set, exportselection=False)
+        model_listbox.pack(side='left', fill='both', expand=True)
+        list_scroll.config(command=model_listbox.yview)
+        for name in model_names:
+            model_listbox.insert(tk.END, name)
+
+        # 创建按钮容器框架，用于组织确认和取消按钮
+        button_frame = ttk.Frame(content_frame)
+        # 设置按钮框架水平居中
+        button_frame.pack(anchor='center', pady=10)
+        
+        # 定义确认按钮的回调函数：收集所有选中的模型后统一确认一次
+        def on_confirm():
+            selected_models = [model_listbox.get(i) for i in model_listbox.curselection()]
+            if selected_models:
+                dialog.destroy()
+                self.confirm_delete_models(selected_models, model_sizes)
+            else:
+                messagebox.showwarning("警告", "请至少选择一个模型！", parent=dialog)
+        
+        # 创建确认删除按钮，并绑定回调函数
+        confirm_button = ttk.Button(button_frame, text="确认删除", command=on_confirm)
+        confirm_button.pack(side='left', padx=20)
+        
+        # 创建取消按钮，点击时直接关闭对话框
+        cancel_button = ttk.Button(button_frame, text="取消", command=dialog.destroy)
+        cancel_button.pack(side='left', padx=20)
+        
+        # 等待对话框关闭后继续执行
+        # wait_window会阻塞程序执行直到对话框被关闭
+        self.root.wait_window(dialog)
 # 主要功能包括：
 # 1. 获取服务器连接信息
 # 2. 请求并获取已安装的模型列表
-# 3. 创建可视化的删除模型对话框
-# 4. 实现对话框的居中显示
-# 5. 设置模态窗口属性，确保用户完成当前操作
-# 6. 使用ttk主题化组件，提供现代的视觉效果
-# 7. 创建可视化的模型选择界面
-# 8. 提供下拉列表方式选择要删除的模型
-# 9. 实现删除确认的双重验证机制
-# 10. 提供清晰的用户操作反馈
-# 11. 完善的异常处理机制
+# 3. 模型列表中已有多选项时直接进入确认，无需再次选择
+# 4. 否则创建可多选的删除模型对话框
+# 5. 实现对话框的居中显示
+# 6. 设置模态窗口属性，确保用户完成当前操作
+# 7. 所有选中的模型只需确认一次
+# 8. 完善的异常处理机制
 # 整体设计采用模态对话框的方式，确保用户完成当前操作后才能进行其他操作，提高操作的安全性和可靠性。
 
-    # perform_delete_model方法：执行模型删除操作
+    def confirm_delete_models(self, model_names, model_sizes):
+        # 对待删除的模型做一次性确认，并提示删除后可释放的磁盘空间
+        # 优先使用本地存储索引计算真实可回收空间（共享层不会重复计算）
+        freed_text = None
+        try:
+            self.store_index.refresh()
+            if all(name in self.store_index.model_layers for name in model_names):
+                freed_text = f"预计释放磁盘空间: {format_bytes(self.store_index.reclaimable_bytes(model_names))}"
+        except Exception:
+            pass
+        # 无法读取本地模型目录（例如远程服务器）时，退回到/api/tags报告的大小之和
+        if freed_text is None:
+            total = sum(model_sizes.get(name) or 0 for name in model_names)
+            freed_text = f"最多释放磁盘空间: {format_bytes(total)}（共享层可能不会释放）"
+
+        # 确认框中最多列出20个模型名称，避免对话框过长
+        listing = "\n".join(model_names[:20])
+        if len(model_names) > 20:
+            listing += f"\n... 等共 {len(model_names)} 个模型"
+        confirm = messagebox.askyesno("确认删除",
+                                      f"确定要删除以下 {len(model_names)} 个模型吗?\n\n{listing}\n\n{freed_text}")
+        if confirm:
+            self.perform_delete_models(model_names)
+# 批量删除只弹出一次确认框，释放空间的计算依赖ModelStoreIndex，保证与实际磁盘变化一致。
+
+    # perform_delete_model方法：执行单个模型的删除操作
     # 参数：model_name - 要删除的模型名称
-    # 功能：通过Ollama API删除指定的AI模型
+    # 功能：保留原有的调用方式，内部复用批量删除流程
     def perform_delete_model(self, model_name):
+        self.perform_delete_models([model_name])
+
+    def perform_delete_models(self, model_names):
         # 从界面输入框获取Ollama服务器的连接参数
-        # strip()方法去除字符串两端的空白字符
+        # 必须在主线程中读取Tk控件，工作线程只使用这里得到的字符串
         ip = self.ip_entry.get().strip()
         port = self.port_entry.get().strip()
-        
-        # 使用try-except结构处理删除过程中可能出现的异常
-        try:
-            # 获取当前时间
-            current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-            # 在结果文本区域追加删除操作的开始提示（带时间）
-            self.result_text.insert(tk.END, f"\n[{current_time}] 正在删除模型 {model_name}...\n")
-            
-            # 构建Ollama API的删除请求
-            # 使用f-string构建完整的API URL
-            delete_url = f"http://{ip}:{port}/api/delete"
-            # 准备请求数据，包含要删除的模型名称
-            delete_data = {"name": model_name}
-            # 发送DELETE请求到Ollama服务器
-            # json参数将Python字典转换为JSON格式发送
-            delete_response = requests.delete(delete_url, json=delete_data)
-            # 检查响应状态码，如果不是2xx则抛出异常
-            delete_response.raise_for_status()
-            
-            # 获取当前时间（用于完成提示）
-            current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-            # 删除成功后在结果文本区域显示成功消息（带时间）
-            self.result_text.insert(tk.END, f"[{current_time}] 模型 {model_name} 已成功删除!\n")
-            
-            # 更新界面显示
-            # 刷新模型列表树形视图
+        delete_url = f"http://{ip}:{port}/api/delete"
+        # 已建立磁盘索引时，记录每个模型删除后可以释放的独占字节数
+        # 本地模型目录只对应本机服务器，删除远程主机上的模型时字节数记为0
+        freed_bytes = {name: self.store_index.model_usage(name)['unique'] if is_local_host(ip) else 0
+                       for name in model_names}
+
+        # 获取当前时间
+        current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        # 在结果文本区域追加删除操作的开始提示（带时间）
+        self.result_text.insert(tk.END, f"\n[{current_time}] 正在删除 {len(model_names)} 个模型"
+                                        f"（并发数 {self.delete_workers}）...\n")
+        self.result_text.see(tk.END)
+
+        # 工作线程通过队列回传每个模型的删除结果：(模型名称, 错误信息或None)
+        results = queue.Queue()
+
+        def delete_one(model_name):
+            record = self.journal.begin('delete', f"{ip}:{port}", model_name)
+            try:
+                # 发送DELETE请求到Ollama服务器，json参数包含要删除的模型名称
+                delete_response = api.delete(delete_url, json={"name": model_name})
+                # 检查响应状态码，如果不是2xx则抛出异常
+                delete_response.raise_for_status()
+            except Exception as e:
+                record.finish('failed', str(e))
+                raise
+            record.finish('success', done_bytes=freed_bytes[model_name])
+
+        def worker():
+            # 使用有界线程池并发发送删除请求，避免同时向服务器发起过多请求
+            with ThreadPoolExecutor(max_workers=self.delete_workers) as pool:
+                futures = {pool.submit(delete_one, name): name for name in model_names}
+                for future in as_completed(futures):
+                    error = future.exception()
+                    results.put((futures[future], str(error) if error else None))
+            # 放入None表示全部删除请求已完成
+            results.put(None)
+
+        threading.Thread(target=worker, daemon=True).start()
+
+        succeeded = []
+        failed = []
+
+        def poll_results():
+            # 在主线程中定时读取删除结果并更新界面，工作线程不直接操作Tk控件
+            while True:
+                try:
+                    item = results.get_nowait()
+                except queue.Empty:
+                    self.root.after(100, poll_results)
+                    return
+                if item is None:
+                    break
+                model_name, error = item
+                current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+                if error is None:
+                    succeeded.append(model_name)
+                    self.result_text.insert(tk.END, f"[{current_time}] 模型 {model_name} 已成功删除!\n")
+                else:
+                    failed.append(model_name)
+                    self.result_text.insert(tk.END, f"[{current_time}] 删除模型 {model_name} 失败: {error}\n")
+                self.result_text.see(tk.END)
+
+            # 全部完成后只刷新一次模型列表和对话界面的下拉列表
             self.list_models()
-            # 更新对话界面的模型选择下拉列表
             self.refresh_models()
-            
-            # 使用消息框显示删除成功的提示
-            # showinfo创建一个信息类型的消息框
-            messagebox.showinfo("成功", f"模型 {model_name} 已成功删除!")
-            
-        # 异常处理：捕获删除过程中可能出现的所有异常
-        except Exception as e:
-            # 在结果文本区域显示错误信息
-            self.result_text.insert(tk.END, f"错误: {str(e)}\n")
-            # 使用错误消息框显示详细的错误信息
-            messagebox.showerror("错误", f"删除模型失败: {str(e)}")
+
+            # 汇总显示删除结果
+            if failed:
+                messagebox.showerror("错误", f"成功删除 {len(succeeded)} 个模型，"
+                                            f"{len(failed)} 个删除失败:\n" + "\n".join(failed))
+            else:
+                messagebox.showinfo("成功", f"已成功删除 {len(succeeded)} 个模型!")
+
+        self.root.after(100, poll_results)
 # 主要功能包括：
-# 1. 执行实际的模型删除操作
-# 2. 通过HTTP请求与Ollama服务器通信
-# 3. 提供实时的操作反馈
-# 4. 自动更新界面显示
-# 5. 完善的错误处理机制
+# 1. 通过有界线程池并发执行删除请求
+# 2. 通过队列把每个模型的结果回传到主线程并逐条显示
+# 3. 全部删除完成后只刷新一次模型目录，避免每个模型刷新两次
+# 4. 汇总成功和失败的数量，失败项单独列出
 # 设计特点：
-# 1. 使用异步更新确保界面响应性
-# 2. 多重反馈机制（文本区域和消息框）
-# 3. 完整的错误处理和提示
-# 4. 自动刷新相关界面元素
-# 5. 统一的错误提示格式
+# 1. 工作线程不访问Tk控件，界面更新全部在主线程的after回调中完成
+# 2. 删除过程中界面保持响应
+# 3. 单个模型删除失败不会影响其他模型
+
+    def set_models_dir(self):
+        # 弹出输入框让用户设置本地Ollama模型目录（只读访问，仅用于统计磁盘占用）
+        models_dir = simpledialog.askstring("模型目录", "请输入本地Ollama模型目录：",
+                                            initialvalue=self.store_index.models_dir,
+                                            parent=self.root)
+        if models_dir:
+            self.store_index.set_models_dir(models_dir.strip())
+            self.show_disk_usage()
+# 模型目录默认取OLLAMA_MODELS环境变量或~/.ollama/models，切换目录后索引会在下次统计时完整重建。
+
+    def show_disk_usage(self):
+        # 增量刷新本地存储索引，并在结果区域显示每个模型的真实磁盘占用
+        try:
+            changed = self.store_index.refresh()
+        except Exception as e:
+            self.result_text.insert(tk.END, f"错误: {str(e)}\n")
+            messagebox.showerror("错误", f"读取模型目录失败: {str(e)}")
+            return
+
+        current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        self.result_text.insert(tk.END, f"\n[{current_time}] 本地模型磁盘占用（{changed} 个清单有变化）:\n")
+        self.result_text.insert(tk.END, f"{'模型':<40}{'总大小':>12}{'独占':>12}{'共享':>12}\n")
+        for name in sorted(self.store_index.model_layers):
+            usage = self.store_index.model_usage(name)
+            self.result_text.insert(tk.END, f"{name:<40}{format_bytes(usage['total']):>12}"
+                                            f"{format_bytes(usage['unique']):>12}"
+                                            f"{format_bytes(usage['shared']):>12}\n")
+        self.result_text.insert(tk.END, f"实际磁盘占用合计: {format_bytes(self.store_index.disk_usage())}\n")
+
+        # 如果在模型列表中选中了模型，额外显示删除这些模型后可回收的空间
+        selected = [self.model_tree.item(item, 'values')[0] for item in self.model_tree.selection()]
+        if selected:
+            freed = self.store_index.reclaimable_bytes(selected)
+            self.result_text.insert(tk.END, f"删除选中的 {len(selected)} 个模型可回收: {format_bytes(freed)}\n")
+        self.result_text.see(tk.END)
+# 这个方法展示本地存储的统计结果：
+# 1. 独占字节只属于当前模型，删除后一定会被释放
+# 2. 共享字节被多个模型引用，单独删除该模型不会释放
+# 3. 合计值按blob去重统计，与磁盘实际占用一致
+
+    def show_logs(self):
+        # 打开日志窗口，显示内存环形缓冲区中最近的日志，可手动刷新
+        dialog = tk.Toplevel(self.root)
+        dialog.title("运行日志")
+        dialog_width = 1100
+        dialog_height = 650
+        dialog_x = self.root.winfo_x() + (self.root.winfo_width() - dialog_width) // 2
+        dialog_y = self.root.winfo_y() + (self.root.winfo_height() - dialog_height) // 2
+        dialog.geometry(f"{dialog_width}x{dialog_height}+{dialog_x}+{dialog_y}")
+        dialog.transient(self.root)
+
+        # 日志显示区域，使用较小的字体和不换行模式以便查看结构化字段
+        text_frame = ttk.Frame(dialog)
+        text_frame.pack(fill='both', expand=True, padx=10, pady=10)
+        log_scroll_y = ttk.Scrollbar(text_frame)
+        log_scroll_y.pack(side='right', fill='y')
+        log_scroll_x = ttk.Scrollbar(text_frame, orient='horizontal')
+        log_scroll_x.pack(side='bottom', fill='x')
+        log_text = tk.Text(text_frame, wrap='none', font=(self.default_font[0], self.default_font[1]-4),
+                           yscrollcommand=log_scroll_y.set, xscrollcommand=log_scroll_x.set)
+        log_text.pack(fill='both', expand=True)
+        log_scroll_y.config(command=log_text.yview)
+        log_scroll_x.config(command=log_text.xview)
+
+        def refresh():
+            log_text.config(state='normal')
+            log_text.delete('1.0', tk.END)
+            log_text.insert(tk.END, '\n'.join(log_buffer.lines()))
+            log_text.see(tk.END)
+            log_text.config(state='disabled')
+
+        button_frame = ttk.Frame(dialog)
+        button_frame.pack(pady=(0, 10))
+        ttk.Button(button_frame, text='刷新', command=refresh).pack(side='left', padx=20)
+        ttk.Button(button_frame, text='关闭', command=dialog.destroy).pack(side='left', padx=20)
+        refresh()
+# 日志窗口只显示最近2000条记录，完整日志保存在~/.ollama_gui/logs目录下的轮转日志文件中。
+
+    def show_operation_journal(self):
+        # 打开操作记录窗口：按任意列排序查看历史操作，可以导出为CSV
+        entries = self.journal.load()
+        dialog = tk.Toplevel(self.root)
+        dialog.title("操作记录")
+        dialog_width = 1300
+        dialog_height = 650
+        dialog_x = self.root.winfo_x() + (self.root.winfo_width() - dialog_width) // 2
+        dialog_y = self.root.winfo_y() + (self.root.winfo_height() - dialog_height) // 2
+        dialog.geometry(f"{dialog_width}x{dialog_height}+{dialog_x}+{dialog_y}")
+        dialog.transient(self.root)
+
+        content_frame = ttk.Frame(dialog, padding=20)
+        content_frame.pack(fill='both', expand=True)
+
+        # 列定义：(字段名, 列标题, 列宽, 显示格式)
+        columns = [
+            ('time', '时间', 170, str),
+            ('operation', '操作', 70, str),
+            ('host', '主机', 160, str),
+            ('model', '模型', 240, str),
+            ('bytes', '大小', 100, format_bytes),
+            ('duration_s', '耗时', 80, lambda value: f"{value:.1f}s"),
+            ('avg_bps', '平均速度', 110, lambda value: f"{format_bytes(value)}/s" if value is not None else '-'),
+            ('peak_bps', '峰值速度', 110, lambda value: f"{format_bytes(value)}/s" if value is not None else '-'),
+            ('retries', '重试', 50, str),
+            ('outcome', '结果', 70, lambda value: '成功' if value == 'success' else '失败'),
+        ]
+        tree_frame = ttk.Frame(content_frame)
+        tree_frame.pack(fill='both', expand=True)
+        tree = ttk.Treeview(tree_frame, columns=[key for key, *_rest in columns], show='headings')
+        tree_scroll = ttk.Scrollbar(tree_frame, orient='vertical', command=tree.yview)
+        tree.configure(yscrollcommand=tree_scroll.set)
+        tree_scroll.pack(side='right', fill='y')
+        tree.pack(side='left', fill='both', expand=True)
+        # 当前排序列和方向，默认按时间倒序
+        sort_state = {'key': 'time', 'reverse': True}
+
+        def fill():
+            # 按当前排序方式重新填充列表，数值列按数值排序
+            key = sort_state['key']
+            ordered = sorted(entries, key=lambda entry: (entry.get(key) is None, entry.get(key) or 0)
+                             if key in ('bytes', 'duration_s', 'avg_bps', 'peak_bps', 'retries')
+                             else str(entry.get(key, '')), reverse=sort_state['reverse'])
+            tree.delete(*tree.get_children())
+            for entry in ordered:
+                tree.insert('', 'end', values=[fmt(entry.get(field, 0 if fmt is not str else ''))
+                                               for field, _title, _width, fmt in columns])
+
+        def sort_by(key):
+            # 点击同一列标题时切换升序和降序
+            sort_state['reverse'] = not sort_state['reverse'] if sort_state['key'] == key else True
+            sort_state['key'] = key
+            fill()
+
+        for key, title, width, _fmt in columns:
+            tree.heading(key, text=title, command=lambda key=key: sort_by(key))
+            tree.column(key, width=width, anchor='e' if key in ('bytes', 'duration_s', 'avg_bps',
+                                                                 'peak_bps', 'retries') else 'w')
+        fill()
+
+        def export_csv():
+            path = filedialog.asksaveasfilename(parent=dialog, title="导出操作记录", defaultextension=".csv",
+                                                initialfile=f"operations_{time.strftime('%Y%m%d')}.csv",
+                                                filetypes=[("CSV文件", "*.csv")])
+            if not path:
+                return
+            try:
+                count = self.journal.export_csv(path)
+            except OSError as e:
+                messagebox.showerror("错误", f"导出失败: {str(e)}", parent=dialog)
+                return
+            messagebox.showinfo("完成", f"已导出 {count} 条记录到:\n{path}", parent=dialog)
+
+        button_frame = ttk.Frame(content_frame)
+        button_frame.pack(fill='x', pady=(10, 0))
+        ttk.Label(button_frame, text=f"共 {len(entries)} 条记录，日志文件: {self.journal.path}").pack(side='left')
+        ttk.Button(button_frame, text='导出CSV', command=export_csv).pack(side='right')
+# 操作记录窗口只读取日志文件，不会阻塞正在进行的操作；CSV导出包含全部历史记录（包括失败原因），
+# 可以按主机和模型统计拉取速度，回答“上周在某台主机上拉取某个模型花了多久”这类问题。
+
+    def open_load_test(self):
+        # 打开负载测试窗口：设置并发级别和请求参数，依次测试后生成报告
+        dialog = tk.Toplevel(self.root)
+        dialog.title("负载测试")
+        dialog_width = 1100
+        dialog_height = 700
+        dialog_x = self.root.winfo_x() + (self.root.winfo_width() - dialog_width) // 2
+        dialog_y = self.root.winfo_y() + (self.root.winfo_height() - dialog_height) // 2
+        dialog.geometry(f"{dialog_width}x{dialog_height}+{dialog_x}+{dialog_y}")
+        dialog.transient(self.root)
+
+        content_frame = ttk.Frame(dialog, padding=20)
+        content_frame.pack(fill='both', expand=True)
+
+        # 测试参数：字段名、说明、默认值
+        settings_frame = ttk.Frame(content_frame)
+        settings_frame.pack(fill='x')
+        fields = [
+            ('model', '模型', self.get_selected_model()),
+            ('levels', '并发级别', '1,2,4,8'),
+            ('requests', '每会话请求数', '3'),
+            ('prompt_tokens', '提示词tokens', '256'),
+            ('answer_tokens', '回答tokens', '128'),
+            ('think_time', '思考时间(秒)', '0'),
+        ]
+        entries = {}
+        for index, (key, label, default) in enumerate(fields):
+            ttk.Label(settings_frame, text=label + ':').grid(row=index // 3, column=(index % 3) * 2,
+                                                            padx=5, pady=5, sticky='e')
+            entry = ttk.Entry(settings_frame, width=20 if key == 'model' else 10)
+            entry.insert(0, default)
+            entry.grid(row=index // 3, column=(index % 3) * 2 + 1, padx=5, pady=5, sticky='w')
+            entries[key] = entry
+
+        button_frame = ttk.Frame(content_frame)
+        button_frame.pack(fill='x', pady=10)
+        progress_label = ttk.Label(button_frame, text='')
+        progress_label.pack(side='left')
+
+        result_text = tk.Text(content_frame, wrap='none', font=(self.default_font[0], self.default_font[1] - 6))
+        result_text.pack(fill='both', expand=True)
+        state = {'tester': None}
+
+        def append(text):
+            if dialog.winfo_exists():
+                result_text.insert(tk.END, text + '\n')
+                result_text.see(tk.END)
+
+        def on_start():
+            # 读取并校验参数，在后台线程中依次测试各并发级别
+            try:
+                levels = [int(value) for value in entries['levels'].get().replace('，', ',').split(',') if value.strip()]
+                requests_per_session = int(entries['requests'].get())
+                prompt_tokens = int(entries['prompt_tokens'].get())
+                answer_tokens = int(entries['answer_tokens'].get())
+                think_time = float(entries['think_time'].get())
+                if not levels or min(levels) < 1 or requests_per_session < 1:
+                    raise ValueError("并发级别和每会话请求数必须为正整数")
+            except ValueError as e:
+                messagebox.showerror("错误", f"参数无效: {str(e)}", parent=dialog)
+                return
+            ip = self.ip_entry.get().strip()
+            port = self.port_entry.get().strip()
+            tester = LoadTester(f"http://{ip}:{port}", entries['model'].get().strip(), prompt_tokens,
+                                answer_tokens, think_time, requests_per_session)
+            state['tester'] = tester
+            start_button.config(state='disabled')
+            stop_button.config(state='normal')
+            append(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] 开始测试 {tester.base_url} {tester.model}，"
+                   f"并发级别 {levels}")
+
+            def progress(done, total):
+                self.run_on_main(lambda: dialog.winfo_exists() and progress_label.config(
+                    text=f"当前级别进度: {done}/{total}"))
+
+            def on_level(summary):
+                text = LoadTester.format_summary(summary)
+                if summary['sample_errors']:
+                    text += f"\n    错误示例: {summary['sample_errors'][0]}"
+                self.run_on_main(lambda: append(text))
+
+            def worker():
+                summaries = tester.sweep(levels, on_level, progress)
+                report_path = tester.write_report(summaries) if summaries else None
+                self.run_on_main(lambda: finish(tester, summaries, report_path))
+
+            threading.Thread(target=worker, daemon=True).start()
+
+        def finish(tester, summaries, report_path):
+            if not dialog.winfo_exists():
+                return
+            start_button.config(state='normal')
+            stop_button.config(state='disabled')
+            progress_label.config(text='已停止' if tester.cancel.is_set() else '测试完成')
+            if not summaries:
+                return
+            knee, saturated = LoadTester.find_knee(summaries)
+            if saturated:
+                append(f"饱和拐点: 并发 {knee}（继续增加并发后总吞吐量提升不足"
+                       f"{LoadTester.KNEE_GAIN * 100:.0f}%，只会增加首token等待时间）")
+            else:
+                append(f"在测试范围内总吞吐量仍在增长，最高测试并发 {knee}，可以尝试更高的并发级别")
+            append(f"报告已保存: {report_path}\n")
+
+        def on_stop():
+            if state['tester']:
+                state['tester'].cancel.set()
+                progress_label.config(text='正在停止（等待当前请求结束）...')
+
+        def on_close():
+            on_stop()
+            dialog.destroy()
+
+        start_button = ttk.Button(button_frame, text='开始测试', command=on_start)
+        start_button.pack(side='right', padx=5)
+        stop_button = ttk.Button(button_frame, text='停止', command=on_stop, state='disabled')
+        stop_button.pack(side='right', padx=5)
+        dialog.protocol("WM_DELETE_WINDOW", on_close)
+# 负载测试在后台线程中运行，每完成一个并发级别立即显示结果；关闭窗口会在当前请求结束后停止测试。
+# 报告保存在~/.ollama_gui/loadtest目录中，用于比较不同主机或不同OLLAMA_NUM_PARALLEL设置的表现。
+
+    def open_diagnostics(self):
+        # 打开诊断窗口：开关诊断模式、查看事件循环延迟和最严重的卡顿、记录性能分析数据
+        dialog = tk.Toplevel(self.root)
+        dialog.title("诊断")
+        dialog_width = 1000
+        dialog_height = 700
+        dialog_x = self.root.winfo_x() + (self.root.winfo_width() - dialog_width) // 2
+        dialog_y = self.root.winfo_y() + (self.root.winfo_height() - dialog_height) // 2
+        dialog.geometry(f"{dialog_width}x{dialog_height}+{dialog_x}+{dialog_y}")
+        dialog.transient(self.root)
+
+        content_frame = ttk.Frame(dialog, padding=20)
+        content_frame.pack(fill='both', expand=True)
+
+        # 第一行：诊断模式开关和性能分析按钮
+        top_frame = ttk.Frame(content_frame)
+        top_frame.pack(fill='x')
+        monitor_var = tk.BooleanVar(value=self.loop_monitor.running)
+
+        def on_toggle_monitor():
+            if monitor_var.get():
+                self.loop_monitor.start()
+            else:
+                self.loop_monitor.stop()
+
+        ttk.Checkbutton(top_frame, text='诊断模式（监测事件循环延迟）', variable=monitor_var,
+                        command=on_toggle_monitor).pack(side='left')
+
+        def on_toggle_profiling():
+            if self.loop_monitor.profiler is None:
+                self.loop_monitor.start_profiling()
+                profile_button.config(text='停止并保存分析')
+                return
+            try:
+                prof_path, mem_path = self.loop_monitor.stop_profiling()
+            except Exception as e:
+                messagebox.showerror("错误", f"保存性能分析失败: {str(e)}", parent=dialog)
+                return
+            profile_button.config(text='开始性能分析')
+            messagebox.showinfo("完成", f"性能分析已保存:\n{prof_path}\n{mem_path}", parent=dialog)
+
+        profile_button = ttk.Button(top_frame, command=on_toggle_profiling,
+                                    text='开始性能分析' if self.loop_monitor.profiler is None else '停止并保存分析')
+        profile_button.pack(side='right')
+
+        # 第二行：延迟分位数
+        lag_label = ttk.Label(content_frame, text='')
+        lag_label.pack(anchor='w', pady=10)
+
+        # 卡顿列表：按时长排序，显示发生时间、来源和时长
+        stall_tree = ttk.Treeview(content_frame, columns=('时间', '来源', '时长'), show='headings', height=7)
+        for column, width in (('时间', 250), ('来源', 400), ('时长', 200)):
+            stall_tree.heading(column, text=column)
+            stall_tree.column(column, width=width, anchor='e' if column == '时长' else 'w')
+        stall_tree.pack(fill='x')
+
+        # 选中卡顿记录后显示当时主线程的调用栈
+        stack_text = tk.Text(content_frame, height=10, wrap='none',
+                             font=(self.default_font[0], self.default_font[1]-6))
+        stack_text.pack(fill='both', expand=True, pady=10)
+        shown_stalls = []
+
+        def on_select_stall(event):
+            selection = stall_tree.selection()
+            if selection:
+                stack_text.delete('1.0', tk.END)
+                stack_text.insert(tk.END, shown_stalls[stall_tree.index(selection[0])]['stack'])
+
+        stall_tree.bind('<<TreeviewSelect>>', on_select_stall)
+
+        def refresh():
+            # 每秒刷新一次统计数据，对话框关闭后停止
+            if not dialog.winfo_exists():
+                return
+            lag = self.loop_monitor.lag_percentiles()
+            if lag:
+                lag_label.config(text=f"事件循环延迟: p50 {lag['p50']:.1f}ms | p95 {lag['p95']:.1f}ms | "
+                                      f"p99 {lag['p99']:.1f}ms | 最大 {lag['max']:.1f}ms")
+            else:
+                lag_label.config(text='诊断模式未开启或尚无数据')
+            stalls = self.loop_monitor.worst_stalls()
+            if stalls != shown_stalls:
+                shown_stalls[:] = stalls
+                stall_tree.delete(*stall_tree.get_children())
+                for stall in stalls:
+                    stall_tree.insert('', 'end', values=(
+                        time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(stall['wall_time'])),
+                        stall['origin'], f"{stall['duration'] * 1000:.0f}ms"))
+            dialog.after(1000, refresh)
+
+        refresh()
+# 诊断窗口不设置模态，可以一边操作一边观察卡顿记录；卡顿同时会写入日志，便于事后分析。
+
 
-    
     # show_version_in_chat方法：显示Ollama服务器版本信息的对话框界面
     # 功能：获取并展示Ollama服务器的版本信息和配置详情
     def show_version_in_chat(self):
@@ -1140,7 +5187,7 @@ class OllamaGUI:
             # 使用f-string动态生成API地址
             url = f"http://{ip}:{port}/api/version"
             # 发送HTTP GET请求获取版本信息
-            response = requests.get(url)
+            response = api.get(url)
             # 检查响应状态码，非2xx状态会抛出异常
             response.raise_for_status()
             
@@ -1256,6 +5303,167 @@ class OllamaGUI:
 # 5. 适合作为GUI程序的标准退出方式
 
 
+    def edit_model_options(self):
+        # 打开当前模型的生成参数编辑对话框
+        model = self.get_selected_model()
+        profile, options = self.options_profiles.profile_for(model)
+
+        dialog = tk.Toplevel(self.root)
+        dialog.title(f"生成参数 - {model}")
+        
+        # 计算对话框在主窗口中的居中位置
+        dialog_width = 560
+        dialog_height = 630
+        dialog_x = self.root.winfo_x() + (self.root.winfo_width() - dialog_width) // 2
+        dialog_y = self.root.winfo_y() + (self.root.winfo_height() - dialog_height) // 2
+        dialog.geometry(f"{dialog_width}x{dialog_height}+{dialog_x}+{dialog_y}")
+        dialog.transient(self.root)
+        dialog.grab_set()
+
+        content_frame = ttk.Frame(dialog, padding=20)
+        content_frame.pack(fill='both', expand=True)
+
+        # 预设选择：选择预设后自动填充下方的参数输入框
+        ttk.Label(content_frame, text='预设:').grid(row=0, column=0, padx=(0,5), pady=5, sticky='e')
+        profile_var = tk.StringVar(value=profile)
+        profile_combobox = ttk.Combobox(content_frame, textvariable=profile_var, width=20,
+                                        values=list(OptionsProfileStore.PRESETS) + ['自定义'],
+                                        state='readonly', font=("TkDefaultFont", 16))
+        profile_combobox.grid(row=0, column=1, padx=5, pady=5, sticky='w')
+
+        # 为每个参数创建输入框，留空表示使用服务器默认值
+        entries = {}
+        for row, (key, label_text) in enumerate(OptionsProfileStore.OPTION_FIELDS, start=1):
+            ttk.Label(content_frame, text=f'{label_text} ({key}):').grid(row=row, column=0, padx=(0,5), pady=5, sticky='e')
+            entry = ttk.Entry(content_frame, width=12, font=("TkDefaultFont", 16))
+            entry.insert(0, str(options.get(key, '')))
+            entry.grid(row=row, column=1, padx=5, pady=5, sticky='w')
+            entries[key] = entry
+
+        # 思考模式：推理模型可以关闭思考以降低延迟，或开启后单独显示思考过程
+        think_row = len(entries) + 1
+        ttk.Label(content_frame, text='思考模式 (think):').grid(row=think_row, column=0, padx=(0,5), pady=5, sticky='e')
+        think_var = tk.StringVar(value=next(name for name, value in OptionsProfileStore.THINK_MODES.items()
+                                            if value == self.options_profiles.think_for(model)))
+        ttk.Combobox(content_frame, textvariable=think_var, width=16, values=list(OptionsProfileStore.THINK_MODES),
+                     state='readonly', font=("TkDefaultFont", 16)).grid(row=think_row, column=1, padx=5, pady=5, sticky='w')
+
+        def on_preset_selected(event):
+            # 选择内置预设时用预设值覆盖输入框内容
+            preset = OptionsProfileStore.PRESETS.get(profile_var.get())
+            if preset is None:
+                return
+            for key, entry in entries.items():
+                entry.delete(0, tk.END)
+                entry.insert(0, str(preset.get(key, '')))
+
+        profile_combobox.bind('<<ComboboxSelected>>', on_preset_selected)
+
+        # 显示该模型最近一次生成的服务器耗时，便于比较不同配置的效果
+        stats = self.options_profiles.last_stats.get(model)
+        stats_text = OptionsProfileStore.format_stats(stats) if stats else '尚无该模型的生成耗时记录'
+        ttk.Label(content_frame, text=stats_text, wraplength=500, foreground='#555555',
+                  font=(self.default_font[0], self.default_font[1]-4)).grid(
+            row=len(entries) + 2, column=0, columnspan=2, pady=(10, 5), sticky='w')
+
+        def on_save():
+            # 校验输入必须为数值（temperature为小数，其余为整数），然后保存配置
+            values = {}
+            for key, entry in entries.items():
+                value = entry.get().strip()
+                if value:
+                    try:
+                        OptionsProfileStore.parse_option(key, value)
+                    except ValueError:
+                        messagebox.showwarning("警告", f"{key} 格式不正确！", parent=dialog)
+                        return
+                values[key] = value
+            # 手动修改过参数值时，将预设名称标记为“自定义”
+            name = profile_var.get()
+            preset = OptionsProfileStore.PRESETS.get(name)
+            if preset is not None and {k: v for k, v in values.items() if v} != {k: str(v) for k, v in preset.items()}:
+                name = '自定义'
+            try:
+                self.options_profiles.set_profile(model, name, values, OptionsProfileStore.THINK_MODES[think_var.get()])
+            except Exception as e:
+                messagebox.showerror("错误", f"保存生成参数失败: {str(e)}", parent=dialog)
+                return
+            dialog.destroy()
+
+        button_frame = ttk.Frame(content_frame)
+        button_frame.grid(row=len(entries) + 3, column=0, columnspan=2, pady=15)
+        ttk.Button(button_frame, text='保存', command=on_save).pack(side='left', padx=20)
+        ttk.Button(button_frame, text='取消', command=dialog.destroy).pack(side='left', padx=20)
+
+        self.root.wait_window(dialog)
+# 这个方法提供按模型编辑生成参数的界面：
+# 1. 内置预设可一键填充，修改后自动标记为“自定义”
+# 2. 留空的参数不会发送给服务器，保持服务器默认行为
+# 3. 显示最近一次生成的加载/提示词评估/生成耗时，用于验证配置效果
+
+    def attach_images(self):
+        # 选择一个或多个图片文件作为下一条消息的附件
+        paths = filedialog.askopenfilenames(parent=self.root, title="选择图片", filetypes=ImageEncoder.FILE_TYPES)
+        for path in paths:
+            self.pending_images.append((os.path.basename(path), path))
+        self.refresh_attachments()
+
+    def handle_paste(self, event):
+        # 剪贴板中有图片（或复制的图片文件）时作为附件添加，否则交给默认的文本粘贴处理
+        sources = ImageEncoder.grab_clipboard()
+        if not sources:
+            return None
+        for source in sources:
+            name = os.path.basename(source) if isinstance(source, str) else f"剪贴板图片{len(self.pending_images) + 1}.png"
+            self.pending_images.append((name, source))
+        self.refresh_attachments()
+        return "break"
+
+    def attach_document(self):
+        # 选择一个文本文件作为文档附件，在后台线程中流式估算token数
+        path = filedialog.askopenfilename(parent=self.root, title="选择文档",
+                                          filetypes=[("文本文件", "*.txt *.md *.log *.csv *.json"), ("所有文件", "*.*")])
+        if not path:
+            return
+        document = {'path': path, 'name': os.path.basename(path), 'tokens': None}
+        self.pending_document = document
+        self.refresh_attachments()
+
+        def worker():
+            try:
+                document['tokens'] = DocumentAttachment.estimate_file(path)
+            except Exception as e:
+                logger.warning(f"估算文档token数失败: {str(e)}")
+            self.run_on_main(self.refresh_attachments)
+
+        threading.Thread(target=worker, daemon=True).start()
+
+    def clear_attachments(self):
+        # 清空等待发送的图片和文档附件
+        self.pending_images = []
+        self.pending_document = None
+        self.refresh_attachments()
+
+    def refresh_attachments(self):
+        # 在附件栏显示等待发送的图片和文档
+        texts = []
+        names = [name for name, _source in self.pending_images]
+        if names:
+            texts.append(f"待发送图片({len(names)}): {', '.join(names)}")
+        if self.pending_document:
+            document = self.pending_document
+            tokens = '估算中...' if document['tokens'] is None else f"约 {document['tokens']} tokens"
+            texts.append(f"文档: {document['name']} ({format_bytes(os.path.getsize(document['path']))}, {tokens})")
+        self.attach_label.config(text='  '.join(texts))
+
+    def on_image_side_changed(self):
+        # 修改图片最大边长，之后发送的图片按新尺寸缩放（缓存键包含尺寸，旧结果不会被误用）
+        try:
+            self.image_encoder.max_side = max(0, int(self.image_side_var.get()))
+        except ValueError:
+            pass
+# 附件只在主线程中记录来源，不读取也不解码图片，真正的处理在生成线程中完成。
+
     def handle_enter(self, event):
         """
         处理用户在输入框中按下回车键的事件
@@ -1313,240 +5521,1619 @@ class OllamaGUI:
         return model  # 返回用户选择的模型名称
 # 是模型选择功能的核心部分，它确保在与Ollama API通信时始终使用有效的模型名称，即使用户未明确选择模型也能提供默认值“gemma3:27b”模型，增强程序的健壮性。
     
+    def new_session(self, title=None, model=None):
+        # 新建一个会话标签页，默认使用当前选择的模型
+        self.session_counter += 1
+        frame = ttk.Frame(self.session_notebook)
+        chat_scroll = ttk.Scrollbar(frame)
+        chat_scroll.pack(side='right', fill='y')
+        # 聊天文本框初始化为禁用状态，防止用户直接编辑
+        text = tk.Text(frame, height=15, font=self.default_font,
+                       state='disabled', yscrollcommand=chat_scroll.set)
+        text.pack(fill='both', expand=True)
+        chat_scroll.config(command=text.yview)
+        # 配置Markdown渲染使用的文本标签
+        MarkdownStreamRenderer.configure_tags(text, self.default_font)
+        session = ChatSession(self.session_counter, title or f"会话{self.session_counter}",
+                              model or self.get_selected_model(), frame, text)
+        self.sessions.append(session)
+        self.session_notebook.add(frame, text=session.tab_text())
+        self.session_notebook.select(frame)
+        self.activate_session(session)
+        return session
+
+    def restore_sessions(self):
+        # 从快照目录恢复会话，按创建顺序打开标签页；返回恢复的会话数量
+        started = time.perf_counter()
+        paths = sorted(os.path.join(self.session_dir, name) for name in os.listdir(self.session_dir)
+                       if name.endswith('.json')) if os.path.isdir(self.session_dir) else []
+        restored = 0
+        for path in paths:
+            meta = load_json_file(path, None)
+            if not meta or meta.get('version') != 1:
+                continue
+            meta['path'] = path
+            session = self.new_session(meta['title'], meta['model'])
+            try:
+                session.load_snapshot(meta)
+            except (OSError, ValueError, KeyError, IndexError) as e:
+                # 快照损坏时关闭这个标签页，不影响其他会话
+                logger.warning(f"恢复会话快照失败 {path}: {str(e)}")
+                self.sessions.remove(session)
+                self.session_notebook.forget(session.frame)
+                session.frame.destroy()
+                continue
+            # 快照保存时的生成参数与当前不同时记录日志；当前num_ctx放不下的上下文不再使用
+            options = self.options_profiles.options_for(session.model)
+            if meta.get('options') != options:
+                logger.info(f"会话 {session.title} 保存时的生成参数与当前设置不同: {meta.get('options')}")
+            if options.get('num_ctx'):
+                dropped = session.drop_contexts_longer_than(options['num_ctx'])
+                if dropped:
+                    logger.info(f"会话 {session.title} 有 {dropped} 个节点的上下文超过 num_ctx={options['num_ctx']}，"
+                                f"继续提问时改为发送对话记录")
+            self.switch_branch(session, session.head, save=False)
+            restored += 1
+        if restored:
+            self.activate_session(self.sessions[-1])
+            logger.info("sessions_restored", extra={'fields': {
+                'sessions': restored, 'elapsed_ms': round((time.perf_counter() - started) * 1000, 1)}})
+        return restored
+
+    def save_session_snapshot(self, session):
+        """
+        保存会话快照（对话树、上下文、模型digest和生成参数）
+
+        主线程只收集数据，写入磁盘在后台线程中进行，长会话每轮结束时界面不会停顿。
+        同一会话在写入完成前再次保存时只保留最新的一份，关闭会话时的删除也经过同一个线程，
+        保证删除不会被之前排队的写入覆盖。
+        """
+        if session.closed or not session.nodes:
+            return
+        state = session.snapshot_state(self.model_digests.get(session.model),
+                                       self.options_profiles.options_for(session.model),
+                                       self.options_profiles.think_for(session.model))
+        self.queue_snapshot_task(session, state)
+
+    def queue_snapshot_task(self, session, state):
+        # 登记会话的快照任务（state为None表示删除快照），需要时启动写入线程
+        with self.snapshot_lock:
+            self.snapshot_tasks[session.key] = (session, state)
+            if self.snapshot_thread is None:
+                # 非守护线程：程序退出时会等待已经登记的快照写完
+                self.snapshot_thread = threading.Thread(target=self.snapshot_worker)
+                self.snapshot_thread.start()
+
+    def snapshot_worker(self):
+        # 依次写入或删除登记的快照，直到没有新的任务，失败只记录日志
+        while True:
+            with self.snapshot_lock:
+                if not self.snapshot_tasks:
+                    self.snapshot_thread = None
+                    return
+                key = next(iter(self.snapshot_tasks))
+                session, state = self.snapshot_tasks.pop(key)
+            try:
+                if state is None:
+                    session.delete_snapshot(self.session_dir)
+                else:
+                    ChatSession.write_snapshot(self.session_dir, *state)
+            except OSError as e:
+                logger.warning(f"{'删除' if state is None else '保存'}会话快照失败: {str(e)}")
+
+    def session_jobs(self, session):
+        # 返回属于指定会话的生成中和排队中的任务
+        return ([job for job in self.active_generations.values() if job['session'] is session],
+                [job for job in self.pending_prompts if job['session'] is session])
+
+    def close_session(self):
+        # 关闭当前会话：取消它的全部任务并移除标签页，至少保留一个会话
+        session = self.current_session
+        if len(self.sessions) <= 1:
+            messagebox.showinfo("提示", "至少需要保留一个会话")
+            return
+        active, pending = self.session_jobs(session)
+        if (active or pending) and not messagebox.askyesno(
+                "确认", f"{session.title} 还有 {len(active) + len(pending)} 条消息未完成，确定要关闭吗？"):
+            return
+        if not (active or pending) and session.nodes and not messagebox.askyesno(
+                "确认", f"关闭后 {session.title} 保存的对话将被删除，下次启动不再恢复，确定要关闭吗？"):
+            return
+        # 排队中的任务直接移除，生成中的任务通知后台线程停止，之后到达的事件会被丢弃
+        for job in pending:
+            self.pending_prompts.remove(job)
+        for job in active:
+            job['cancel'].set()
+        session.closed = True
+        # 关闭的会话不再恢复，删除它的快照（排在之前登记的写入之后）
+        self.queue_snapshot_task(session, None)
+        self.sessions.remove(session)
+        self.session_notebook.forget(session.frame)
+        session.frame.destroy()
+        self.refresh_queue_view()
+
+    def on_session_changed(self, event=None):
+        # 切换标签页时切换当前会话
+        selected = self.session_notebook.select()
+        for session in self.sessions:
+            if str(session.frame) == selected:
+                self.activate_session(session)
+                return
+
+    def activate_session(self, session):
+        # 将会话设为当前会话：同步模型下拉框，并把后台期间缓冲的片段一次性渲染
+        self.current_session = session
+        self.model_combobox.set(session.model)
+        if session.unread:
+            session.unread = False
+            self.session_notebook.tab(session.frame, text=session.tab_text())
+        for job in self.session_jobs(session)[0]:
+            self.flush_job_buffer(job)
+        session.text.see(tk.END)
+
+    def on_session_model_changed(self, event=None):
+        # 下拉框中选择的模型只作用于当前会话
+        session = self.current_session
+        if session is None:
+            return
+        session.model = self.get_selected_model()
+        self.session_notebook.tab(session.frame, text=session.tab_text())
+
+    def flush_job_buffer(self, job):
+        # 将任务在后台期间缓冲的片段一次性交给渲染器
+        if job['buffer']:
+            text = ''.join(job['buffer'])
+            job['buffer'].clear()
+            job['renderer'].feed(text)
+# 后台会话的片段只追加到列表中，不触发文本控件的插入和重绘；
+# 切换到该会话时合并为一次渲染，多个会话同时生成时界面开销只取决于前台会话。
+
+    def regenerate_answer(self):
+        # 重新生成当前节点的回答，原回答作为另一个分支保留
+        session = self.current_session
+        if session.head is None:
+            messagebox.showinfo("提示", "当前会话还没有可以重新生成的回答")
+            return
+        self.branch_from(session, session.head, session.nodes[session.head]['user'])
+
+    def branch_from(self, session, node_id, prompt):
+        """
+        以指定节点的父节点为起点重新提问，生成的回答成为该节点的兄弟分支
+
+        - 发送父节点保存的上下文，服务器只需计算新的提问，不必重新计算整个对话
+        - 只重新发送提问文字，原提问附带的图片和文档不会再次发送
+        """
+        active, pending = self.session_jobs(session)
+        if active or pending:
+            messagebox.showinfo("提示", "请等待当前会话的回答完成后再创建分支")
+            return False
+        parent = session.nodes[node_id]['parent']
+        self.switch_branch(session, parent)
+        job = self.create_job(session, prompt)
+        job['parent'] = parent
+        self.pending_prompts.append(job)
+        self.schedule_prompts()
+        return True
+
+    def switch_branch(self, session, node_id, save=True):
+        # 切换到对话树的指定节点，并重新显示从第一轮到该节点的对话
+        session.head = node_id
+        # 对话前缀改变，之前的预填充结果不再有效
+        session.prefill_text = None
+        session.turn += 1
+        text_widget = session.text
+        text_widget.config(state='normal')
+        text_widget.delete('1.0', tk.END)
+        # 思考过程区域随文本一起删除，重新显示时只包含最终回答
+        for section in session.thinking_sections.values():
+            text_widget.mark_unset(section['start'], section['end'])
+        session.thinking_sections.clear()
+        for node in session.path(node_id):
+            text_widget.insert(tk.END, f"\n[{node['time']}]\n你: {node['user']}\n\nAI: \n\n")
+            # 与生成时相同，在“AI: ”之后的位置按Markdown渲染回答
+            text_widget.mark_set('replay', 'end-3c')
+            text_widget.mark_gravity('replay', 'right')
+            renderer = MarkdownStreamRenderer(text_widget, 'replay')
+            renderer.feed(node['ai'])
+            renderer.finish()
+            text_widget.config(state='normal')
+        text_widget.mark_unset('replay')
+        text_widget.config(state='disabled')
+        text_widget.see(tk.END)
+        session.trim()
+        if save:
+            self.save_session_snapshot(session)
+
+    def show_conversation_tree(self):
+        # 显示当前会话的对话树，可以切换分支、重新生成或修改任意一轮的提问
+        session = self.current_session
+        if not session.nodes:
+            messagebox.showinfo("提示", "当前会话还没有对话")
+            return
+        dialog = tk.Toplevel(self.root)
+        dialog.title(f"对话树 - {session.title}")
+        dialog_width = 900
+        dialog_height = 500
+        dialog_x = self.root.winfo_x() + (self.root.winfo_width() - dialog_width) // 2
+        dialog_y = self.root.winfo_y() + (self.root.winfo_height() - dialog_height) // 2
+        dialog.geometry(f"{dialog_width}x{dialog_height}+{dialog_x}+{dialog_y}")
+        dialog.transient(self.root)
+
+        content_frame = ttk.Frame(dialog, padding=10)
+        content_frame.pack(fill='both', expand=True)
+        tree_frame = ttk.Frame(content_frame)
+        tree_frame.pack(fill='both', expand=True)
+        tree_scroll = ttk.Scrollbar(tree_frame, orient='vertical')
+        tree_scroll.pack(side='right', fill='y')
+        tree = ttk.Treeview(tree_frame, columns=('ai', 'time', 'context'), yscrollcommand=tree_scroll.set)
+        tree.pack(fill='both', expand=True)
+        tree_scroll.config(command=tree.yview)
+        tree.heading('#0', text='提问')
+        tree.heading('ai', text='回答')
+        tree.heading('time', text='时间')
+        tree.heading('context', text='上下文')
+        tree.column('#0', width=300)
+        tree.column('ai', width=340)
+        tree.column('time', width=150)
+        tree.column('context', width=80, anchor='e')
+
+        def short(text):
+            text = text.replace('\n', ' ')
+            return text[:40] + '...' if len(text) > 40 else text
+
+        def populate():
+            tree.delete(*tree.get_children())
+            # 当前分支上的节点用圆点标出
+            current = {node['id'] for node in session.path(session.head)}
+            for node_id in sorted(session.nodes):
+                node = session.nodes[node_id]
+                parent_item = str(node['parent']) if node['parent'] is not None else ''
+                context = f"{len(node['context'])} tok" if node['context'] is not None else '-'
+                tree.insert(parent_item, 'end', iid=str(node_id), open=True,
+                            text=f"{'● ' if node_id in current else ''}{short(node['user'])}",
+                            values=(short(node['ai']), node['time'], context))
+            if session.head is not None:
+                tree.selection_set(str(session.head))
+                tree.see(str(session.head))
+
+        def selected_node():
+            selection = tree.selection()
+            if not selection:
+                messagebox.showinfo("提示", "请先选择一轮对话", parent=dialog)
+                return None
+            if int(selection[0]) not in session.nodes:
+                # 对话框打开期间该分支因节点数超过上限被删除
+                messagebox.showinfo("提示", "这一轮对话所在的旧分支已被清理", parent=dialog)
+                populate()
+                return None
+            return int(selection[0])
+
+        def switch_to():
+            node_id = selected_node()
+            if node_id is None:
+                return
+            active, pending = self.session_jobs(session)
+            if active or pending:
+                messagebox.showinfo("提示", "请等待当前会话的回答完成后再切换分支", parent=dialog)
+                return
+            self.switch_branch(session, node_id)
+            populate()
+
+        def regenerate():
+            node_id = selected_node()
+            if node_id is not None and self.branch_from(session, node_id, session.nodes[node_id]['user']):
+                dialog.destroy()
+
+        def edit_prompt():
+            node_id = selected_node()
+            if node_id is None:
+                return
+            prompt = simpledialog.askstring("修改提问", "修改后的提问（原对话作为另一个分支保留）:",
+                                            initialvalue=session.nodes[node_id]['user'], parent=dialog)
+            if prompt and prompt.strip() and self.branch_from(session, node_id, prompt.strip()):
+                dialog.destroy()
+
+        button_frame = ttk.Frame(content_frame)
+        button_frame.pack(fill='x', pady=(10, 0))
+        ttk.Button(button_frame, text='切换到此分支', command=switch_to).pack(side='left', padx=5)
+        ttk.Button(button_frame, text='重新生成', command=regenerate).pack(side='left', padx=5)
+        ttk.Button(button_frame, text='修改提问', command=edit_prompt).pack(side='left', padx=5)
+        ttk.Button(button_frame, text='关闭', command=dialog.destroy).pack(side='right', padx=5)
+        tree.bind('<Double-1>', lambda event: switch_to())
+        populate()
+# 对话树中每个节点都保存了到这一轮为止的上下文，切换分支、重新生成或修改提问时直接从对应节点继续，
+# 服务器只需计算新增的提问；上下文被释放或回答包含思考内容的节点改为发送该分支的对话记录。
+
     def send_message(self):
         """
-        发送用户消息到Ollama模型并处理AI回复的核心方法
+        将用户输入的消息加入提交队列
+
         功能概述：
-        - 获取用户输入的消息并发送到Ollama API
-        - 在聊天界面实时显示用户消息和AI回复
-        - 使用流式响应技术实现AI回复的实时显示
-        - 处理网络请求过程中可能出现的各种异常
-        - 维护对话历史记录
+        - 获取用户输入的消息，连同当前模型和生成参数一起生成一个任务
+        - 正在生成回复时新消息只会排队等待，不会与正在进行的回复交错显示
+        - 排队中的消息可以在队列面板中调整顺序或取消
+        - 每个会话同时进行的生成数量由“并发”设置控制，不同会话的消息互不等待
         工作流程：
-        1. 获取用户输入和服务器配置
-        2. 在界面显示用户消息
-        3. 发送API请求并获取流式响应
-        4. 实时更新界面显示AI回复
-        5. 保存对话历史
-        6. 处理可能的异常情况
+        1. 获取用户输入和服务器配置（只在主线程中读取Tk控件）
+        2. 创建任务并加入等待队列
+        3. 调用schedule_prompts按并发上限启动任务
         """
         # 获取输入框内容并去除首尾空白
-        message = self.input_text.get("1.0", tk.END).strip()
-        
-        # 检查消息是否为空
-        if not message:
-            messagebox.showinfo("提示", "您想聊啥？")
-            return
-
-        # 获取当前系统时间，用于在聊天记录中显示消息发送时间
-        current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-
-        # 从输入文本框获取用户输入的消息内容并去除首尾空白字符
         user_message = self.input_text.get("1.0", tk.END).strip()
         
-        # 消息为空时直接返回，不执行后续操作
+        # 检查消息是否为空（只附加了图片时使用默认提问）
+        if not user_message and self.pending_document:
+            user_message = "请总结这份文档的主要内容。"
+        if not user_message and self.pending_images:
+            user_message = "请描述这张图片。"
         if not user_message:
+            messagebox.showinfo("提示", "您想聊啥？")
             return
         
+        # 消息属于当前会话，使用该会话选择的AI模型
+        session = self.current_session
+        job = self.create_job(session, user_message)
+        # 本轮的预填充状态：只有预填充的内容与发送的消息完全一致才算已预填充，通过主机池发送时不预填充
+        if job.get('use_pool'):
+            job['prefill'] = 'none'
+        elif session.prefill_text == user_message:
+            job['prefill'] = 'done'
+        else:
+            job['prefill'] = 'running' if session.prefill_running else 'none'
+        # 新消息改变了对话前缀，本轮的预填充结果不再有效
+        if self.prefill_after_id:
+            self.root.after_cancel(self.prefill_after_id)
+            self.prefill_after_id = None
+        session.prefill_text = None
+        session.turn += 1
+        # 附加的图片随任务一起保存，缩放和编码在生成线程中进行
+        if self.pending_images:
+            job['images'] = self.pending_images
+        # 文档附件只记录路径和处理方式，分段和映射归约在生成线程中进行，附加文档时不再检索知识库
+        if self.pending_document:
+            job['document'] = dict(self.pending_document, mode=DocumentAttachment.MODES[self.document_mode.get()])
+            job.pop('retrieval', None)
+        self.clear_attachments()
+        self.pending_prompts.append(job)
+        
+        # 清空用户输入框并重新聚焦，用户可以继续输入下一条消息
+        self.input_text.delete("1.0", tk.END)
+        self.input_text.config(state='normal')
+        self.input_text.focus()
+
+        # 按并发上限启动排队中的任务
+        self.schedule_prompts()
+# 这个方法只负责把消息放入队列，真正的网络请求在后台线程中完成，
+# 因此连续按回车不会再出现两个回复交错写入chat_text、对话历史错乱的问题。
+
+    def create_job(self, session, prompt):
+        # 按当前界面设置为会话创建生成任务，工作线程只会使用任务中保存的数据，不会访问Tk控件
         # 从界面输入框获取Ollama服务器的IP地址和端口号
         ip = self.ip_entry.get().strip()
         port = self.port_entry.get().strip()
-        # 获取当前选择的AI模型名称
-        model = self.get_selected_model()
-        
-        # 临时解除聊天文本区域的只读状态，以便添加新内容
-        self.chat_text.config(state='normal')
-        # 在聊天区域添加用户消息，包含时间戳和消息内容
-        self.chat_text.insert(tk.END, f"\n[{current_time}]\n你: {user_message}\n\n")
-        # 添加AI回复的前缀标识，不包含时间戳
-        self.chat_text.insert(tk.END, "AI: ")
-        # 自动滚动聊天区域到最新内容
-        self.chat_text.see(tk.END)
-        # 恢复聊天文本区域的只读状态，防止用户修改历史消息
-        self.chat_text.config(state='disabled')
-        
-        # 清空用户输入框，为下一次输入做准备
-        self.input_text.delete("1.0", tk.END)
-        
-        # 强制更新界面显示，确保用户消息立即可见
-        self.root.update()
-        
-        try:            
-            # 构建完整的Ollama API请求URL
-            url = f"http://{ip}:{port}/api/generate"
-            
-            # 准备API请求的JSON数据
-            data = {
-                "model": model,      # 指定使用的AI模型
-                "prompt": user_message,  # 用户输入的提示文本
-                "stream": True       # 启用流式响应模式，实现实时显示
-            }            
-            # 向Ollama API发送POST请求，启用流式响应模式
-            # stream=True参数使请求保持连接，逐步接收响应内容
-            response = requests.post(url, json=data, stream=True)
-            # 检查HTTP响应状态码，非2xx状态会抛出异常
-            response.raise_for_status()
-            
-            # 初始化空字符串，用于累积存储完整的AI回复内容
-            full_response = ""
-            
-            """
-            流式响应处理循环：
-            1. 使用iter_lines()方法逐行获取响应数据
-            2. 每行数据代表AI回复的一个片段
-            3. 解析每个片段并实时更新到界面
-            4. 同时累积构建完整回复文本
-            """
+        model = session.model
+        self.job_counter += 1
+        job = {
+            'id': self.job_counter,                 # 任务编号
+            'prompt': prompt,                       # 用户输入的提示文本
+            'model': model,                         # 使用的AI模型
+            'url': f"http://{ip}:{port}/api/generate",  # 生成接口地址
+            'options': self.options_profiles.options_for(model),  # 该模型保存的生成参数
+            'think': self.options_profiles.think_for(model),      # 思考模式，None表示使用服务器默认
+            'cancel': threading.Event(),            # 取消标志
+            'response': '',                         # 累积的完整回复
+            'session': session,                     # 所属会话
+            'buffer': [],                           # 会话在后台时缓冲的片段
+            'prefill': 'none',                      # 发送时的预填充状态（见OptionsProfileStore.PREFILL_LABELS）
+        }
+        # 启用主机池时，由生成线程在发送前选择目标主机
+        if self.host_pool.enabled and self.host_pool.hosts:
+            job['use_pool'] = True
+        # 开启回答缓存且请求为确定性时，记录模型digest用于计算缓存键
+        if (self.response_cache_enabled.get() and ResponseCache.is_deterministic(job['options'])
+                and self.model_digests.get(model)):
+            job['cache_digest'] = self.model_digests[model]
+            # 勾选“跳过缓存”时仍会生成并更新缓存，但不读取已有结果
+            job['cache_read'] = not self.bypass_response_cache.get()
+        # 结构化输出模式记录输出Schema，没有编辑Schema时只要求输出合法的JSON
+        if self.structured_output_enabled.get():
+            job['schema'] = self.output_schema
+        # 开启知识库检索时记录嵌入接口和检索参数，检索在生成线程中进行
+        if self.retrieval_enabled.get() and self.get_document_index().chunk_count():
+            job['retrieval'] = {'url': f"http://{ip}:{port}/api/embed",
+                                'model': self.document_index.model,
+                                'k': self.retrieval_top_k}
+        return job
+
+    def schedule_prompts(self):
+        # 按队列顺序启动等待中的任务，并发上限按会话计算，不同会话的消息可以同时生成
+        for job in list(self.pending_prompts):
+            if len(self.session_jobs(job['session'])[0]) < self.max_parallel_generations:
+                self.pending_prompts.remove(job)
+                self.start_generation(job)
+        self.refresh_queue_view()
+
+    def start_generation(self, job):
+        # 在聊天区域写入用户消息和AI回复前缀，并为该任务创建独立的插入位置标记
+        current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        chat_text = job['session'].text
+        chat_text.config(state='normal')
+        chat_text.insert(tk.END, f"\n[{current_time}]\n你: {job['prompt']}\n")
+        if job.get('images'):
+            chat_text.insert(tk.END, f"[图片: {', '.join(name for name, _source in job['images'])}]\n")
+        if job.get('document'):
+            chat_text.insert(tk.END, f"[文档: {job['document']['name']}]\n")
+        chat_text.insert(tk.END, "\n")
+        chat_text.insert(tk.END, "AI: \n\n")
+        # 标记位于“AI: ”之后、结尾两个换行之前（end-1c是文本控件自带的最后一个换行）
+        # 使用右侧重力使后续插入的片段始终追加在标记之前，多个任务同时生成时各自写入自己的位置
+        job['mark'] = f"gen_{job['id']}"
+        chat_text.mark_set(job['mark'], 'end-3c')
+        chat_text.mark_gravity(job['mark'], 'right')
+        # 每个任务使用独立的Markdown渲染器，在标记位置逐行渲染回答
+        job['renderer'] = MarkdownStreamRenderer(chat_text, job['mark'])
+        chat_text.see(tk.END)
+        chat_text.config(state='disabled')
+
+        # 普通提问接在当前节点之后，重新生成和修改提问的任务已经指定了父节点
+        job.setdefault('parent', job['session'].head)
+        self.apply_session_context(job, job['session'], job['parent'])
+        self.active_generations[job['id']] = job
+        threading.Thread(target=self.generation_worker, args=(job,), daemon=True).start()
+
+    def apply_session_context(self, job, session, node_id):
+        # 从对话树的指定节点继续提问：发送该节点保存的上下文，不同会话、不同分支的上下文互不影响
+        # 节点回答包含思考内容、上下文已被释放或由其他模型（版本）生成时，改为发送不含思考内容的对话记录
+        context = session.context_for(node_id, job['model'], self.model_digests.get(job['model']))
+        if context:
+            job['context'] = context
+        elif node_id is not None:
+            job['transcript'] = session.transcript(node_id)
+
+    def build_generate_payload(self, job):
+        # 根据任务构建/api/generate的请求数据
+        data = {
+            "model": job['model'],    # 指定使用的AI模型
+            "prompt": job.get('transcript', '') + job.get('augmented_prompt', job['prompt']),  # 提示文本（开启检索时包含参考资料）
+            "stream": True            # 启用流式响应模式，实现实时显示
+        }
+        # 按模型设置开启或关闭思考，未设置时由服务器决定
+        if job.get('think') is not None:
+            data["think"] = job['think']
+        # 合并当前模型保存的生成参数（num_ctx、num_gpu等），未设置时使用服务器默认值
+        if job['options']:
+            data["options"] = job['options']
+        # 会话上一轮回答返回的上下文
+        if job.get('context'):
+            data["context"] = job['context']
+        # 视觉模型的图片附件（base64编码）
+        if job.get('encoded_images'):
+            data["images"] = job['encoded_images']
+        # 结构化输出：服务器按Schema约束生成，未设置Schema时使用JSON模式
+        if 'schema' in job:
+            data["format"] = job['schema'] or "json"
+        return data
+
+    def generation_worker(self, job):
+        """
+        在后台线程中执行流式生成请求
+
+        - 每收到一个片段就通过ui_events队列交给主线程显示
+        - 检测到取消标志时关闭连接并结束
+        - 不直接访问任何Tk控件
+        """
+        # 记录开始时间，用于日志中的完整流式耗时
+        started = time.perf_counter()
+        # 从回答中分离<think>思考内容，思考片段和回答片段分别交给主线程
+        splitter = ThinkingSplitter()
+        # 结构化输出模式下逐段校验回答，一旦不可能再符合Schema就提前中止
+        validator = StreamingJsonValidator(job['schema']) if 'schema' in job else None
+
+        def emit(segments):
+            for is_thinking, text in segments:
+                if is_thinking is None:
+                    # 模板省略了<think>，已经显示的回答改为思考内容
+                    self.ui_events.put(('retract', job['id'], text))
+                    continue
+                self.ui_events.put(('thinking' if is_thinking else 'token', job['id'], text))
+                if validator and not is_thinking:
+                    validator.feed(text)
+
+        def finish(result):
+            # 校验通过的结果解析为对象随任务一起交给主线程
+            if validator:
+                job['structured'] = validator.finish()
+            self.ui_events.put(('done', job['id'], result))
+        # 开启知识库检索时先检索相关片段，检索失败不影响正常提问
+        if job.get('retrieval'):
+            try:
+                self.augment_prompt(job)
+            except Exception as e:
+                logger.warning(f"知识库检索失败: {str(e)}")
+        response = None
+        try:
+            # 发送前估算显存占用，放不下时询问用户是否改用较小的num_ctx
+            # 通过主机池发送时目标主机尚未确定，不做检查
+            if self.memory_fit.enabled and not job.get('use_pool') and not self.check_memory_fit(job):
+                self.ui_events.put(('cancelled', job['id'], None))
+                return
+            # 图片附件在生成线程中缩放和编码，同一张图片再次发送时直接使用缓存结果
+            if job.get('images'):
+                job['encoded_images'] = []
+                for name, source in job['images']:
+                    encoded, note = self.image_encoder.encode(source)
+                    job['encoded_images'].append(encoded)
+                    logger.info(f"图片附件 {name}: {note}")
+            # 文档附件按上下文长度分段处理，映射阶段可能需要多次请求
+            if job.get('document') and not self.process_document(job):
+                self.ui_events.put(('cancelled', job['id'], None))
+                return
+            payload = self.build_generate_payload(job)
+            # 确定性请求先查回答缓存，命中时按原片段顺序回放，与流式显示走同一条路径
+            cache_key = None
+            if job.get('cache_digest'):
+                cache_key = ResponseCache.make_key(job['cache_digest'], payload)
+                cached = self.response_cache.get(cache_key) if job['cache_read'] else None
+                if cached:
+                    parts, final = cached
+                    for response_part in parts:
+                        emit(splitter.feed(response_part))
+                    emit(splitter.flush())
+                    final['cached'] = True
+                    finish(final)
+                    return
+            # 启用主机池时选择负载最低的健康主机，连接失败会计入该主机的熔断计数
+            if job.get('use_pool'):
+                job['host'] = self.host_pool.acquire(job['model'])
+                job['url'] = f"{job['host']}/api/generate"
+            # 首token时间：从发送请求到收到第一个思考或回答片段
+            # 服务器在第一个片段生成后才返回响应头，因此必须在发送请求之前开始计时，才能包含加载和提示词计算的时间
+            request_started = time.perf_counter()
+            # 向Ollama API发送POST请求，stream=True使请求保持连接，逐步接收响应内容
+            try:
+                response = api.post(job['url'], json=payload, stream=True, timeout=GENERATE_TIMEOUT)
+                # 检查HTTP响应状态码，非2xx状态会抛出异常
+                response.raise_for_status()
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+                # 连接失败、超时和服务器5xx错误都计入主机的熔断计数，4xx是请求本身的问题，不计入
+                status = e.response.status_code if isinstance(e, requests.HTTPError) else None
+                if job.get('host') and (status is None or status >= 500):
+                    self.host_pool.record_failure(job['host'], str(e))
+                raise
+            parts = []
             for line in response.iter_lines():
-                if line:  # 确保行内容非空
-                    # 将字节流解码为UTF-8字符串并解析JSON数据
-                    result = json.loads(line.decode('utf-8'))
-                    # 从JSON响应中提取当前文本片段
-                    response_part = result.get('response', '')
-                    
-                    if response_part:  # 确保响应片段非空
-                        # 将当前片段追加到完整回复字符串中
-                        full_response += response_part
-                        
-                        """
-                        实时更新聊天界面：
-                        1. 临时解除文本区域的只读状态
-                        2. 追加当前响应片段到文本末尾
-                        3. 自动滚动确保最新内容可见
-                        4. 恢复文本区域的只读状态
-                        5. 强制刷新UI确保实时显示
-                        """
-                        self.chat_text.config(state='normal')  # 临时启用编辑状态
-                        self.chat_text.insert(tk.END, response_part)  # 插入当前片段
-                        self.chat_text.see(tk.END)  # 自动滚动到最新内容
-                        self.chat_text.config(state='disabled')  # 恢复只读状态
-                        # 强制更新GUI界面，确保用户能实时看到AI回复
-                        self.root.update()
-            
-            # AI回复完成后的界面处理
-            # 添加额外换行，提高可读性并为下一次对话做准备
-            self.chat_text.config(state='normal')  # 临时启用编辑状态
-            self.chat_text.insert(tk.END, "\n\n")  # 插入两个换行符
-            self.chat_text.see(tk.END)  # 确保滚动到最新位置
-            self.chat_text.config(state='disabled')  # 恢复只读状态
-            
-            """
-            对话历史管理：
-            1. 检查conversation_history属性是否存在
-            2. 不存在则初始化为空列表
-            3. 将当前对话(用户问题和AI完整回复)添加到历史记录
-            4. 采用字典结构存储，便于后续处理和显示
-            """
-            if not hasattr(self, 'conversation_history'):
-                self.conversation_history = []  # 首次使用时初始化历史记录列表
-            # 将当前对话添加到历史记录中，包含用户问题和AI完整回复
-            self.conversation_history.append({"user": user_message, "ai": full_response})
-            
+                if job['cancel'].is_set():
+                    response.close()
+                    self.ui_events.put(('cancelled', job['id'], None))
+                    return
+                if not line:
+                    continue
+                # 将字节流解码为UTF-8字符串并解析JSON数据
+                result = json.loads(line.decode('utf-8'))
+                if 'ttft' not in job and (result.get('thinking') or result.get('response')):
+                    job['ttft'] = time.perf_counter() - request_started
+                # 开启think时服务器通过单独的thinking字段返回思考内容
+                if result.get('thinking'):
+                    self.ui_events.put(('thinking', job['id'], result['thinking']))
+                response_part = result.get('response', '')
+                if response_part:
+                    parts.append(response_part)
+                    emit(splitter.feed(response_part))
+                # 最后一条数据包含服务器报告的加载和推理耗时
+                if result.get('done'):
+                    emit(splitter.flush())
+                    if cache_key:
+                        self.response_cache.put(cache_key, parts, result)
+                    logger.info("generate_done", extra={'fields': {
+                        'model': job['model'], 'host': job.get('host', ''), 'chunks': len(parts),
+                        'elapsed_ms': round((time.perf_counter() - started) * 1000, 1),
+                        'eval_count': result.get('eval_count')}})
+                    finish(result)
+                    return
+            finish({})
+        except SchemaMismatch as e:
+            # 关闭连接停止服务器继续生成，已显示的内容保留
+            if response is not None:
+                response.close()
+            self.ui_events.put(('schema_abort', job['id'], str(e)))
         except Exception as e:
-            """
-            异常处理机制：
-            1. 捕获请求过程中可能出现的所有异常
-            2. 包括网络错误、服务器错误、JSON解析错误等
-            3. 提供多层次的错误反馈（控制台、聊天窗口、对话框）
-            4. 确保即使出错也不会导致程序崩溃
-            """
+            self.ui_events.put(('error', job['id'], str(e)))
+        finally:
+            if job.get('host'):
+                self.host_pool.release(job['host'])
+
+    def process_ui_events(self):
+        """
+        在主线程中定时处理后台线程产生的事件
+
+        同一轮中属于同一任务的多个片段会合并为一次插入，减少文本控件的重绘次数。
+        """
+        # 任务编号 -> [[类型, 片段列表], ...]，相邻的同类片段合并，思考片段和回答片段保持原有顺序
+        pending_tokens = {}
+        finished = []
+
+        def flush_tokens():
+            # 将本轮累积的片段按任务一次性插入
+            for job_id, segments in pending_tokens.items():
+                job = self.active_generations.get(job_id)
+                if job is None:
+                    continue
+                for kind, parts in segments:
+                    if kind == 'thinking':
+                        self.append_thinking(job, ''.join(parts))
+                    else:
+                        self.append_answer(job, ''.join(parts))
+            pending_tokens.clear()
+
+        try:
+            while True:
+                kind, job_id, payload = self.ui_events.get_nowait()
+                if kind in ('token', 'thinking'):
+                    segments = pending_tokens.setdefault(job_id, [])
+                    if segments and segments[-1][0] == kind:
+                        segments[-1][1].append(payload)
+                    else:
+                        segments.append([kind, [payload]])
+                elif kind == 'call':
+                    # 后台线程请求在主线程执行的回调，先插入之前的片段以保持顺序
+                    flush_tokens()
+                    payload()
+                elif kind == 'retract':
+                    # 撤回已经显示的回答之前先插入之前的片段，保证撤回的范围完整
+                    flush_tokens()
+                    job = self.active_generations.get(job_id)
+                    if job is not None:
+                        self.retract_answer(job, payload)
+                else:
+                    finished.append((kind, job_id, payload))
+        except queue.Empty:
+            pass
+        flush_tokens()
+
+        for kind, job_id, payload in finished:
+            job = self.active_generations.pop(job_id, None)
+            if job is None:
+                continue
+            self.finish_generation(job, kind, payload)
+
+        if finished:
+            self.schedule_prompts()
+        self.root.after(30, self.process_ui_events)
+
+    def append_answer(self, job, text):
+        # 处理回答片段：前台会话直接渲染，后台会话只缓冲
+        job['response'] += text
+        session = job['session']
+        if session.closed:
+            return
+        section = job.get('thinking')
+        if section and not section['done']:
+            # 回答开始说明思考已经结束，只在这时更新一次折叠标题
+            section['done'] = True
+            self.update_thinking_header(section)
+        if session is not self.current_session:
+            # 后台会话只缓冲片段，并在标签页上提示有新内容
+            job['buffer'].append(text)
+            if not session.unread:
+                session.unread = True
+                self.session_notebook.tab(session.frame, text=session.tab_text())
+            return
+        job['renderer'].feed(text)
+        session.text.see(tk.END)
+
+    def retract_answer(self, job, text):
+        # 回答开头其实是省略了<think>的思考内容：删除已经渲染的回答，改为显示在折叠的思考过程中
+        job['response'] = ''
+        job['buffer'].clear()
+        if job['session'].closed:
+            return
+        job['renderer'].reset(job.get('thinking'))
+        self.append_thinking(job, text)
+
+    def append_thinking(self, job, text):
+        """
+        处理思考片段
+
+        思考内容保存在列表中，默认折叠显示为一行标题；折叠时收到新的思考片段不会改动文本控件，
+        展开后才把全部思考内容插入标题下方，之后的片段直接追加。
+        """
+        session = job['session']
+        if session.closed:
+            return
+        section = job.get('thinking')
+        if section is None:
+            section = self.create_thinking_section(job)
+        section['parts'].append(text)
+        section['chars'] += len(text)
+        if section['expanded']:
+            session.text.config(state='normal')
+            session.text.insert(section['end'], text, ('md_thinking',))
+            session.text.config(state='disabled')
+
+    def create_thinking_section(self, job):
+        # 在回答之前插入折叠的思考过程标题，并创建用于展开内容的区域标记
+        session = job['session']
+        text_widget = session.text
+        name = f"think_{job['id']}"
+        section = {'parts': [], 'chars': 0, 'expanded': False, 'done': False, 'evicted': False,
+                   'text': text_widget, 'header_tag': f"{name}_header",
+                   'start': f"{name}_start", 'end': f"{name}_end"}
+        # 先渲染缓冲中的回答片段，保证标题位于正确的位置
+        self.flush_job_buffer(job)
+        renderer = job['renderer']
+        renderer.insert_plain(self.thinking_header_text(section), (section['header_tag'], 'md_thinking_header'))
+        renderer.insert_plain('\n\n')
+        # 思考内容区域位于标题和空行之间，与后面的回答隔开，不会受到回答插入的影响
+        index = text_widget.index(f"{renderer.tail_mark} -1c")
+        text_widget.mark_set(section['start'], index)
+        text_widget.mark_gravity(section['start'], 'left')
+        text_widget.mark_set(section['end'], index)
+        text_widget.mark_gravity(section['end'], 'right')
+        text_widget.tag_bind(section['header_tag'], '<Button-1>', lambda event: self.toggle_thinking(section))
+        text_widget.tag_bind(section['header_tag'], '<Enter>', lambda event: text_widget.config(cursor='hand2'))
+        text_widget.tag_bind(section['header_tag'], '<Leave>', lambda event: text_widget.config(cursor=''))
+        job['thinking'] = section
+
+        # 每个会话只保留最近若干个回答的思考内容，更早的折叠后释放
+        session.thinking_sections[job['id']] = section
+        while len(session.thinking_sections) > ChatSession.MAX_THINKING_SECTIONS:
+            _job_id, old = session.thinking_sections.popitem(last=False)
+            if old['expanded']:
+                self.toggle_thinking(old)
+            old['parts'] = []
+            old['evicted'] = True
+            self.update_thinking_header(old)
+        return section
+
+    @staticmethod
+    def thinking_header_text(section):
+        # 生成思考过程标题文字
+        if section['evicted']:
+            return f"思考过程（{section['chars']}字，已释放）"
+        if not section['done']:
+            return "▶ 思考过程（思考中...）"
+        action = '点击折叠' if section['expanded'] else '点击展开'
+        return f"{'▼' if section['expanded'] else '▶'} 思考过程（{section['chars']}字，{action}）"
+
+    def update_thinking_header(self, section):
+        # 替换思考过程标题文字
+        text_widget = section['text']
+        ranges = text_widget.tag_ranges(section['header_tag'])
+        if not ranges:
+            return
+        text_widget.config(state='normal')
+        text_widget.delete(ranges[0], ranges[1])
+        text_widget.insert(ranges[0], self.thinking_header_text(section), (section['header_tag'], 'md_thinking_header'))
+        text_widget.config(state='disabled')
+
+    def toggle_thinking(self, section):
+        # 展开时一次性插入全部思考内容，折叠时删除，已释放的思考内容不能再展开
+        if section['evicted']:
+            return
+        text_widget = section['text']
+        text_widget.config(state='normal')
+        if section['expanded']:
+            text_widget.delete(section['start'], section['end'])
+        else:
+            text_widget.insert(section['end'], ''.join(section['parts']), ('md_thinking',))
+        text_widget.config(state='disabled')
+        section['expanded'] = not section['expanded']
+        self.update_thinking_header(section)
+# 思考过程与回答分开处理：回答按Markdown渲染并记入对话历史，思考内容只在展开时显示，
+# 不计入历史记录，也不会随下一轮提问发送回服务器。
+
+    def insert_generation_text(self, job, text, *tags):
+        # 在任务自己的标记位置插入文本，并保持聊天区域只读
+        # 回答仍在渲染时交给渲染器插入，保证未完成的Markdown行始终位于末尾
+        if job['session'].closed:
+            return
+        chat_text = job['session'].text
+        renderer = job.get('renderer')
+        if renderer and not renderer.finished:
+            # 先渲染缓冲中的片段，保证插入的文本位于已生成内容之后
+            self.flush_job_buffer(job)
+            renderer.insert_plain(text, tags)
+            chat_text.see(tk.END)
+            return
+        chat_text.config(state='normal')
+        chat_text.insert(job['mark'], text, tags)
+        chat_text.see(tk.END)
+        chat_text.config(state='disabled')
+
+    def finish_generation(self, job, kind, payload):
+        # 处理任务结束：成功时保存对话历史和耗时统计，失败或取消时给出提示
+        session = job['session']
+        if session.closed:
+            return
+        # 先渲染后台期间缓冲的片段，再完成最后一行的Markdown渲染
+        self.flush_job_buffer(job)
+        job['renderer'].finish()
+        section = job.get('thinking')
+        if section and not section['done']:
+            section['done'] = True
+            self.update_thinking_header(section)
+        if kind == 'done':
+            if payload.get('cached'):
+                # 命中回答缓存时不记录耗时统计，只显示缓存命中情况
+                self.stats_label.config(text=f"[回答缓存命中] 命中 {self.response_cache.hits} / "
+                                             f"未命中 {self.response_cache.misses}")
+            elif payload:
+                stats = self.options_profiles.record_stats(job['model'], payload)
+                stats_text = self.options_profiles.format_stats(stats)
+                # 通过主机池发送时显示实际处理请求的主机
+                if job.get('host'):
+                    stats_text = f"{job['host']} {stats_text}"
+                # 显示首token时间以及预填充和未预填充时的平均值，用于按模型验证预填充的效果
+                if 'ttft' in job:
+                    self.options_profiles.record_ttft(job['model'], job['ttft'], job['prefill'])
+                    stats_text += "\n" + self.options_profiles.format_ttft(job['model'], job['ttft'], job['prefill'])
+                self.stats_label.config(text=stats_text)
+            # 将本轮问答加入对话树，保存该节点的上下文
+            # 服务器返回的上下文包含思考内容，回答有思考过程时不保存，之后从该节点继续时改为发送对话记录
+            node_id = session.add_turn(job['parent'], job['prompt'], job['response'],
+                                       payload.get('context') if not section else None,
+                                       job['model'], self.model_digests.get(job['model']))
+            # 生成期间没有切换到其他分支时，新节点成为当前节点；否则作为新分支保留
+            if session.head == job['parent']:
+                session.head = node_id
+            # 节点数超过上限时删除最早的旁支，新节点和其他任务将要接上的节点不会被删除
+            active, pending = self.session_jobs(session)
+            session.prune([node_id] + [other['parent'] for other in active + pending if other.get('parent')])
+            self.save_session_snapshot(session)
+            # 校验通过的结构化结果保存到会话中，可以导出为JSON文件
+            if 'structured' in job:
+                session.structured_results.append(job['structured'])
+                self.insert_generation_text(job, f" [JSON校验通过，本会话已记录 {len(session.structured_results)} 条]")
+        elif kind == 'cancelled':
+            self.insert_generation_text(job, " [已停止]")
+        elif kind == 'schema_abort':
+            # 输出已不可能符合Schema时提前中止，不弹窗打断，只在回答末尾和状态栏说明原因
+            self.insert_generation_text(job, f" [输出不符合Schema，已中止: {payload}]")
+            self.stats_label.config(text=f"结构化输出校验失败: {payload}")
+        else:
             # 构建详细的错误信息字符串
-            error_message = f"发送消息时出错: {str(e)}"
-            # 在控制台输出错误信息，便于调试
-            print(f"错误: {error_message}")
-            
+            error_message = f"发送消息时出错: {payload}"
+            # 在日志中记录错误信息，便于调试
+            logger.error(error_message, extra={'fields': {'model': job['model'], 'host': job.get('host', '')}})
             # 在聊天窗口中显示错误信息，让用户直接看到错误
-            self.chat_text.config(state='normal')  # 临时启用编辑状态
-            self.chat_text.insert(tk.END, f"错误: {error_message}\n\n")  # 插入错误信息
-            self.chat_text.see(tk.END)  # 滚动到错误信息位置
-            self.chat_text.config(state='disabled')  # 恢复只读状态
-            
+            self.insert_generation_text(job, f"错误: {error_message}")
             # 弹出错误对话框，确保用户注意到错误情况
             messagebox.showerror("错误", error_message)
-        
-        finally:
-            """
-            消息发送完成后的清理和重置操作：
-            1. 无论消息发送成功还是失败，都会执行此代码块
-            2. 确保输入区域恢复到可用状态
-            3. 重新聚焦到输入框，方便用户继续输入
-            
-            执行顺序：
-            - 首先清空输入框内容
-            - 然后确保输入框处于可编辑状态
-            - 最后将输入焦点重新设置到输入框
-            
-            设计目的：
-            - 提供一致的用户体验
-            - 确保即使在错误情况下界面也能正常使用
-            - 遵循资源管理的最佳实践
-            """
-            # 清空输入文本框中的所有内容，为下一次输入做准备
-            self.input_text.delete("1.0", tk.END)
-            # 确保输入框处于可编辑状态，防止因异常导致输入框被锁定
-            self.input_text.config(state='normal')
-            # 将键盘焦点重新设置到输入框，用户可以直接开始输入下一条消息
-            self.input_text.focus()
-# 该方法是 OllamaGUI 类中的核心功能方法，负责处理用户消息发送和 AI 回复的整个流程。下面是该方法的详细功能和技术特点分析：
-# 主要功能
-# 1. 用户消息处理 ：获取用户在输入框中输入的消息，并在聊天界面中显示
-# 2. 服务器通信 ：与 Ollama API 服务器建立连接并发送用户消息
-# 3. 流式响应处理 ：实时接收和显示 AI 模型的回复内容
-# 4. 对话历史管理 ：维护用户与 AI 之间的对话历史记录
-# 5. 异常处理 ：处理网络请求、数据解析等过程中可能出现的各种异常情况
-# ## 技术特点
-# ### 1. 流式响应技术
-# 该方法采用了流式响应（Streaming Response）技术，这是其最核心的技术特点：
-# - 使用 requests.post(..., stream=True) 建立持久连接
-# - 通过 response.iter_lines() 逐行获取服务器返回的数据
-# - 实时解析 JSON 数据并更新界面显示
-# - 提供即时的用户反馈，无需等待完整响应
-# 这种技术特别适合大语言模型的应用场景，因为模型生成回复可能需要较长时间，流式处理可以让用户立即看到部分回复，提升用户体验。
-# ### 2. 实时界面更新机制
-# - 使用 self.chat_text.config(state='normal'/'disabled') 动态控制文本区域的编辑状态
-# - 通过 self.root.update() 强制刷新界面，确保实时显示
-# - 使用 self.chat_text.see(tk.END) 自动滚动到最新内容
-# ### 3. 健壮的异常处理机制
-# - 采用完整的 try-except-finally 结构
-# - 提供多层次的错误反馈（控制台日志、聊天窗口提示、弹窗警告）
-# - 即使在出错情况下也能保持程序稳定运行
-# - 在 finally 块中确保界面状态一致性
-# ### 4. 对话历史管理
-# - 动态创建对话历史存储结构
-# - 使用字典格式保存用户问题和 AI 回复
-# - 支持后续功能扩展（如对话导出、上下文管理等）
-# ### 5. 用户体验优化
-# - 在发送请求前立即清空输入框，提供更好的交互体验
-# - 显示时间戳，便于用户追踪对话时间
-# - 区分用户消息和 AI 回复的显示格式
-# - 在等待 AI 回复时保持界面响应性
-# ## 实现流程
-# 1. 获取用户输入和服务器配置信息
-# 2. 在聊天界面显示用户消息
-# 3. 构建并发送 API 请求
-# 4. 流式处理响应数据并实时更新界面
-# 5. 保存对话历史
-# 6. 处理可能的异常情况
-# 7. 重置输入区域状态
-# ## 总结
-# send_message 方法通过流式处理技术实现与大语言模型的实时交互，提供良好的用户体验。其健壮的异常处理机制和界面状态管理确保程序在各种情况下的稳定运行。该方法是整个聊天应用的核心组件，以尽力体现现代 GUI 应用与 AI 服务交互的最佳实践。
+        session.text.mark_unset(job['mark'])
+        # 限制会话显示区域的行数，长时间对话不会无限占用内存
+        session.trim()
+# 生成流程分为四步：
+# 1. send_message：创建任务并入队
+# 2. schedule_prompts/start_generation：按并发上限启动任务，并在聊天区域为任务预留位置
+# 3. generation_worker：后台线程流式接收回复，通过队列交给主线程
+# 4. process_ui_events/finish_generation：主线程批量插入片段、保存历史、显示耗时
+# 整个过程中不再调用root.update()，事件循环不会被重入，界面在生成期间始终保持响应。
+
+    def open_knowledge_base(self):
+        # 打开知识库设置对话框：选择文件夹和嵌入模型，增量更新索引，开启或关闭回答时检索
+        index = self.get_document_index()
+
+        dialog = tk.Toplevel(self.root)
+        dialog.title("知识库")
+        dialog_width = 700
+        dialog_height = 420
+        dialog_x = self.root.winfo_x() + (self.root.winfo_width() - dialog_width) // 2
+        dialog_y = self.root.winfo_y() + (self.root.winfo_height() - dialog_height) // 2
+        dialog.geometry(f"{dialog_width}x{dialog_height}+{dialog_x}+{dialog_y}")
+        dialog.transient(self.root)
+
+        content_frame = ttk.Frame(dialog, padding=20)
+        content_frame.pack(fill='both', expand=True)
+
+        # 第一行：资料文件夹
+        ttk.Label(content_frame, text='资料文件夹:').grid(row=0, column=0, padx=(0,5), pady=5, sticky='e')
+        folder_entry = ttk.Entry(content_frame, width=35, font=("TkDefaultFont", 16))
+        folder_entry.insert(0, index.folder or '')
+        folder_entry.grid(row=0, column=1, padx=5, pady=5, sticky='w')
+
+        def browse_folder():
+            folder = filedialog.askdirectory(parent=dialog, initialdir=folder_entry.get() or None)
+            if folder:
+                folder_entry.delete(0, tk.END)
+                folder_entry.insert(0, folder)
+
+        ttk.Button(content_frame, text='浏览', command=browse_folder).grid(row=0, column=2, padx=5, pady=5)
+
+        # 第二行：嵌入模型
+        ttk.Label(content_frame, text='嵌入模型:').grid(row=1, column=0, padx=(0,5), pady=5, sticky='e')
+        embed_model_var = tk.StringVar(value=index.model or 'nomic-embed-text')
+        ttk.Combobox(content_frame, textvariable=embed_model_var, width=33,
+                     values=list(self.model_combobox['values']),
+                     font=("TkDefaultFont", 16)).grid(row=1, column=1, padx=5, pady=5, sticky='w')
+
+        # 第三行：检索片段数量
+        ttk.Label(content_frame, text='检索片段数:').grid(row=2, column=0, padx=(0,5), pady=5, sticky='e')
+        top_k_var = tk.StringVar(value=str(self.retrieval_top_k))
+        ttk.Spinbox(content_frame, from_=1, to=20, width=5, textvariable=top_k_var, state='readonly',
+                    font=("TkDefaultFont", 16)).grid(row=2, column=1, padx=5, pady=5, sticky='w')
+
+        # 第四行：回答时是否自动检索
+        ttk.Checkbutton(content_frame, text='回答时自动检索知识库并加入提示词',
+                        variable=self.retrieval_enabled).grid(row=3, column=0, columnspan=3, pady=5, sticky='w')
+
+        # 索引状态和进度显示
+        status_label = ttk.Label(content_frame, wraplength=640,
+                                 text=f"已索引 {len(index.files)} 个文件，{index.chunk_count()} 个片段")
+        status_label.grid(row=4, column=0, columnspan=3, pady=10, sticky='w')
+
+        # 嵌入缓存统计：本次运行的命中/未命中次数和磁盘占用
+        cache_label = ttk.Label(content_frame, foreground='#555555',
+                                font=(self.default_font[0], self.default_font[1]-4))
+        cache_label.grid(row=5, column=0, columnspan=3, sticky='w')
+
+        def refresh_cache_label():
+            count, size = self.embedding_cache.stats()
+            cache_label.config(text=f"嵌入缓存: 命中 {self.embedding_cache.hits} / 未命中 "
+                                    f"{self.embedding_cache.misses}，{count} 条，"
+                                    f"{format_bytes(size)} / {format_bytes(self.embedding_cache.max_bytes)}")
+
+        refresh_cache_label()
+
+        ip = self.ip_entry.get().strip()
+        port = self.port_entry.get().strip()
+        embed_url = f"http://{ip}:{port}/api/embed"
+
+        def on_update():
+            folder = folder_entry.get().strip()
+            embed_model = embed_model_var.get().strip()
+            if not folder or not os.path.isdir(folder):
+                messagebox.showwarning("警告", "请选择有效的资料文件夹！", parent=dialog)
+                return
+            update_button.config(state='disabled')
+
+            def progress(done, total, path):
+                # 进度回调在后台线程中执行，通过界面事件队列交给主线程更新标签
+                text = f"正在处理 {done}/{total}: {os.path.basename(path)}" if path else "正在保存索引..."
+                self.run_on_main(lambda: status_label.winfo_exists() and status_label.config(text=text))
+
+            def worker():
+                try:
+                    changed, rows = index.update(
+                        folder, embed_model,
+                        lambda texts: self.cached_embed(embed_url, embed_model, texts),
+                        progress)
+                    message = (f"更新完成：重新嵌入 {changed} 个文件、新增 {rows} 个片段；"
+                               f"共 {len(index.files)} 个文件，{index.chunk_count()} 个片段")
+                except Exception as e:
+                    message = f"更新索引失败: {str(e)}"
+
+                def done():
+                    if status_label.winfo_exists():
+                        status_label.config(text=message)
+                        update_button.config(state='normal')
+                        refresh_cache_label()
+
+                self.run_on_main(done)
+
+            threading.Thread(target=worker, daemon=True).start()
+
+        def on_close():
+            self.retrieval_top_k = int(top_k_var.get())
+            dialog.destroy()
+
+        button_frame = ttk.Frame(content_frame)
+        button_frame.grid(row=6, column=0, columnspan=3, pady=10)
+        update_button = ttk.Button(button_frame, text='更新索引', command=on_update)
+        update_button.pack(side='left', padx=20)
+
+        def on_clear_cache():
+            self.embedding_cache.clear()
+            refresh_cache_label()
+
+        ttk.Button(button_frame, text='清空缓存', command=on_clear_cache).pack(side='left', padx=20)
+        ttk.Button(button_frame, text='关闭', command=on_close).pack(side='left', padx=20)
+        dialog.protocol("WM_DELETE_WINDOW", on_close)
+# 知识库对话框不设置模态，更新索引在后台线程中进行，期间可以关闭对话框继续对话。
+
+    def open_host_pool(self):
+        # 打开主机池设置对话框：编辑主机列表、开启/关闭主机池，并实时显示各主机的健康状态
+        dialog = tk.Toplevel(self.root)
+        dialog.title("主机池")
+        dialog_width = 900
+        dialog_height = 600
+        dialog_x = self.root.winfo_x() + (self.root.winfo_width() - dialog_width) // 2
+        dialog_y = self.root.winfo_y() + (self.root.winfo_height() - dialog_height) // 2
+        dialog.geometry(f"{dialog_width}x{dialog_height}+{dialog_x}+{dialog_y}")
+        dialog.transient(self.root)
+
+        content_frame = ttk.Frame(dialog, padding=20)
+        content_frame.pack(fill='both', expand=True)
+
+        # 启用开关：关闭时对话仍然使用界面上的IP地址和端口
+        enabled_var = tk.BooleanVar(value=self.host_pool.enabled)
+        ttk.Checkbutton(content_frame, text='启用主机池（对话请求发送到负载最低的健康主机）',
+                        variable=enabled_var).pack(anchor='w')
+
+        # 主机列表输入区域，每行一个地址
+        ttk.Label(content_frame, text='主机列表（每行一个，如 192.168.1.10:11434）:').pack(anchor='w', pady=(10, 5))
+        hosts_text = tk.Text(content_frame, height=5, font=self.default_font)
+        hosts_text.pack(fill='x')
+        hosts_text.insert('1.0', '\n'.join(self.host_pool.hosts))
+
+        # 主机状态表格
+        status_tree = ttk.Treeview(content_frame, columns=('主机', '状态', '延迟', '负载', '模型数'),
+                                   show='headings', height=6)
+        for column, width in (('主机', 300), ('状态', 120), ('延迟', 120), ('负载', 120), ('模型数', 120)):
+            status_tree.heading(column, text=column)
+            status_tree.column(column, width=width, anchor='w' if column == '主机' else 'e')
+        status_tree.pack(fill='both', expand=True, pady=10)
+
+        def refresh_status():
+            # 每秒刷新一次状态表格，对话框关闭后自动停止
+            if not dialog.winfo_exists():
+                return
+            status_tree.delete(*status_tree.get_children())
+            for host, state in self.host_pool.snapshot().items():
+                if state['checked_at'] is None:
+                    status = '未探测'
+                elif state['healthy']:
+                    status = '正常'
+                else:
+                    status = '熔断'
+                latency = f"{state['latency'] * 1000:.0f}ms" if state['latency'] is not None else '-'
+                load = f"{state['loaded']}+{state['in_flight']}"
+                status_tree.insert('', 'end', values=(host, status, latency, load, len(state['models'])))
+            dialog.after(1000, refresh_status)
+
+        def on_save():
+            hosts = []
+            for line in hosts_text.get('1.0', tk.END).splitlines():
+                line = line.strip().rstrip('/')
+                if not line:
+                    continue
+                # 未写协议头时默认使用http
+                if not line.startswith(('http://', 'https://')):
+                    line = f"http://{line}"
+                if line not in hosts:
+                    hosts.append(line)
+            self.host_pool.set_hosts(hosts)
+            self.host_pool.enabled = enabled_var.get()
+            try:
+                self.host_pool.save()
+            except Exception as e:
+                messagebox.showerror("错误", f"保存主机池失败: {str(e)}", parent=dialog)
+                return
+            if self.host_pool.enabled:
+                self.host_pool.start()
+            else:
+                self.host_pool.stop()
+            # 立即在后台探测一次，尽快得到新主机的状态
+            threading.Thread(target=self.host_pool.probe_all, daemon=True).start()
+
+        button_frame = ttk.Frame(content_frame)
+        button_frame.pack(pady=5)
+        ttk.Button(button_frame, text='保存并探测', command=on_save).pack(side='left', padx=20)
+        ttk.Button(button_frame, text='关闭', command=dialog.destroy).pack(side='left', padx=20)
+
+        refresh_status()
+# 负载列显示为“服务器已加载模型数+本客户端进行中的请求数”，主机池按这个值和延迟选择目标主机。
+
+    def get_document_index(self):
+        # 延迟创建文档索引，只有使用知识库功能时才读取索引文件
+        if self.document_index is None:
+            self.document_index = DocumentIndex()
+        return self.document_index
+
+    def cached_embed(self, url, model, texts):
+        # 通过嵌入缓存生成向量，只有缓存未命中的文本才会发送/api/embed请求
+        # 模型digest未知时（例如未刷新模型列表）不使用缓存，避免不同版本的向量混用
+        digest = self.model_digests.get(model) or self.model_digests.get(f"{model}:latest")
+
+        def embed_fn(batch):
+            return embed_texts(url, model, batch, self.embed_batch_size, self.embed_concurrency)
+
+        if not digest:
+            return embed_fn(texts)
+        return self.embedding_cache.embed(model, digest, texts, embed_fn)
+
+    def run_on_main(self, callback):
+        # 从后台线程请求在主线程中执行回调（通过界面事件队列转交）
+        self.ui_events.put(('call', None, callback))
+
+    def augment_prompt(self, job):
+        # 在后台线程中检索知识库，把最相关的片段加入提示词
+        settings = job['retrieval']
+        vector = self.cached_embed(settings['url'], settings['model'], [job['prompt']])[0]
+        hits = self.document_index.search(vector, settings['k'])
+        if not hits:
+            return
+        passages = "\n\n".join(f"[{os.path.basename(path)}]\n{text}" for _score, path, text in hits)
+        job['augmented_prompt'] = (f"请参考以下资料回答问题，资料不相关时可以忽略。\n\n"
+                                   f"资料:\n{passages}\n\n问题: {job['prompt']}")
+        sources = ", ".join(sorted({os.path.basename(path) for _score, path, _text in hits}))
+        self.run_on_main(lambda: self.insert_generation_text(job, f"[参考资料: {sources}]\n"))
+# 检索在生成线程中完成，查询向量的嵌入请求不会阻塞界面；检索失败时直接按原始问题提问。
+
+    def context_length_for(self, job):
+        # 返回任务实际使用的上下文长度：优先使用num_ctx参数，否则取服务器默认值与模型最大上下文中的较小者
+        if job['options'].get('num_ctx'):
+            return job['options']['num_ctx']
+        model = job['model']
+        try:
+            show = self.fetch_model_show(job['url'].rsplit('/api/', 1)[0], model)
+        except Exception as e:
+            logger.warning(f"获取模型 {model} 的上下文长度失败: {str(e)}")
+            return DocumentAttachment.DEFAULT_NUM_CTX
+        model_ctx = MemoryFitEstimator.model_shape(show)['context_length']
+        return min(model_ctx, DocumentAttachment.DEFAULT_NUM_CTX) if model_ctx else DocumentAttachment.DEFAULT_NUM_CTX
+
+    def open_memory_fit(self):
+        # 显示当前模型在不同num_ctx下的显存估算，并设置显存预算、KV缓存类型和发送前检查
+        model = self.get_selected_model()
+        if not model:
+            messagebox.showinfo("提示", "请先选择模型")
+            return
+        ip = self.ip_entry.get().strip()
+        port = self.port_entry.get().strip()
+        base_url = f"http://{ip}:{port}"
+        fit = self.memory_fit
+
+        dialog = tk.Toplevel(self.root)
+        dialog.title(f"显存估算 - {model}")
+        dialog_width = 760
+        dialog_height = 560
+        dialog_x = self.root.winfo_x() + (self.root.winfo_width() - dialog_width) // 2
+        dialog_y = self.root.winfo_y() + (self.root.winfo_height() - dialog_height) // 2
+        dialog.geometry(f"{dialog_width}x{dialog_height}+{dialog_x}+{dialog_y}")
+        dialog.transient(self.root)
+
+        content_frame = ttk.Frame(dialog, padding=20)
+        content_frame.pack(fill='both', expand=True)
+        info_label = ttk.Label(content_frame, text='正在读取模型信息...', wraplength=700, justify='left')
+        info_label.pack(anchor='w')
+
+        table = ttk.Treeview(content_frame, columns=('num_ctx', 'kv', 'total', 'fit'), show='headings', height=9)
+        for column, title, width in (('num_ctx', 'num_ctx', 120), ('kv', 'KV缓存', 160),
+                                     ('total', '预计总占用', 160), ('fit', '能否放入', 160)):
+            table.heading(column, text=title)
+            table.column(column, width=width, anchor='e')
+        table.pack(fill='both', expand=True, pady=10)
+
+        # 设置：显存预算（GB，留空表示根据/api/ps推断）、KV缓存类型和发送前检查
+        settings_frame = ttk.Frame(content_frame)
+        settings_frame.pack(fill='x')
+        ttk.Label(settings_frame, text='显存预算(GB):').pack(side='left')
+        budget_var = tk.StringVar(value=f"{fit.budget_bytes / 1024 ** 3:g}" if fit.budget_bytes else '')
+        ttk.Entry(settings_frame, textvariable=budget_var, width=8).pack(side='left', padx=(2, 10))
+        ttk.Label(settings_frame, text='KV缓存类型:').pack(side='left')
+        kv_var = tk.StringVar(value=fit.kv_cache_type)
+        ttk.Combobox(settings_frame, textvariable=kv_var, values=list(MemoryFitEstimator.KV_CACHE_BYTES),
+                     width=6, state='readonly').pack(side='left', padx=(2, 10))
+        enabled_var = tk.BooleanVar(value=fit.enabled)
+        ttk.Checkbutton(settings_frame, text='发送前检查', variable=enabled_var).pack(side='left')
+        state = {'show': None, 'running': []}
+
+        def refresh_table():
+            # 按当前设置重新计算各个num_ctx的估算结果
+            show = state['show']
+            if show is None:
+                return
+            table.delete(*table.get_children())
+            available, source = fit.available(base_url, state['running'], model)
+            current_ctx = self.options_profiles.options_for(model).get('num_ctx') or DocumentAttachment.DEFAULT_NUM_CTX
+            estimate = fit.estimate(show, current_ctx, self.model_sizes.get(model))
+            shape = estimate['shape']
+            max_ctx = shape['context_length'] or 131072
+            info_label.config(text=(
+                f"参数量 {shape['parameters'] / 1e9:.1f}B " if shape['parameters'] else "参数量未知 ") + (
+                f"| 量化 {shape['quantization'] or '-'} | 层数 {shape['layers'] or '-'} | KV头数 {shape['kv_heads'] or '-'} "
+                f"| 每头维度 {shape['key_dim'] or '-'} | 最大上下文 {shape['context_length'] or '-'}\n"
+                f"权重 {format_bytes(estimate['weights'])} | KV缓存每1K token {format_bytes(estimate['kv_per_token'] * 1024)} | "
+                f"可用显存 {format_bytes(available) + '（' + source + '）' if available is not None else '未知（请设置显存预算）'}\n"
+                f"当前设置 num_ctx={current_ctx} 预计占用 {format_bytes(estimate['total'])}"))
+            num_ctx = MemoryFitEstimator.MIN_NUM_CTX
+            while num_ctx <= max_ctx:
+                row = fit.estimate(show, num_ctx, self.model_sizes.get(model))
+                verdict = ('-' if available is None else '可以' if row['total'] <= available else '超出')
+                table.insert('', 'end', values=(num_ctx, format_bytes(row['kv']), format_bytes(row['total']), verdict))
+                num_ctx *= 2
+            if available is not None:
+                suggestion = fit.largest_fit(estimate, available)
+                info_label.config(text=info_label.cget('text') + (
+                    f" | 最大可用 num_ctx={suggestion}" if suggestion else " | 权重本身已超出可用显存"))
+
+        def load_info():
+            # 在后台线程中读取/api/show和/api/ps
+            try:
+                show = self.fetch_model_show(base_url, model)
+                running = api.get(f"{base_url}/api/ps", timeout=5).json().get('models', [])
+            except Exception as e:
+                error = f"读取模型信息失败: {str(e)}"
+                self.run_on_main(lambda: info_label.winfo_exists() and info_label.config(text=error))
+                return
+
+            def show_result():
+                if not dialog.winfo_exists():
+                    return
+                state['show'] = show
+                state['running'] = running
+                refresh_table()
+            self.run_on_main(show_result)
+
+        def save_settings():
+            try:
+                budget = float(budget_var.get()) if budget_var.get().strip() else None
+            except ValueError:
+                messagebox.showerror("错误", "显存预算必须是数字（GB）", parent=dialog)
+                return
+            fit.budget_bytes = int(budget * 1024 ** 3) if budget else None
+            fit.kv_cache_type = kv_var.get()
+            fit.enabled = enabled_var.get()
+            fit.accepted.clear()
+            fit.save()
+            refresh_table()
+
+        button_frame = ttk.Frame(content_frame)
+        button_frame.pack(fill='x', pady=(10, 0))
+        ttk.Button(button_frame, text='关闭', command=dialog.destroy).pack(side='right', padx=5)
+        ttk.Button(button_frame, text='保存设置', command=save_settings).pack(side='right', padx=5)
+        threading.Thread(target=load_info, daemon=True).start()
+# 显存估算与发送前检查使用同一个MemoryFitEstimator，对话框中的表格可以直接验证某个num_ctx是否会超出显存。
+
+    def fetch_model_show(self, base_url, model):
+        # 获取模型的/api/show信息，按模型名称和digest缓存，模型更新后自动重新获取
+        key = (model, self.model_digests.get(model))
+        if key not in self.model_show_info:
+            response = api.post(f"{base_url}/api/show", json={"model": model})
+            response.raise_for_status()
+            self.model_show_info[key] = response.json()
+        return self.model_show_info[key]
+
+    def check_memory_fit(self, job):
+        """
+        在生成线程中检查模型和num_ctx能否放入可用显存，返回False表示用户取消发送
+
+        - 模型已经以相同的上下文长度加载时不需要检查
+        - 超出可用显存时在主线程弹窗询问：改用能放下的最大num_ctx、仍按原设置发送或取消
+        - 检查本身失败（服务器不支持/api/ps等）时不影响发送
+        """
+        model = job['model']
+        num_ctx = job['options'].get('num_ctx') or DocumentAttachment.DEFAULT_NUM_CTX
+        if (model, num_ctx) in self.memory_fit.accepted:
+            return True
+        base_url = job['url'].rsplit('/api/', 1)[0]
+        try:
+            running = api.get(f"{base_url}/api/ps", timeout=5).json().get('models', [])
+            loaded = next((item for item in running if model in (item.get('name'), item.get('model'))), None)
+            if loaded and loaded.get('context_length', num_ctx) == num_ctx:
+                return True
+            available, source = self.memory_fit.available(base_url, running, model)
+            if available is None:
+                return True
+            estimate = self.memory_fit.estimate(self.fetch_model_show(base_url, model), num_ctx,
+                                                self.model_sizes.get(model))
+        except Exception as e:
+            logger.warning(f"显存估算失败: {str(e)}")
+            return True
+        logger.info("memory_fit", extra={'fields': {
+            'model': model, 'num_ctx': num_ctx, 'estimate': int(estimate['total']), 'available': available}})
+        if estimate['total'] <= available:
+            return True
+        suggestion = self.memory_fit.largest_fit(estimate, available)
+        message = (f"模型 {model} 以 num_ctx={num_ctx} 加载预计需要 {format_bytes(estimate['total'])}"
+                   f"（权重 {format_bytes(estimate['weights'])}，KV缓存 {format_bytes(estimate['kv'])}），"
+                   f"超过可用显存 {format_bytes(available)}（{source}）。\n"
+                   f"服务器可能会把部分层放到CPU上运行，速度明显变慢，甚至加载失败。\n\n")
+        answer = {}
+        answered = threading.Event()
+
+        def ask():
+            # 在主线程中弹窗询问，生成线程等待用户的选择
+            if suggestion:
+                answer['choice'] = messagebox.askyesnocancel(
+                    "显存不足", message + f"是否改用 num_ctx={suggestion}？\n"
+                                         f"“是”：改用较小的上下文；“否”：仍按原设置发送；“取消”：取消发送")
+            else:
+                answer['choice'] = False if messagebox.askokcancel(
+                    "显存不足", message + "即使使用最小的上下文也放不下这个模型，仍然发送吗？") else None
+            answered.set()
+        self.run_on_main(ask)
+        answered.wait()
+        if answer['choice'] is None:
+            return False
+        if answer['choice']:
+            job['options'] = dict(job['options'], num_ctx=suggestion)
+            self.run_on_main(lambda: self.stats_label.config(text=f"已改用 num_ctx={suggestion} 以放入显存"))
+        else:
+            self.memory_fit.accepted.add((model, num_ctx))
+        return True
+
+    def generate_once(self, job, prompt):
+        # 以非流式请求生成一次回答，用于文档映射归约的中间步骤
+        data = {"model": job['model'], "prompt": prompt, "stream": False}
+        if job['options']:
+            data["options"] = job['options']
+        response = api.post(job['url'], json=data, timeout=GENERATE_TIMEOUT)
+        response.raise_for_status()
+        return response.json().get('response', '').strip()
+
+    def process_document(self, job):
+        """
+        在生成线程中处理文档附件，生成最终提示词
+
+        - 截断：只使用文档开头能放入上下文的部分
+        - 映射归约：逐段提取与问题相关的要点，再把要点合并后回答问题
+        返回值：任务被取消时返回False
+        """
+        document = job['document']
+        name = document['name']
+        question = job['prompt']
+        num_ctx = self.context_length_for(job)
+        budget = DocumentAttachment.chunk_budget(num_ctx, job['options'], question)
+        if document.get('tokens') is None:
+            document['tokens'] = DocumentAttachment.estimate_file(document['path'])
+        chunk_count = sum(1 for _chunk in DocumentAttachment.iter_chunks(document['path'], budget))
+        mode_name = '截断' if document['mode'] == 'truncate' else '映射归约'
+        summary = f"[文档: {name}，约 {document['tokens']} tokens，上下文 {num_ctx}，共 {chunk_count} 段，{mode_name}]\n"
+        self.run_on_main(lambda: self.insert_generation_text(job, summary))
+
+        def show_progress(text):
+            self.run_on_main(lambda: self.stats_label.config(text=text))
+
+        if document['mode'] == 'truncate' or chunk_count <= 1:
+            content = next(DocumentAttachment.iter_chunks(document['path'], budget), '')
+            note = "（文档过长，以下只是开头部分）" if chunk_count > 1 else ""
+            job['augmented_prompt'] = f"文档《{name}》{note}:\n{content}\n\n问题: {question}"
+            return True
+
+        # 映射：逐段提取要点，每段完成后更新进度
+        notes = []
+        for index, chunk in enumerate(DocumentAttachment.iter_chunks(document['path'], budget), start=1):
+            if job['cancel'].is_set():
+                return False
+            show_progress(f"文档 {name}: 正在处理第 {index}/{chunk_count} 段...")
+            note = self.generate_once(job, (
+                f"以下是文档《{name}》的第 {index}/{chunk_count} 部分。请提取其中与问题相关的全部要点，"
+                f"没有相关内容时只回答“无相关内容”。\n\n问题: {question}\n\n文档内容:\n{chunk}"))
+            if note and '无相关内容' not in note[:20]:
+                notes.append(f"[第{index}段] {note}")
+
+        # 归约：要点合计仍超出上下文时分组合并，最多合并3轮，仍超出时截断
+        for _round in range(3):
+            if DocumentAttachment.estimate_tokens('\n\n'.join(notes)) <= budget or len(notes) <= 1:
+                break
+            groups, current, current_tokens = [], [], 0
+            for note in notes:
+                note_tokens = DocumentAttachment.estimate_tokens(note)
+                if current and current_tokens + note_tokens > budget:
+                    groups.append(current)
+                    current, current_tokens = [], 0
+                current.append(note)
+                current_tokens += note_tokens
+            groups.append(current)
+            merged = []
+            for index, group in enumerate(groups, start=1):
+                if job['cancel'].is_set():
+                    return False
+                show_progress(f"文档 {name}: 正在合并要点 {index}/{len(groups)}...")
+                if len(group) == 1:
+                    merged.append(group[0])
+                    continue
+                merged.append(self.generate_once(job, (
+                    f"请合并以下要点，去掉重复内容，保留与问题相关的全部信息。\n\n问题: {question}\n\n"
+                    + '\n\n'.join(group))))
+            notes = merged
+        combined = '（文档中没有找到相关内容）'
+        if notes:
+            combined = next(DocumentAttachment.split_text(['\n\n'.join(notes)], budget), '')
+        show_progress(f"文档 {name}: {chunk_count} 段处理完成，正在生成回答...")
+        job['augmented_prompt'] = (f"以下是从文档《{name}》各部分提取的与问题相关的要点:\n{combined}\n\n"
+                                   f"请根据这些要点回答问题: {question}")
+        return True
+# 文档处理在生成线程中进行，映射阶段每完成一段就在状态栏更新进度，取消任务会在下一段开始前生效；
+# 最终提示词与知识库检索一样写入augmented_prompt，回答缓存和主机池逻辑不需要任何改动。
+
+    def edit_output_schema(self):
+        # 编辑结构化输出使用的JSON Schema，内容为空时只要求输出合法的JSON
+        dialog = tk.Toplevel(self.root)
+        dialog.title("输出Schema")
+        dialog_width = 640
+        dialog_height = 520
+        dialog_x = self.root.winfo_x() + (self.root.winfo_width() - dialog_width) // 2
+        dialog_y = self.root.winfo_y() + (self.root.winfo_height() - dialog_height) // 2
+        dialog.geometry(f"{dialog_width}x{dialog_height}+{dialog_x}+{dialog_y}")
+        dialog.transient(self.root)
+
+        content_frame = ttk.Frame(dialog, padding=20)
+        content_frame.pack(fill='both', expand=True)
+        ttk.Label(content_frame, wraplength=600,
+                  text='JSON Schema（留空表示只要求输出合法JSON）。生成过程中按Schema逐段校验，'
+                       '输出已不可能符合时立即中止。').pack(anchor='w', pady=(0, 5))
+        schema_text = tk.Text(content_frame, height=16, font=('Consolas', self.default_font[1] - 2), wrap='none')
+        schema_text.pack(fill='both', expand=True)
+        if self.output_schema:
+            schema_text.insert('1.0', json.dumps(self.output_schema, ensure_ascii=False, indent=2))
+
+        def save_schema():
+            content = schema_text.get('1.0', tk.END).strip()
+            try:
+                schema = json.loads(content) if content else None
+            except ValueError as e:
+                messagebox.showerror("错误", f"Schema不是有效的JSON: {str(e)}", parent=dialog)
+                return
+            if schema is not None and not isinstance(schema, dict):
+                messagebox.showerror("错误", "Schema必须是JSON对象", parent=dialog)
+                return
+            self.output_schema = schema
+            save_json_file(self.output_schema_path, {'schema': schema})
+            dialog.destroy()
+
+        button_frame = ttk.Frame(content_frame)
+        button_frame.pack(fill='x', pady=(10, 0))
+        ttk.Button(button_frame, text='保存', command=save_schema).pack(side='right', padx=5)
+        ttk.Button(button_frame, text='取消', command=dialog.destroy).pack(side='right', padx=5)
+
+    def export_structured_results(self):
+        # 将当前会话中校验通过的结构化结果导出为JSON数组
+        results = list(self.current_session.structured_results)
+        if not results:
+            messagebox.showinfo("提示", "当前会话还没有校验通过的JSON结果")
+            return
+        path = filedialog.asksaveasfilename(defaultextension='.json', filetypes=[('JSON', '*.json')],
+                                            initialfile=f"{self.current_session.title}.json")
+        if not path:
+            return
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+        except OSError as e:
+            messagebox.showerror("错误", f"导出失败: {str(e)}")
+            return
+        self.stats_label.config(text=f"已导出 {len(results)} 条JSON结果到 {path}")
+# 结构化输出的结果在生成线程中由StreamingJsonValidator解析，导出时直接写出对象，不需要重新解析回答文本。
+
+    def clear_response_cache(self):
+        # 清空回答缓存前先确认，避免误操作
+        if messagebox.askyesno("确认", "确定要清空回答缓存吗?"):
+            self.response_cache.clear()
+            self.stats_label.config(text="回答缓存已清空")
+
+    def refresh_queue_view(self):
+        # 刷新队列面板：先显示正在生成的任务，再按顺序显示排队中的任务
+        self.queue_listbox.delete(0, tk.END)
+        self.queue_view_ids = []
+        for job in list(self.active_generations.values()) + self.pending_prompts:
+            state = '生成中' if job['id'] in self.active_generations else '排队'
+            prompt = job['prompt'].replace('\n', ' ')
+            if len(prompt) > 50:
+                prompt = prompt[:50] + '...'
+            self.queue_listbox.insert(tk.END, f"[{state}] {job['session'].title} {job['model']}: {prompt}")
+            self.queue_view_ids.append(job['id'])
+
+    def selected_queue_job(self):
+        # 返回队列面板中当前选中的任务，未选中时返回None
+        selection = self.queue_listbox.curselection()
+        if not selection:
+            return None
+        job_id = self.queue_view_ids[selection[0]]
+        if job_id in self.active_generations:
+            return self.active_generations[job_id]
+        for job in self.pending_prompts:
+            if job['id'] == job_id:
+                return job
+        return None
+
+    def move_queued_prompt(self, offset):
+        # 调整排队中任务的顺序，offset为-1表示上移，1表示下移
+        job = self.selected_queue_job()
+        if job is None or job not in self.pending_prompts:
+            return
+        index = self.pending_prompts.index(job)
+        new_index = index + offset
+        if 0 <= new_index < len(self.pending_prompts):
+            self.pending_prompts.insert(new_index, self.pending_prompts.pop(index))
+            self.refresh_queue_view()
+            self.queue_listbox.selection_set(self.queue_view_ids.index(job['id']))
+
+    def cancel_queued_prompt(self):
+        # 取消选中的任务：排队中的任务直接移除，正在生成的任务设置取消标志
+        job = self.selected_queue_job()
+        if job is None:
+            return
+        if job in self.pending_prompts:
+            self.pending_prompts.remove(job)
+        else:
+            job['cancel'].set()
+        self.refresh_queue_view()
+
+    def on_parallel_changed(self):
+        # 修改并发数后立即按新的上限调度排队中的任务
+        try:
+            self.max_parallel_generations = max(1, int(self.parallel_var.get()))
+        except (ValueError, tk.TclError):
+            return
+        self.schedule_prompts()
+# 队列面板提供排队任务的上移、下移和取消操作，正在生成的任务可以被停止。
+# 并发数按会话计算，默认为1；当服务器设置了OLLAMA_NUM_PARALLEL大于1时，可以调大并发数让同一会话的多个提问同时生成。
+
+    def schedule_prefill(self, event=None):
+        # 输入变化时重新计时，停止输入prefill_delay_ms毫秒后才发送预填充请求
+        if not self.prefill_enabled.get():
+            return
+        if self.prefill_after_id:
+            self.root.after_cancel(self.prefill_after_id)
+        self.prefill_after_id = self.root.after(self.prefill_delay_ms, self.start_prefill)
+
+    def start_prefill(self):
+        """
+        将会话的对话前缀和当前已输入的内容发送给服务器预先计算
+
+        - 请求与正式提问使用相同的模型、参数和上下文，num_predict为0，服务器只计算提示词不生成回答
+        - 服务器保留计算结果（KV缓存），发送时只需计算新增的部分，首token时间随之缩短
+        - 会话正在生成或排队时不预填充，避免与正式请求争用服务器
+        - 启用主机池时正式请求的目标主机在发送时才确定，预填充到界面上的主机没有意义，因此不预填充
+        """
+        self.prefill_after_id = None
+        session = self.current_session
+        text = self.input_text.get("1.0", tk.END).strip()
+        if not self.prefill_enabled.get() or not session.model or text == session.prefill_text:
+            return
+        if self.host_pool.enabled and self.host_pool.hosts:
+            return
+        if not text and session.head is None:
+            return
+        active, pending = self.session_jobs(session)
+        if active or pending:
+            return
+        # 上一次预填充仍在进行时，等它结束后再按最新输入重新预填充
+        if session.prefill_running:
+            self.schedule_prefill()
+            return
+        ip = self.ip_entry.get().strip()
+        port = self.port_entry.get().strip()
+        job = {
+            'model': session.model,
+            'prompt': text,
+            'options': dict(self.options_profiles.options_for(session.model), num_predict=0),
+            'think': self.options_profiles.think_for(session.model),
+        }
+        self.apply_session_context(job, session, session.head)
+        payload = self.build_generate_payload(job)
+        payload['stream'] = False
+        session.prefill_running = True
+        threading.Thread(target=self.prefill_worker,
+                         args=(session, session.turn, f"http://{ip}:{port}/api/generate", payload, text),
+                         daemon=True).start()
+
+    def prefill_worker(self, session, turn, url, payload, text):
+        # 在后台线程中发送预填充请求，结果只用于日志和状态记录，失败时不影响正常提问
+        ok = False
+        try:
+            response = api.post(url, json=payload, timeout=300)
+            response.raise_for_status()
+            result = response.json()
+            ok = True
+            logger.info("prefill_done", extra={'fields': {
+                'model': payload['model'], 'prompt_eval_count': result.get('prompt_eval_count'),
+                'prompt_eval_ms': round((result.get('prompt_eval_duration') or 0) / 1e6, 1)}})
+        except Exception as e:
+            logger.warning(f"预填充失败: {str(e)}")
+
+        def done():
+            session.prefill_running = False
+            # 预填充期间已经发送了新消息时，结果属于上一轮，不再记录
+            if ok and turn == session.turn:
+                session.prefill_text = text
+        self.run_on_main(done)
+# 预填充利用服务器对相同提示词前缀的缓存：对话越长、历史越多，发送时节省的提示词计算时间越多。
+# 预填充使用与正式请求相同的参数，参数不同会导致服务器重新加载模型，反而增加等待时间。
 
 
 """
 程序入口点模块：
 这是整个GUI应用程序的启动入口，主要负责：
 1. 环境初始化和配置
-2. 异常输出控制
+2. 日志系统初始化（按大小轮转的日志文件 + 内存环形缓冲区）
 3. GUI程序的启动和生命周期管理
 4. 全局异常处理机制
 5. 资源清理和程序退出管理
 """
 if __name__ == '__main__':
-    # 导入基础系统操作模块
-    import os
-    import sys
-    import io
-    
     """
     环境变量配置块：
     设置Python解释器的基本运行环境，主要用于处理字符编码和输出控制
@@ -1557,64 +7144,23 @@ if __name__ == '__main__':
     os.environ['PYTHONLEGACYWINDOWSSTDIO'] = 'utf-8'
     
     """
-    警告控制机制：
-    通过warnings模块配置全局警告过滤器，抑制不必要的警告信息
-    特别用于处理PIL库等第三方模块的警告
-    """
-    import warnings
-    warnings.filterwarnings("ignore", category=UserWarning)
-    
-    """
-    标准错误输出重定向块：
-    创建内存中的文本缓冲区，用于捕获所有标准错误输出
-    避免警告和错误信息直接显示在终端中
-    保存原始stderr以便后续恢复
+    日志初始化块：
+    警告和写入stderr的内容不再缓存在内存中，而是写入大小有上限的轮转日志文件，
+    同时保留最近的日志在内存环形缓冲区中，可以在“模型操作”页面的“查看日志”中查看
+    第三方库（如PIL）的日志级别设为ERROR，避免无用的警告
     """
-    stderr_capture = io.StringIO()
-    original_stderr = sys.stderr
-    sys.stderr = stderr_capture
-    
-# ... existing code ...
-
-"""
-程序入口点模块：
-这是整个GUI应用程序的启动入口，主要负责：
-1. 环境初始化和配置
-2. 异常输出控制
-3. GUI程序的启动和生命周期管理
-4. 全局异常处理机制
-5. 资源清理和程序退出管理
-"""
-if __name__ == '__main__':
-    # 导入基础系统操作模块
-    import os
-    import sys
-    import io
-    
-    # 设置环境变量来抑制libpng警告
-    os.environ['PYTHONIOENCODING'] = 'utf-8'
-    os.environ['PYTHONLEGACYWINDOWSSTDIO'] = 'utf-8'
-    
-    # 更彻底的警告抑制方法
-    import warnings
-    warnings.filterwarnings("ignore", category=UserWarning)
-    
-    # 创建内存文本流来捕获stderr输出
-    stderr_capture = io.StringIO()
+    log_path = setup_logging()
+    logging.getLogger('PIL').setLevel(logging.ERROR)
     original_stderr = sys.stderr
-    sys.stderr = stderr_capture
-    
-    # 尝试使用PIL的日志设置来抑制警告
-    try:
-        import logging
-        logging.getLogger('PIL').setLevel(logging.ERROR)
-        logging.getLogger().setLevel(logging.ERROR)
-    except:
-        pass
+    sys.stderr = LoggerWriter(logging.ERROR)
+    logger.info("程序启动", extra={'fields': {'log_file': log_path}})
     
     try:
         # 创建Tkinter主窗口对象
         root = tk.Tk()
+        # Tk回调中未捕获的异常同样写入日志
+        root.report_callback_exception = lambda exc, value, tb: logger.error(
+            "界面回调异常", exc_info=(exc, value, tb))
         
         # 实例化应用程序主类
         app = OllamaGUI(root)
@@ -1622,14 +7168,16 @@ if __name__ == '__main__':
         # 启动Tkinter的事件循环，开始处理用户交互
         root.mainloop()
     
-        # 处理用户通过Ctrl+C等方式的主动中断
         sys.stderr = original_stderr  # 恢复原始的stderr
+        logger.info("程序已退出")
         print("程序已退出。")
         
+    # 处理用户通过Ctrl+C等方式的主动中断
     except KeyboardInterrupt:
         sys.stderr = original_stderr  # 恢复原始的stderr
         print("\n程序正在优雅地退出...")
     
     except Exception as e:
+        logger.exception("程序异常退出")
         sys.stderr = original_stderr  # 恢复原始的stderr
-        print(f"\n发生错误: {str(e)}")
\ No newline at end of file
+        print(f"\n发生错误: {str(e)}，详细信息见日志文件: {log_path}")
@@ -3,7 +3,7 @@
 实现目标：
 1. 配置环境变量以控制程序输出
 2. 使用子进程方式启动主程序
-3. 完全抑制所有标准输出和错误输出
+3. 完全抑制所有标准输出和错误输出（警告和错误由主程序写入~/.ollama_gui/logs中的轮转日志文件）
 4. 确保程序能够正常退出
 """
 import os